@@ -1,10 +1,42 @@
 import matplotlib.pyplot as plt
-from scipy import stats
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
+from 单因子测试.tool_kit import db_zcs
 from 单因子测试.tool_kit.date_N_time import gen_trade_date, shift_date
-from 单因子测试.tool_kit.base_datastruct import block_data
-from 单因子测试.tool_kit.utility_tool import cal_indicator
+from 单因子测试.tool_kit.utility_tool import cal_indicator, gen_universe_mask
+from 单因子测试.tool_kit.price_store_tool import get_post_close, cal_return_matrix, load_price_matrix
+from 单因子测试.tool_kit.ic_tool import cal_ic
+from 单因子测试.tool_kit.performance_tool import cal_performance, cal_rolling_performance
+from 单因子测试.tool_kit.position_tool import cal_turnover_array, cal_trade_cost_array, cal_net_value, simulate_position
+
+
+def cal_group_return(group_arr, return_arr, group=5, weight_arr=None):
+    """
+    在对齐的[股票代码×日期]矩阵上按日期和组号做分段求和，计算每天每组的加权平均收益率，不构造长表
+    :param group_arr: 分组矩阵，numpy.ndarray，shape是(股票数，日期数)，值为1~group的组号，nan表示不在任何组中，
+                      需要事先shift(1)，满足T日收益按照T-1日因子分组
+    :param return_arr: 收益率矩阵，numpy.ndarray，shape与group_arr相同
+    :param group: 分组数量，int
+    :param weight_arr: 权重矩阵，numpy.ndarray，shape与group_arr相同，None表示组内等权
+    :return: (分组收益矩阵，分组成员数量矩阵)，tuple，元素是numpy.ndarray，shape是(日期数，group)；
+             没有成员或成员收益率全为nan的位置收益为nan
+    """
+    n_dates = group_arr.shape[1]
+    group_arr = np.asarray(group_arr, dtype='float64')
+    in_group = (group_arr >= 1) & (group_arr <= group)
+    # 每个元素的分段编号为 日期位置*group + 组号-1
+    key = np.arange(n_dates)[None, :] * group + np.where(in_group, group_arr, 1).astype(int) - 1
+    member_arr = np.bincount(key[in_group], minlength=n_dates * group).reshape(n_dates, group)
+
+    weight_arr = np.ones_like(group_arr) if weight_arr is None else np.asarray(weight_arr, dtype='float64')
+    valid = in_group & np.isfinite(return_arr) & np.isfinite(weight_arr)
+    key, weight, ret = key[valid], weight_arr[valid], return_arr[valid]
+    weight_sum = np.bincount(key, weights=weight, minlength=n_dates * group).reshape(n_dates, group)
+    return_sum = np.bincount(key, weights=weight * ret, minlength=n_dates * group).reshape(n_dates, group)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        group_return_arr = np.where(weight_sum != 0, return_sum / weight_sum, np.nan)
+    return group_return_arr, member_arr
 
 
 class BackTest(object):
@@ -16,8 +48,17 @@ class BackTest(object):
     :param universe: 股票池，str，A/hs300/zz500/zz800
     :param group: 分组数量，int
     :param cal_ls_ret: 是否计算long-short收益，bool
+    :param universe_mask: 预先计算的股票池成员矩阵，pandas.DataFrame，index是股票代码，columns是换仓日，值为bool，
+                          若为None且universe不是a_share，则在get_group中由gen_universe_mask生成
+    :param weight_ls: 组内加权方式列表，list，equal为等权，cap为流通市值加权，sqrt_cap为流通市值平方根加权，
+                      其他名称需要在weight_dt中给出权重矩阵；第一个加权方式的结果作为self.group_return_df和self.group_value_df
+    :param weight_dt: 自定义权重矩阵，dict，key是加权方式，value是pandas.DataFrame，index是股票代码，columns是日期，
+                      T日的权重用于T+1日的收益
+    :param cache_price: 是否使用进程内的后复权价格缓存，bool，多个回测区间相互覆盖的BackTest只查询一次价格，
+                        见price_store_tool.load_adjusted_price
     """
-    def __init__(self, factor_df=None, s_date='', e_date='', freq='', universe='a_share', group=5, cal_ls_ret=False):
+    def __init__(self, factor_df=None, s_date='', e_date='', freq='', universe='a_share', group=5, cal_ls_ret=False,
+                 universe_mask=None, weight_ls=('equal',), weight_dt=None, cache_price=False):
         self.factor_df = factor_df
         self.s_date = s_date
         self.e_date = e_date
@@ -27,9 +68,15 @@ class BackTest(object):
         self.universe = universe
         self.group = group
         self.cal_ls_ret = cal_ls_ret
+        self.universe_mask = universe_mask
+        self.weight_ls = list(weight_ls)
+        self.weight_dt = {} if weight_dt is None else dict(weight_dt)
+        self.cache_price = cache_price
         self.db = db_zcs
         self.price_series = pd.Series()
         self.return_series = pd.Series()
+        self.price_df = pd.DataFrame()
+        self.return_df = pd.DataFrame()
         self.full_factor_df = pd.DataFrame()
         self.full_rank_df = pd.DataFrame()
         self.full_group_df = pd.DataFrame()
@@ -37,7 +84,16 @@ class BackTest(object):
         self.group_return_series = pd.Series()
         self.group_return_df = pd.DataFrame()
         self.group_value_df = pd.DataFrame()
+        self.group_return_dt = {}
+        self.group_value_dt = {}
         self.indicator = pd.DataFrame()
+        self.turnover_df = pd.DataFrame()
+        self.turnover_dt = {}
+        self.cost_dt = {}
+        self.net_group_value_dt = {}
+        self.net_group_value_df = pd.DataFrame()
+        self.performance = pd.DataFrame()
+        self.rolling_performance = {}
         self.ic_series = pd.Series()
         self.ic_mean = 0.0
         self.icir = 0.0
@@ -48,14 +104,34 @@ class BackTest(object):
         self.price_series: 价格序列，pandas.Series，index是[股票代码，日期]
         self.return_series: 收益率序列，pandas.Series，index是[股票代码，日期]
         二者都是date从小到大排序
+        self.price_df: 价格矩阵，pandas.DataFrame，index是股票代码，columns是日期
+        self.return_df: 收益率矩阵，pandas.DataFrame，index是股票代码，columns是日期
         """
-        cursor = self.db.ts_daily_adj_factor.find({'date': {'$gte': self.s_date, '$lte': shift_date(self.e_date, self.freq, 'post')}},
-                                                  {'_id': 0, 'date': 1, 'code': 1, 'close': 1, 'adj_factor': 1})
-        price_df = pd.DataFrame(list(cursor)).set_index(['code', 'date'])
-        price_df['post_close'] = price_df['close'] * price_df['adj_factor']
-        price_df['return'] = price_df['post_close'].groupby('code').pct_change()
-        self.price_series = price_df['post_close'].copy()
-        self.return_series = price_df['return'].copy()
+        post_close_df = get_post_close(self.s_date, shift_date(self.e_date, self.freq, 'post'), cache=self.cache_price)
+        self.price_df = post_close_df.T
+        self.return_df = cal_return_matrix(post_close_df).T
+        self.price_series = post_close_df.T.stack().rename('post_close')
+        self.return_series = self.return_df.stack(dropna=False).reindex(self.price_series.index)
+        self.return_series.rename('return', inplace=True)
+        if {'cap', 'sqrt_cap'} & (set(self.weight_ls) - set(self.weight_dt)):
+            self.match_weight()
+
+    def match_weight(self):
+        """
+        一次查询整个回测区间的流通股本，与收盘价相乘得到流通市值，同时生成cap和sqrt_cap两种权重矩阵，
+        与FactorCal中的free_mkt、sqrtmkt相同
+        self.weight_dt: 权重矩阵，dict，key是cap/sqrt_cap，value是pandas.DataFrame，index是股票代码，columns是日期
+        """
+        e_date = shift_date(self.e_date, self.freq, 'post')
+        share_data = self.db.wind_financial_2014.find({'date': {'$gte': self.s_date, '$lte': e_date}},
+                                                      {'_id': 0, 'code': 1, 'date': 1, 'free_float_shares': 1})
+        share_df = pd.DataFrame(list(share_data), columns=['code', 'date', 'free_float_shares'])
+        share_df = share_df.drop_duplicates(subset=['date', 'code']).pivot(index='code', columns='date',
+                                                                            values='free_float_shares')
+        close_df = load_price_matrix(['close'], self.s_date, e_date)['close'].T
+        free_mkt_df = share_df.astype('float64').reindex_like(close_df) * close_df
+        self.weight_dt['cap'] = free_mkt_df
+        self.weight_dt['sqrt_cap'] = np.sqrt(free_mkt_df)
 
     def get_group(self):
         """
@@ -68,51 +144,82 @@ class BackTest(object):
         self.group_return_series: 分组收益序列，pandas.Series，index是[组名，self.date_ls中的日期]
         self.group_return_df: 分组收益矩阵，pandas.DataFrame，index是self.date_ls中的日期，columns是组名+long-short
         self.group_value_df: 分组净值矩阵，pandas.DataFrame，index是self.date_ls中的日期，columns是组名+long-short
+        self.group_return_dt: 各加权方式的分组收益矩阵，dict，key是self.weight_ls中的加权方式，value同self.group_return_df
+        self.group_value_dt: 各加权方式的分组净值矩阵，dict，key是self.weight_ls中的加权方式，value同self.group_value_df
+        以上两个收益和净值矩阵是self.weight_ls中第一个加权方式的结果
         """
 
-        # 计算完整因子值矩阵self.full_factor_df ,数据填充，换仓日外的数据与换仓日相同
-        self.full_factor_ls = []
-        for date in self.date_ls:  # date_ls是所有交易日的日期
-            if date in self.trade_date_ls:  # trade_date_ls是传入的factor_df的列，只包含换仓交易日日期
-                if self.universe == 'a_share':
-                    date_factor = self.factor_df[date].copy()
-                else:
-                    universe_codes = eval('block_data(date=date).%s()' % self.universe)
-                    date_factor = self.factor_df[date].reindex(universe_codes)
-                date_factor.rename(date, inplace=True)
+        # 换仓日因子矩阵，非a_share股票池按照成员矩阵把池外股票置为空值
+        rebalance_ls = sorted(set(self.trade_date_ls) & set(self.date_ls))
+        rebalance_factor_df = self.factor_df[rebalance_ls]
+        if self.universe != 'a_share':
+            if self.universe_mask is None:
+                self.universe_mask = gen_universe_mask(rebalance_ls, self.universe)
+            mask_df = self.universe_mask.reindex(columns=rebalance_ls, fill_value=False)
+            mask_df = mask_df[mask_df.any(axis=1)].sort_index()
+            rebalance_factor_df = rebalance_factor_df.reindex(mask_df.index).where(mask_df.astype(bool))
+        else:
+            rebalance_factor_df = rebalance_factor_df.sort_index()
+
+        # 换仓日的百分比排名和分组，只在换仓日横截面上计算一次
+        rebalance_rank_df = rebalance_factor_df.rank(method='dense', pct=True)
+        rebalance_group_df = ((rebalance_rank_df*100)/((1/self.group)*100) + 1).fillna(0).astype(int)
+        rebalance_group_df = rebalance_group_df.replace({0: np.nan, self.group + 1: self.group})
+
+        # 每个交易日对应最近一个换仓日的列位置，换仓日外的数据与换仓日相同，首个换仓日之前的位置为-1，对应补充的空值列
+        position = np.searchsorted(np.array(rebalance_ls), np.array(self.date_ls), side='right') - 1
+
+        def expand(rebalance_df):
+            values = np.concatenate([rebalance_df.to_numpy(dtype='float64'),
+                                     np.full((rebalance_df.shape[0], 1), np.nan)], axis=1)
+            return pd.DataFrame(values[:, position], index=rebalance_df.index, columns=self.date_ls)
+
+        # 计算完整因子值矩阵self.full_factor_df、完整因子百分比排名矩阵self.full_rank_df、
+        # 完整因子分组矩阵self.full_group_df，列为所有交易日，行为股票，值为该股票该天的因子值/排名/组号
+        self.full_factor_df = expand(rebalance_factor_df)
+        self.full_rank_df = expand(rebalance_rank_df)
+        self.full_group_df = expand(rebalance_group_df)
+
+        # 分组矩阵shift(1)，满足T日收益按照T-1日因子分组，收益率矩阵对齐到相同的[股票代码×日期]
+        if len(self.return_df) == 0:
+            self.return_df = self.return_series.unstack(level=1)
+        group_arr = self.full_group_df.shift(1, axis=1).to_numpy(dtype='float64')
+        return_arr = self.return_df.reindex(index=self.full_group_df.index, columns=self.date_ls).to_numpy(dtype='float64')
+        code_loc, date_loc = np.nonzero(~np.isnan(group_arr))
+        date_arr = np.array(self.date_ls)
+
+        # 计算完整因子分组序列self.full_group_series，一重索引为股票代码，二重索引为该股票代码的所有交易日，值为组号
+        self.full_group_series = pd.Series(group_arr[code_loc, date_loc], index=pd.MultiIndex.from_arrays(
+            [self.full_group_df.index[code_loc], date_arr[date_loc]], names=['code', 'date']))
+
+        # 按日期和组号分段求和得到分组收益，所有加权方式共用分组矩阵和收益率矩阵，
+        # 只保留有成员的[组名，日期]，等权时与groupby(['group', 'date']).mean()的结果相同
+        for weight in self.weight_ls:
+            if weight == 'equal':
+                weight_arr = None
             else:
-                date_factor = self.full_factor_ls[-1].copy()
-                date_factor.rename(date, inplace=True)
-            self.full_factor_ls.append(date_factor)
-        self.full_factor_df = pd.concat(self.full_factor_ls, axis=1, join='outer', sort=True)
-        self.full_factor_df = self.full_factor_df.sort_index(axis=1)
-
-        # 计算完整因子百分比排名矩阵self.full_rank_df
-        self.full_rank_df = self.full_factor_df.rank(method='dense', pct=True)
-
-        # 计算完整因子分组矩阵self.full_group_df，列为排序的股票，行为日期（所有交易日），值为该股票该天第几组
-        self.full_group_df = ((self.full_rank_df*100)/((1/self.group)*100) + 1).fillna(0).astype(int)
-        self.full_group_df.replace({0: np.nan, self.group + 1: self.group}, inplace=True)
-
-        # 计算完整因子分组序列self.full_group_series，并shift(1)，满足T日收益按照T-1日因子分组，一重索引为groupby的股票代码，二重索引为该股票代码的所有交易日，值为组号
-        self.full_group_series = self.full_group_df.stack(dropna=False)
-        self.full_group_series.index.set_names(['code', 'date'], inplace=True)
-        self.full_group_series = self.full_group_series.groupby('code').shift(1).dropna()
-
-        # 计算分组收益序列self.group_return_series
-        group_match_return_df = pd.concat([self.full_group_series.rename('group'), self.return_series.rename('return')],
-                                          axis=1, join='outer').reindex(self.full_group_series.index)
-        self.group_return_series = group_match_return_df.reset_index().groupby(['group', 'date'])['return'].mean()
-
-        # 计算分组收益矩阵self.group_return_df
-        self.group_return_df = self.group_return_series.unstack(level=0)
-        self.group_return_df.loc[self.date_ls[0], :] = 0
-        self.group_return_df.sort_index(inplace=True)
-        if self.cal_ls_ret:
-            self.group_return_df.loc[:, 'long-short'] = (self.group_return_df.loc[:, self.group] - self.group_return_df.loc[:, 1])*0.5
-            
-        # 计算分组净值矩阵self.group_value_df
-        self.group_value_df = (self.group_return_df + 1).cumprod()
+                # T日收益按照T-1日收盘后的权重加权，与分组矩阵的shift(1)对应
+                weight_arr = self.weight_dt[weight].reindex(index=self.full_group_df.index, columns=self.date_ls)
+                weight_arr = weight_arr.shift(1, axis=1).to_numpy(dtype='float64')
+            group_return_arr, member_arr = cal_group_return(group_arr, return_arr, self.group, weight_arr)
+            group_pos, date_pos = np.nonzero(member_arr.T > 0)
+            group_return_series = pd.Series(group_return_arr[date_pos, group_pos], name='return',
+                                            index=pd.MultiIndex.from_arrays([(group_pos + 1).astype('float64'),
+                                                                             date_arr[date_pos]],
+                                                                            names=['group', 'date']))
+
+            # 计算分组收益矩阵和分组净值矩阵
+            group_return_df = group_return_series.unstack(level=0)
+            group_return_df.loc[self.date_ls[0], :] = 0
+            group_return_df.sort_index(inplace=True)
+            if self.cal_ls_ret:
+                group_return_df.loc[:, 'long-short'] = (group_return_df.loc[:, self.group] - group_return_df.loc[:, 1])*0.5
+            self.group_return_dt[weight] = group_return_df
+            self.group_value_dt[weight] = (group_return_df + 1).cumprod()
+            if weight == self.weight_ls[0]:
+                self.group_return_series = group_return_series
+        self.group_return_df = self.group_return_dt[self.weight_ls[0]]
+        self.group_value_df = self.group_value_dt[self.weight_ls[0]]
 
     def cal_indicator(self):
         """
@@ -121,6 +228,68 @@ class BackTest(object):
         """
         self.indicator = cal_indicator(self.group_value_df)
 
+    def cal_cost(self, commission=0.0003, stamp_duty=0.001, slippage=0.0):
+        """
+        由相邻两天的分组持仓计算各组的换手和交易成本，以及扣除交易成本后的分组净值，组内权重与分组收益的加权方式相同；
+        等权组合的换手只来自分组变化，市值加权等组合的调仓前权重按上一天收益漂移，市值自然变化不计入换手
+        :param commission: 双边佣金费率，float
+        :param stamp_duty: 印花税税率，float，只对卖出收取
+        :param slippage: 双边滑点，float
+        self.turnover_dt: 分组双边换手率，dict，key是self.weight_ls中的加权方式，value是pandas.DataFrame，
+                          index是self.date_ls中的日期，columns是组名+long-short
+        self.cost_dt: 分组交易成本，dict，结构与self.turnover_dt相同
+        self.net_group_value_dt: 扣费分组净值矩阵，dict，结构与self.turnover_dt相同
+        self.net_group_value_df: self.weight_ls中第一个加权方式的扣费分组净值矩阵，与self.group_value_df对应
+        """
+        # T日收益按照T-1日分组，换手发生在分组变化后的下一个交易日，持仓矩阵为(日期数，股票数)
+        group_arr = self.full_group_df.shift(1, axis=1).to_numpy(dtype='float64').T
+        return_arr = None
+        for weight in self.weight_ls:
+            if weight == 'equal':
+                raw_weight_arr = np.ones_like(group_arr)
+                drift_arr = None
+            else:
+                if return_arr is None:
+                    return_arr = self.return_df.reindex(index=self.full_group_df.index, columns=self.date_ls)
+                    return_arr = return_arr.to_numpy(dtype='float64').T
+                drift_arr = return_arr
+                raw_weight_arr = self.weight_dt[weight].reindex(index=self.full_group_df.index, columns=self.date_ls)
+                raw_weight_arr = raw_weight_arr.shift(1, axis=1).to_numpy(dtype='float64').T
+            turnover_dt, cost_dt = {}, {}
+            for group in range(1, self.group + 1):
+                weight_arr = np.where((group_arr == group) & np.isfinite(raw_weight_arr), raw_weight_arr, 0.0)
+                weight_sum = weight_arr.sum(axis=1, keepdims=True)
+                weight_arr = np.divide(weight_arr, weight_sum, out=np.zeros_like(weight_arr), where=weight_sum != 0)
+                buy_arr, sell_arr = cal_turnover_array(weight_arr, drift_arr)
+                turnover_dt[group] = buy_arr + sell_arr
+                cost_dt[group] = cal_trade_cost_array(buy_arr, sell_arr, commission, stamp_duty, slippage)
+            turnover_df = pd.DataFrame(turnover_dt, index=self.date_ls).reindex(self.group_value_dt[weight].index).fillna(0)
+            cost_df = pd.DataFrame(cost_dt, index=self.date_ls).reindex(turnover_df.index).fillna(0)
+            if self.cal_ls_ret:
+                turnover_df.loc[:, 'long-short'] = (turnover_df.loc[:, self.group] + turnover_df.loc[:, 1])*0.5
+                cost_df.loc[:, 'long-short'] = (cost_df.loc[:, self.group] + cost_df.loc[:, 1])*0.5
+            self.turnover_dt[weight] = turnover_df
+            self.cost_dt[weight] = cost_df
+            self.net_group_value_dt[weight] = cal_net_value(self.group_return_dt[weight][cost_df.columns], cost_df)
+        self.net_group_value_df = self.net_group_value_dt[self.weight_ls[0]]
+
+    def cal_performance(self, cost_rate=0.0, window=None):
+        """
+        计算扩展回测指标，换手率与self.group_value_df的加权方式相同，由cal_cost计算
+        :param cost_rate: 单位换手的交易成本，float，用于计算turnover_adj_sharpe
+        :param window: 滚动窗口长度，int，None表示不计算滚动指标
+        self.turnover_df: 分组双边换手率，pandas.DataFrame，index是self.date_ls中的日期，columns是组名+long-short
+        self.performance: 回测指标，pandas.DataFrame，index是组名+long-short，columns是performance_tool.PERFORMANCE_COLUMN_LS
+        self.rolling_performance: 滚动回测指标，dict，key是指标名称，value是pandas.DataFrame，index是日期，columns是组名+long-short
+        """
+        if len(self.turnover_dt) == 0:
+            self.cal_cost()
+        self.turnover_df = self.turnover_dt[self.weight_ls[0]]
+        value_df = self.group_value_df[self.turnover_df.columns]
+        self.performance = cal_performance(value_df, self.turnover_df, cost_rate)
+        if window is not None:
+            self.rolling_performance = cal_rolling_performance(value_df, window, self.turnover_df, cost_rate)
+
     def plot_value(self, factor_name='', picture_name=''):
         """
         画净值图，图片直接保存到本地
@@ -157,54 +326,181 @@ class BackTest(object):
         self.ic_mean: IC均值，float
         self.icir: ICIR值，float
         """
-        price_df = self.price_series.unstack(level=1).loc[:, self.trade_date_ls + [shift_date(self.e_date, self.freq, 'post')]]
+        if len(self.price_df) == 0:
+            self.price_df = self.price_series.unstack(level=1)
+        price_df = self.price_df.loc[:, self.trade_date_ls + [shift_date(self.e_date, self.freq, 'post')]]
         freq_return_df = price_df.pct_change(axis=1)
-        ic_ls = []
-        for i in range(0, self.factor_df.shape[1]):
-            one_df = pd.concat([self.factor_df.iloc[:, i], freq_return_df.iloc[:, i+1]], join='inner', axis=1).dropna()
-            if rank:
-                result = stats.spearmanr(one_df)
-            else:
-                result = stats.pearsonr(one_df)
-            if result[1] > 0.05:
-                ic_ls.append(0)
-            else:
-                ic_ls.append(result[0])
-        self.ic_series = pd.Series(ic_ls, index=self.trade_date_ls)
+        # 第i个换仓日的因子值对应第i个到第i+1个换仓日之间的收益率，所有换仓日的IC一次向量化计算
+        ic_df = cal_ic(self.factor_df.T, freq_return_df.shift(-1, axis=1).T.iloc[:self.factor_df.shape[1]],
+                       rank=rank, sig_level=0.05)
+        self.ic_series = pd.Series(ic_df['ic'].to_numpy(), index=self.trade_date_ls)
         self.ic_mean = self.ic_series.mean()
         self.icir = self.ic_series.mean()/self.ic_series.std()
 
 
-def back_test_from_portfolio(portfolio_df=None, freq='', strategy_name=''):
+class BatchBackTest(object):
+    """
+    多因子批量回测工具类，价格序列、收益率序列和股票池成员矩阵只获取一次，由全部因子共享，
+    每个因子的分组、回测指标和IC计算与BackTest相同
+    :param factor_dt: 原始因子值矩阵，dict，key是因子名称，value是pandas.DataFrame，index是股票代码，columns是换仓日；
+                      也可以是numpy.ndarray，shape是(因子数，股票数，换仓日数)，此时需要指定factor_ls、code_ls、trade_date_ls
+    :param s_date: 回测开始日期，"%Y-%m-%d"
+    :param e_date: 回测结束日期，"%Y-%m-%d"
+    :param freq: 换仓频率，str
+    :param universe: 股票池，str，A/hs300/zz500/zz800
+    :param group: 分组数量，int
+    :param cal_ls_ret: 是否计算long-short收益，bool
+    :param factor_ls: factor_dt为numpy.ndarray时的因子名称列表，list
+    :param code_ls: factor_dt为numpy.ndarray时的股票代码列表，list
+    :param trade_date_ls: factor_dt为numpy.ndarray时的换仓日列表，list
+    :param n_jobs: 进程数，int，1表示在当前进程中逐个因子计算
+    :param weight: 组内加权方式，str，equal/cap/sqrt_cap，市值数据只获取一次，由全部因子共享
+    """
+    def __init__(self, factor_dt=None, s_date='', e_date='', freq='', universe='a_share', group=5, cal_ls_ret=False,
+                 factor_ls=None, code_ls=None, trade_date_ls=None, n_jobs=1, weight='equal'):
+        if isinstance(factor_dt, np.ndarray):
+            factor_dt = {name: pd.DataFrame(factor_dt[i], index=code_ls, columns=trade_date_ls)
+                         for i, name in enumerate(factor_ls)}
+        self.factor_dt = factor_dt
+        self.s_date = s_date
+        self.e_date = e_date
+        self.freq = freq
+        self.universe = universe
+        self.group = group
+        self.cal_ls_ret = cal_ls_ret
+        self.n_jobs = n_jobs
+        self.weight = weight
+        self.template = BackTest(next(iter(factor_dt.values())), s_date, e_date, freq, universe, group, cal_ls_ret,
+                                 weight_ls=[weight])
+        self.universe_mask = None
+        self.group_value_dt = {}
+        self.ic_dt = {}
+        self.indicator = pd.DataFrame()
+
+    def match_price(self):
+        """
+        获取全部因子共享的价格序列、收益率序列，非a_share股票池同时生成全部换仓日的股票池成员矩阵
+        """
+        self.template.match_price()
+        if self.universe != 'a_share':
+            rebalance_ls = sorted(set(date for factor_df in self.factor_dt.values() for date in factor_df.columns)
+                                  & set(self.template.date_ls))
+            self.universe_mask = gen_universe_mask(rebalance_ls, self.universe)
+
+    def run(self, rank=False):
+        """
+        对全部因子进行分组回测，计算回测指标和IC
+        :param rank: 是否计算rankIC，bool
+        self.group_value_dt: 分组净值矩阵，dict，key是因子名称，value是pandas.DataFrame，同BackTest.group_value_df
+        self.ic_dt: 因子IC，dict，key是因子名称，value是pandas.Series，同BackTest.ic_series
+        self.indicator: 回测指标汇总，pandas.DataFrame，index是因子名称，columns是[组名，指标名称]，
+                        IC均值和ICIR在组名IC下
+        """
+        if len(self.template.price_series) == 0:
+            self.match_price()
+        shared = (self.template.price_series, self.template.return_series, self.template.price_df, self.universe_mask,
+                  self.template.return_df, self.template.weight_dt)
+        params = (self.s_date, self.e_date, self.freq, self.universe, self.group, self.cal_ls_ret, rank, self.weight)
+        if self.n_jobs == 1:
+            init_batch_worker(*shared)
+            result_ls = [run_single_factor(factor_df, params) for factor_df in self.factor_dt.values()]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=init_batch_worker, initargs=shared) as executor:
+                result_ls = list(executor.map(run_single_factor, self.factor_dt.values(),
+                                              [params] * len(self.factor_dt)))
+        indicator_dt = {}
+        for name, (indicator_df, group_value_df, ic_series, ic_mean, icir) in zip(self.factor_dt.keys(), result_ls):
+            self.group_value_dt[name] = group_value_df
+            self.ic_dt[name] = ic_series
+            indicator_series = indicator_df.stack()
+            indicator_series.loc[('IC', 'ic_mean')] = ic_mean
+            indicator_series.loc[('IC', 'icir')] = icir
+            indicator_dt[name] = indicator_series
+        self.indicator = pd.DataFrame(indicator_dt).T
+
+
+batch_shared_dt = {}
+
+
+def init_batch_worker(price_series, return_series, price_df, universe_mask, return_df=None, weight_dt=None):
+    """
+    批量回测的进程初始化函数，把共享的价格数据放入进程内的batch_shared_dt，避免每个因子重复传输
+    """
+    batch_shared_dt.update({'price_series': price_series, 'return_series': return_series, 'price_df': price_df,
+                            'universe_mask': universe_mask,
+                            'return_df': pd.DataFrame() if return_df is None else return_df,
+                            'weight_dt': {} if weight_dt is None else weight_dt})
+
+
+def run_single_factor(factor_df, params):
+    """
+    使用batch_shared_dt中的共享数据完成单个因子的分组回测、回测指标和IC计算
+    :param factor_df: 原始因子值矩阵，pandas.DataFrame，index是股票代码，columns是换仓日
+    :param params: (s_date, e_date, freq, universe, group, cal_ls_ret, rank, weight)，tuple
+    :return: (回测指标，分组净值矩阵，IC序列，IC均值，ICIR)，tuple
+    """
+    s_date, e_date, freq, universe, group, cal_ls_ret, rank, weight = params
+    bt = BackTest(factor_df, s_date, e_date, freq, universe, group, cal_ls_ret,
+                  universe_mask=batch_shared_dt['universe_mask'], weight_ls=[weight],
+                  weight_dt=batch_shared_dt['weight_dt'])
+    bt.price_series = batch_shared_dt['price_series']
+    bt.return_series = batch_shared_dt['return_series']
+    bt.price_df = batch_shared_dt['price_df']
+    bt.return_df = batch_shared_dt['return_df']
+    bt.get_group()
+    bt.cal_indicator()
+    bt.cal_icir(rank=rank)
+    return bt.indicator, bt.group_value_df, bt.ic_series, bt.ic_mean, bt.icir
+
+
+def back_test_from_portfolio(portfolio_df=None, freq='', strategy_name='', cost_rate=0.0, commission=0.0003,
+                             stamp_duty=0.001, slippage=0.0):
     """
-    根据具体组合持仓进行回测
-    :param portfolio_df: 持仓权重，pandas.DataFrame，index是日期，columns是股票代码
+    根据具体组合持仓进行回测，调仓日收盘按持仓权重调仓，调仓日之间持仓按收益漂移
+    :param portfolio_df: 持仓权重，pandas.DataFrame，index是调仓日期，columns是股票代码，权重之和小于1的部分为现金
     :param freq: 调仓频率，str，d/w/2w/m代表日频、周频、半月频、月频
     :param strategy_name: 策略名称，str
-    :return: 净值图直接保存到本地，回测指标，dict，key是annual_return、max_drawdown、sharpe_ratio，value是指标值
+    :param cost_rate: 单位换手的交易成本，float，用于计算turnover_adj_sharpe
+    :param commission: 双边佣金费率，float，用于计算扣费净值
+    :param stamp_duty: 印花税税率，float，只对卖出收取
+    :param slippage: 双边滑点，float
+    :return: 毛净值和扣费净值图直接保存到本地，回测指标，dict，key是annual_return、max_drawdown、sharpe_ratio、
+             drawdown_duration、recovery_time、calmar、sortino、turnover_adj_sharpe、turnover、total_cost、
+             net_annual_return、net_max_drawdown、net_sharpe_ratio，value是指标值，turnover是日均双边换手率，
+             total_cost是累计交易成本
     """
     date_ls = gen_trade_date(portfolio_df.index[0], shift_date(portfolio_df.index[-1], freq, direction='post'))
-    full_portfolio_df = pd.DataFrame(index=date_ls, columns=portfolio_df.columns)
-    full_portfolio_df.update(portfolio_df)
-    full_portfolio_df.ffill(axis=0, inplace=True)
-    full_portfolio_df = full_portfolio_df.shift(periods=1)
-    db = db_zcs
-    cursor = db.ts_daily_adj_factor.find({'code': {'$in': portfolio_df.columns.tolist()},
-                                          'date': {'$gte': date_ls[0], '$lte': date_ls[-1]}},
-                                         {'_id': 0, 'date': 1, 'code': 1, 'close': 1, 'adj_factor': 1})
-    price_df = pd.DataFrame(list(cursor)).set_index(['date', 'code'])
-    price_df['post_close'] = price_df['close'] * price_df['adj_factor']
-    return_df = price_df['post_close'].unstack(level=1).pct_change()
-    portfolio_return_series = (full_portfolio_df*return_df).sum(axis=1)
+    # 调仓日的空值表示沿用上一个调仓日的权重，调仓日之间持仓按收益漂移，未分配的仓位为现金
+    target_df = portfolio_df.ffill().reindex(date_ls)
+    return_df = get_post_close(date_ls[0], date_ls[-1], portfolio_df.columns.tolist()).pct_change()
+    return_df = return_df.reindex(index=date_ls, columns=portfolio_df.columns).fillna(0)
+    weight_arr, portfolio_return_arr, buy_arr, sell_arr = simulate_position(
+        target_df.to_numpy(dtype='float64'), return_df.to_numpy(dtype='float64'), np.isin(date_ls, portfolio_df.index),
+        normalize=False)
+    portfolio_return_series = pd.Series(portfolio_return_arr, index=date_ls)
     value_series = (1 + portfolio_return_series).cumprod()
-    annual_return = value_series.iloc[-1] ** (252/len(value_series)) - 1
-    drawdown_series = pd.Series([value_series.loc[date]/value_series.loc[:date].max() - 1 for date in value_series.index], index=value_series.index)
-    max_drawdown = drawdown_series.min() * -1
+    cost_df = pd.DataFrame({'turnover': buy_arr + sell_arr,
+                            'cost': cal_trade_cost_array(buy_arr, sell_arr, commission, stamp_duty, slippage)},
+                           index=date_ls)
+    net_value_series = cal_net_value(portfolio_return_series, cost_df['cost'])
+    performance_df = cal_performance(pd.DataFrame({'gross': value_series, 'net': net_value_series}),
+                                     pd.DataFrame({'gross': cost_df['turnover'], 'net': cost_df['turnover']}), cost_rate)
+    performance = performance_df.loc['gross']
     sharpe_ratio = portfolio_return_series.mean()/portfolio_return_series.std()*(252**0.5)
+    net_return_series = portfolio_return_series - cost_df['cost']
     pd.plotting.register_matplotlib_converters()
     plt.figure()
     plt.title(strategy_name)
     plt.plot(pd.to_datetime(value_series.index, format='%Y-%m-%d'), value_series)
+    plt.plot(pd.to_datetime(net_value_series.index, format='%Y-%m-%d'), net_value_series)
+    plt.legend(labels=['gross', 'net'], loc=2)
     plt.grid()
     plt.savefig('%s.jpg' % strategy_name)
-    return {'annual_return': annual_return, 'max_drawdown': max_drawdown, 'sharpe_ratio': sharpe_ratio}
+    return {'annual_return': performance['annualized_returns'], 'max_drawdown': performance['max_drawdown'],
+            'sharpe_ratio': sharpe_ratio, 'drawdown_duration': performance['drawdown_duration'],
+            'recovery_time': performance['recovery_time'], 'calmar': performance['calmar'],
+            'sortino': performance['sortino'], 'turnover_adj_sharpe': performance['turnover_adj_sharpe'],
+            'turnover': cost_df['turnover'].mean(), 'total_cost': cost_df['cost'].sum(),
+            'net_annual_return': performance_df.loc['net', 'annualized_returns'],
+            'net_max_drawdown': performance_df.loc['net', 'max_drawdown'],
+            'net_sharpe_ratio': net_return_series.mean()/net_return_series.std()*(252**0.5)}
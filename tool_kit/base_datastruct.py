@@ -1,8 +1,8 @@
 
-import statistics
 from copy import copy
 from tool_kit import db_zcs, np, pd, datetime, timedelta
 from tool_kit.date_N_time import util_get_real_date, util_get_closed_month_end
+from tool_kit.price_store_tool import read_store_query, get_price_store, adjust_price_matrix
 from functools import lru_cache
 
 
@@ -15,9 +15,269 @@ ref_ST = db.wind_ST.find({})
 cursor0 = db.ts_stock_basic.find({}, {'_id': 0, 'code': 1})
 basic_codes = [data['code'] for data in cursor0]
 
+STAT_NAME_LS = ['max', 'min', 'mean', 'pvariance', 'variance', 'stdev', 'pstdev', 'mean_harmonic', 'mode', 'amplitude',
+                'skew', 'kurt', 'mad']
 
-class bar_data(object):
-    def __init__(self, code=None, date=None, start=None, end=None, stock_list=None, n=None, coll=db.ts_daily_adj_factor):
+
+def shift_matrix(value_arr, n):
+    """
+    :param value_arr: numpy.ndarray，shape是(日期数，股票数)
+    :param n: 向后移动的行数，int，>=0
+    :return: 移动后的矩阵，numpy.ndarray，shape与value_arr相同，前n行为nan
+    """
+    shift_arr = np.full(value_arr.shape, np.nan)
+    shift_arr[n:] = value_arr[:len(value_arr) - n]
+    return shift_arr
+
+
+def mode_matrix(value_arr):
+    """
+    每一列的众数，与statistics.mode相同，出现次数相同时取最先出现的值
+    :param value_arr: numpy.ndarray，shape是(日期数，股票数)
+    :return: numpy.ndarray，shape是(股票数，)，没有有效值的列为nan
+    """
+    mode_arr = np.full(value_arr.shape[1], np.nan)
+    row_loc, col_loc = np.nonzero(~np.isnan(value_arr))
+    if len(row_loc) == 0:
+        return mode_arr
+    value = value_arr[row_loc, col_loc]
+    order = np.lexsort((row_loc, value, col_loc))
+    row_loc, col_loc, value = row_loc[order], col_loc[order], value[order]
+    # 排序后相同(股票，取值)是连续的一段，每段的第一个元素是该取值最先出现的位置
+    start = np.flatnonzero(np.r_[True, (col_loc[1:] != col_loc[:-1]) | (value[1:] != value[:-1])])
+    length = np.diff(np.r_[start, len(value)])
+    best = np.lexsort((row_loc[start], -length, col_loc[start]))
+    first = best[np.r_[True, col_loc[start][best][1:] != col_loc[start][best][:-1]]]
+    mode_arr[col_loc[start][first]] = value[start][first]
+    return mode_arr
+
+
+def matrix_stat(value_arr, name):
+    """
+    对矩阵的每一列计算统计量，忽略nan，各统计量与pandas和statistics中的同名函数相同
+    :param value_arr: numpy.ndarray，shape是(日期数，股票数)
+    :param name: 统计量名称，str，STAT_NAME_LS中的一个
+    :return: numpy.ndarray，shape是(股票数，)，有效值个数不足的列为nan
+    """
+    if name == 'mode':
+        return mode_matrix(value_arr)
+    count = (~np.isnan(value_arr)).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if name in ['max', 'min', 'amplitude']:
+            max_arr = np.fmax.reduce(value_arr, axis=0)
+            min_arr = np.fmin.reduce(value_arr, axis=0)
+            return {'max': max_arr, 'min': min_arr, 'amplitude': (max_arr - min_arr) / min_arr}[name]
+        if name == 'mean_harmonic':
+            return count / np.nansum(1 / value_arr, axis=0)
+        mean_arr = np.nansum(value_arr, axis=0) / count
+        if name == 'mean':
+            return mean_arr
+        dev_arr = value_arr - mean_arr
+        if name == 'mad':
+            return np.nansum(np.abs(dev_arr), axis=0) / count
+        m2 = np.nansum(dev_arr ** 2, axis=0) / count
+        if name in ['pvariance', 'pstdev']:
+            return m2 if name == 'pvariance' else np.sqrt(m2)
+        if name in ['variance', 'stdev']:
+            var_arr = np.where(count > 1, m2 * count / (count - 1), np.nan)
+            return var_arr if name == 'variance' else np.sqrt(var_arr)
+        # 偏度和峰度是无偏估计，方差为0时为0，与pandas.Series.skew和pandas.Series.kurt相同
+        m2 = np.where(np.abs(m2) < 1e-14, 0, m2)
+        if name == 'skew':
+            m3 = np.nansum(dev_arr ** 3, axis=0) / count
+            result = m3 / m2 ** 1.5 * np.sqrt(count * (count - 1)) / (count - 2)
+            return np.where(count < 3, np.nan, np.where(m2 == 0, 0, result))
+        if name == 'kurt':
+            m4 = np.nansum(dev_arr ** 4, axis=0) / count
+            result = ((count + 1) * (m4 / m2 ** 2 - 3) + 6) * (count - 1) / ((count - 2) * (count - 3))
+            return np.where(count < 4, np.nan, np.where(m2 == 0, 0, result))
+    raise ValueError('%s is not in STAT_NAME_LS' % name)
+
+
+def rolling_matrix_stat(value_arr, name, window, min_periods=None):
+    """
+    对矩阵的每一列按行计算滚动统计量，忽略nan
+    :param value_arr: numpy.ndarray，shape是(日期数，股票数)
+    :param name: 统计量名称，str，STAT_NAME_LS中的一个
+    :param window: 滚动窗口长度，int
+    :param min_periods: 窗口内最少的有效值个数，int，None表示与window相同
+    :return: numpy.ndarray，shape与value_arr相同，有效值个数不足min_periods的位置为nan
+    """
+    min_periods = window if min_periods is None else min_periods
+    value_df = pd.DataFrame(value_arr)
+    count_arr = value_df.rolling(window, min_periods=0).count().to_numpy()
+    roll = value_df.rolling(window, min_periods=min_periods)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if name in ['max', 'min', 'mean', 'skew', 'kurt']:
+            result = getattr(roll, name)().to_numpy()
+            if name in ['skew', 'kurt']:
+                result = np.where(np.abs(roll.var(ddof=0).to_numpy()) < 1e-14, 0, result)
+        elif name in ['pvariance', 'pstdev']:
+            result = roll.var(ddof=0).to_numpy()
+            result = result if name == 'pvariance' else np.sqrt(result)
+        elif name in ['variance', 'stdev']:
+            result = roll.var(ddof=1).to_numpy()
+            result = result if name == 'variance' else np.sqrt(result)
+        elif name == 'amplitude':
+            min_arr = roll.min().to_numpy()
+            result = (roll.max().to_numpy() - min_arr) / min_arr
+        elif name == 'mean_harmonic':
+            result = count_arr / pd.DataFrame(1 / value_arr).rolling(window, min_periods=0).sum().to_numpy()
+        elif name == 'mad':
+            # 窗口内每个位置与窗口均值的绝对偏差逐个累加，循环次数为window
+            mean_arr = roll.mean().to_numpy()
+            result = np.zeros(value_arr.shape)
+            for n in range(window):
+                result += np.nan_to_num(np.abs(shift_matrix(value_arr, n) - mean_arr))
+            result = result / count_arr
+        elif name == 'mode':
+            # 逐个比较窗口内的取值，循环次数为window的平方，从窗口最早的位置开始，出现次数相同时保留最先出现的值
+            shift_ls = [shift_matrix(value_arr, n) for n in range(window - 1, -1, -1)]
+            result = np.full(value_arr.shape, np.nan)
+            best_count = np.zeros(value_arr.shape)
+            for candidate in shift_ls:
+                candidate_count = sum(shift_arr == candidate for shift_arr in shift_ls)
+                update = candidate_count > best_count
+                result[update] = candidate[update]
+                best_count[update] = candidate_count[update]
+        else:
+            raise ValueError('%s is not in STAT_NAME_LS' % name)
+    return np.where(count_arr >= max(min_periods, 1), result, np.nan)
+
+
+class lazy_query(object):
+    """
+    按self.query从数据库读取数据的公共部分。lazy为False时构造实例即获取全部字段；lazy为True时构造实例只记录查询条件，
+    第一次调用字段方法时只获取该字段，之后调用的新字段增量获取并合并到self.data，已获取的字段缓存在实例中，
+    直接访问self.data时补齐全部字段
+    """
+    def init_data(self, coll, lazy=False, use_store=False):
+        """
+        :param coll: 数据库变量
+        :param lazy: 是否按字段延迟获取，bool
+        :param use_store: 是否优先从本地价格库读取，bool，只对ts_daily_adj_factor有效
+        """
+        self.coll_query = coll
+        self.lazy = lazy
+        self.use_store = use_store and getattr(coll, 'name', None) == 'ts_daily_adj_factor'
+        self.fetched_set = set()
+        self.full_loaded = False
+        if not lazy:
+            self.fetch()
+
+    @property
+    def data(self):
+        """
+        :return: 数据查询结果，pandas.DataFrame，index是[日期，股票代码]，columns是字段名称
+        """
+        if not self.full_loaded:
+            self.fetch()
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self.full_loaded = True
+
+    def find_df(self, field_ls=None):
+        """
+        :param field_ls: 投影的字段列表，list，None表示全部字段
+        :return: 查询结果，pandas.DataFrame，index是[日期，股票代码]，columns是字段名称
+        """
+        data_df = None
+        if self.use_store:
+            store = get_price_store()
+            if store is not None and (field_ls is None or set(field_ls) <= set(store.field_dt)):
+                data_df = read_store_query(self.query, field_ls)
+        if data_df is None:
+            if field_ls is None:
+                self.coll = self.coll_query.find(self.query)
+            else:
+                projection = {'_id': 0, 'date': 1, 'code': 1}
+                projection.update({field: 1 for field in field_ls})
+                self.coll = self.coll_query.find(self.query, projection)
+            data_df = pd.DataFrame(item for item in self.coll).set_index(['date', 'code'])
+            if not data_df.index.is_monotonic_increasing:
+                data_df = data_df.sort_index()
+            data_df = data_df.drop(['_id'], axis=1, errors='ignore')
+        return data_df
+
+    def fetch(self, field_ls=None):
+        """
+        获取数据，field_ls为None时获取全部字段，否则只获取field_ls中尚未获取的字段并合并到已有数据中
+        :param field_ls: 字段名称列表，list
+        """
+        if field_ls is None:
+            self._data = self.find_df()
+            self.fetched_set |= set(self._data.columns)
+            self.full_loaded = True
+            return
+        field_ls = [field for field in field_ls if field not in self.fetched_set]
+        if self.full_loaded or len(field_ls) == 0:
+            return
+        self.merge_df(self.find_df(field_ls), field_ls)
+
+    def merge_df(self, data_df, field_ls):
+        """
+        把增量获取的字段合并到已有数据中
+        :param data_df: 增量获取的数据，pandas.DataFrame，index是[日期，股票代码]
+        :param field_ls: 本次获取的字段名称列表，list，查询结果中没有的字段也记为已获取
+        """
+        self.fetched_set |= set(field_ls)
+        if self._data is None:
+            self._data = data_df
+        elif data_df.index.equals(self._data.index):
+            self._data = pd.concat([self._data, data_df.drop(columns=self._data.columns, errors='ignore')], axis=1)
+        else:
+            self._data = self._data.join(data_df.drop(columns=self._data.columns, errors='ignore'), how='outer')
+
+    def has_field(self, name):
+        """
+        :param name: 字段名称，str
+        :return: 查询结果中是否有该字段，bool，延迟获取时会先尝试获取该字段
+        """
+        if not self.full_loaded:
+            self.fetch([name])
+        return self._data is not None and name in self._data.columns
+
+    def first_field(self, name_ls):
+        """
+        :param name_ls: 候选字段名称列表，list，按优先顺序排列
+        :return: 查询结果中第一个存在的字段名称，str，都不存在时为None；延迟获取时尚未获取的候选字段一次获取，
+                 第一个候选字段在本地价格库中时只从本地价格库读取该字段
+        """
+        if not self.full_loaded:
+            field_ls = []
+            for name in name_ls:
+                if name not in self.fetched_set:
+                    field_ls.append(name)
+                elif name in self._data.columns:
+                    break
+            store = get_price_store() if self.use_store and len(field_ls) != 0 else None
+            if store is not None and field_ls[0] in store.field_dt:
+                data_df = read_store_query(self.query, field_ls[:1])
+                if data_df is not None:
+                    self.merge_df(data_df, field_ls[:1])
+                    field_ls = []
+            self.fetch(field_ls)
+        for name in name_ls:
+            if self._data is not None and name in self._data.columns:
+                return name
+        return None
+
+    def field(self, name):
+        """
+        :param name: 字段名称，str
+        :return: 字段值，pandas.Series，index是[日期，股票代码]
+        """
+        if not self.full_loaded:
+            self.fetch([name])
+        return self._data[name]
+
+
+class bar_data(lazy_query):
+    def __init__(self, code=None, date=None, start=None, end=None, stock_list=None, n=None, coll=db.ts_daily_adj_factor,
+                 use_store=False, lazy=False):
         """
         股票行情数据接口
         :param code: 股票代码，str
@@ -27,7 +287,13 @@ class bar_data(object):
         :param stock_list: 股票池，list
         :param n: 交易日数量，int，+为向未来增加，-为向过去增加
         :param coll: 数据库变量，被连接的document为ts_daily_adj_factor
+        :param use_store: 是否优先从本地价格库读取，bool，本地价格库只包含PRICE_FIELD_DT中的字段，不能覆盖查询日期时仍从数据库读取
+        :param lazy: 是否按字段延迟获取，bool，True时构造实例只记录查询条件，close()等字段方法只获取该字段
         """
+        self._data = None
+        self.price_series = None
+        self.price_df = None
+        self.adjusted_dt = {}
         self.code = code
         self.stock_list = stock_list
         if date is not None:
@@ -38,58 +304,54 @@ class bar_data(object):
         self.end = end
         self.n = n
         if self.code is not None and self.date is not None and self.n is None:
-            self.coll = self.coll_bar.find({'date': self.date, 'code': self.code})
+            self.query = {'date': self.date, 'code': self.code}
         elif self.code is not None and self.date is not None and self.n is not None:
             if self.n > 0:
                 try:
-                    self.coll = self.coll_bar.find(
-                        {'date': {'$gte': self.date, '$lt': trade_date_sse[trade_date_sse.index(self.date) + self.n]},
-                         'code': self.code})
+                    self.query = {'date': {'$gte': self.date, '$lt': trade_date_sse[trade_date_sse.index(self.date) + self.n]},
+                                  'code': self.code}
                 except Exception:
-                    self.coll = self.coll_bar.find({'date': {'$gte': self.date}, 'code': self.code})
+                    self.query = {'date': {'$gte': self.date}, 'code': self.code}
             else:
                 try:
-                    self.coll = self.coll_bar.find(
-                        {'date': {'$gt': trade_date_sse[trade_date_sse.index(self.date) + self.n], '$lte': self.date},
-                         'code': self.code})
+                    self.query = {'date': {'$gt': trade_date_sse[trade_date_sse.index(self.date) + self.n], '$lte': self.date},
+                                  'code': self.code}
                 except Exception:
-                    self.coll = self.coll_bar.find({'date': {'$lte': self.date}, 'code': self.code})
+                    self.query = {'date': {'$lte': self.date}, 'code': self.code}
         elif self.start is not None and self.code is not None:
             if self.end is None:
-                self.coll = self.coll_bar.find({'code': self.code, 'date': {'$gte': self.start}})
+                self.query = {'code': self.code, 'date': {'$gte': self.start}}
             else:
-                self.coll = self.coll_bar.find({'code': self.code, 'date': {'$gte': self.start, '$lte': self.end}})
+                self.query = {'code': self.code, 'date': {'$gte': self.start, '$lte': self.end}}
         elif self.stock_list is not None and self.date is not None and self.n is None:
-            self.coll = self.coll_bar.find({'code': {'$in': self.stock_list}, 'date': self.date})
+            self.query = {'code': {'$in': self.stock_list}, 'date': self.date}
         elif self.stock_list is not None and self.date is not None and self.n is not None:
             if self.n > 0:
                 try:
-                    self.coll = self.coll_bar.find({'date': {'$gte': self.date, '$lt': trade_date_sse[
-                        trade_date_sse.index(self.date) + self.n]}, 'code': {'$in': self.stock_list}})
+                    self.query = {'date': {'$gte': self.date, '$lt': trade_date_sse[
+                        trade_date_sse.index(self.date) + self.n]}, 'code': {'$in': self.stock_list}}
                 except Exception:
-                    self.coll = self.coll_bar.find({'date': {'$gte': self.date}, 'code': {'$in': self.stock_list}})
+                    self.query = {'date': {'$gte': self.date}, 'code': {'$in': self.stock_list}}
             else:
                 try:
-                    self.coll = self.coll_bar.find({'date': {
+                    self.query = {'date': {
                         '$gt': trade_date_sse[trade_date_sse.index(self.date) + self.n], '$lte': self.date},
-                        'code': {'$in': self.stock_list}})
+                        'code': {'$in': self.stock_list}}
                 except Exception:
-                    self.coll = self.coll_bar.find({'date': {'$lte': self.date}, 'code': {'$in': self.stock_list}})
+                    self.query = {'date': {'$lte': self.date}, 'code': {'$in': self.stock_list}}
         elif self.stock_list is not None and self.start is not None:
             if self.end is None:
-                self.coll = self.coll_bar.find({'code': {'$in': self.stock_list}, 'date': {'$gte': self.start}})
+                self.query = {'code': {'$in': self.stock_list}, 'date': {'$gte': self.start}}
             else:
-                self.coll = self.coll_bar.find(
-                    {'code': {'$in': self.stock_list}, 'date': {'$gte': self.start, '$lte': self.end}})
+                self.query = {'code': {'$in': self.stock_list}, 'date': {'$gte': self.start, '$lte': self.end}}
         elif self.start is None and self.stock_list is None and self.code is None and self.date is not None:
-            self.coll = self.coll_bar.find({'date': self.date})
+            self.query = {'date': self.date}
         elif self.date is None and self.stock_list is None and self.code is None and self.start is not None:
             if self.end is None:
-                self.coll = self.coll_bar.find({'date': {'$gte': self.start}})
+                self.query = {'date': {'$gte': self.start}}
             else:
-                self.coll = self.coll_bar.find({'date': {'$gte': self.start, '$lte': self.end}})
-        self.data = pd.DataFrame(item for item in self.coll).set_index(['date', 'code']).sort_index()
-        self.data.drop(['_id'], axis=1, inplace=True)
+                self.query = {'date': {'$gte': self.start, '$lte': self.end}}
+        self.init_data(coll, lazy, use_store)
 
     def __call__(self):
         """
@@ -195,7 +457,7 @@ class bar_data(object):
         """
         :return: 开盘价，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.open
+        return self.field('open')
 
     # @property
     # @lru_cache(1024)
@@ -203,7 +465,7 @@ class bar_data(object):
         """
         :return: 最高价，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.high
+        return self.field('high')
 
     HIGH = high
     High = high
@@ -214,7 +476,7 @@ class bar_data(object):
         """
         :return: 最低价，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.low
+        return self.field('low')
 
     LOW = low
     Low = low
@@ -225,7 +487,7 @@ class bar_data(object):
         """
         :return: 收盘价，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.close
+        return self.field('close')
 
     CLOSE = close
     Close = close
@@ -236,14 +498,8 @@ class bar_data(object):
         """
         :return: 成交量，pandas.Series，index是[日期，股票代码]
         """
-        if 'volume' in self.data.columns:
-            return self.data.volume
-        elif 'vol' in self.data.columns:
-            return self.data.vol
-        elif 'trade' in self.data.columns:
-            return self.data.trade
-        else:
-            return None
+        name = self.first_field(['volume', 'vol', 'trade'])
+        return None if name is None else self.field(name)
 
     vol = volume
     VOLUME = vol
@@ -257,10 +513,11 @@ class bar_data(object):
         """
         :return: 成交额，pandas.Series，index是[日期，股票代码]
         """
-        if 'amount' in self.data.columns:
-            return self.data.amount
+        name = self.first_field(['amount', 'volume', 'vol', 'trade'])
+        if name == 'amount':
+            return self.field('amount')
         else:
-            return self.vol * self.price * 100
+            return self.vol() * self.price() * 100
 
     amt = amount
     AMT = amount
@@ -269,21 +526,78 @@ class bar_data(object):
     # # @lru_cache()
     def price(self):
         """
-        :return: 均价，pandas.Series，index是[日期，股票代码]
+        :return: 均价，pandas.Series，index是[日期，股票代码]，第一次计算后缓存在实例中
         """
-        return (self.open + self.high + self.low + self.close) / 4
+        if self.price_series is None:
+            if not self.full_loaded:
+                self.fetch(['open', 'high', 'low', 'close'])
+            self.price_series = (self.open() + self.high() + self.low() + self.close()) / 4
+        return self.price_series
 
     PRICE = price
     Price = price
 
+    def price_matrix(self):
+        """
+        :return: 均价矩阵，pandas.DataFrame，index是日期，columns是股票代码，查询结果中没有的[日期，股票代码]为nan，
+                 第一次计算后缓存在实例中
+        """
+        if self.price_df is None:
+            index = self.price().index.remove_unused_levels()
+            date_loc, code_loc = index.codes
+            price_arr = np.full((len(index.levels[0]), len(index.levels[1])), np.nan)
+            price_arr[date_loc, code_loc] = self.price().to_numpy(dtype='float64')
+            self.price_df = pd.DataFrame(price_arr, index=index.levels[0], columns=index.levels[1])
+        return self.price_df
+
+    def price_stat(self, name, window=None, min_periods=None):
+        """
+        按股票代码计算均价的统计量，在均价矩阵上对所有股票同时计算
+        :param name: 统计量名称，str，STAT_NAME_LS中的一个
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: window为None时是统计量，pandas.Series，index是股票代码；否则是滚动统计量，pandas.Series，index是[日期，股票代码]
+        """
+        price_df = self.price_matrix()
+        if window is None:
+            return pd.Series(matrix_stat(price_df.to_numpy(), name), index=price_df.columns)
+        index = self.price().index.remove_unused_levels()
+        date_loc, code_loc = index.codes
+        stat_arr = rolling_matrix_stat(price_df.to_numpy(), name, window, min_periods)
+        return pd.Series(stat_arr[date_loc, code_loc], index=self.price().index)
+
+    def price_shift(self, periods=1, pad=False):
+        """
+        :param periods: 间隔的记录数量，int，>0，按每只股票自己的查询结果计数
+        :param pad: 是否先用同一股票之前的均价填充nan，bool
+        :return: (均价，同一股票periods条记录之前的均价)，tuple，元素是numpy.ndarray，与price()的顺序相同
+        """
+        index = self.price().index.remove_unused_levels()
+        date_loc, code_loc = index.codes
+        order = np.lexsort((date_loc, code_loc))
+        sorted_code = code_loc[order]
+        sorted_price = self.price().to_numpy(dtype='float64')[order]
+        if pad:
+            # 排序后同一股票是连续的一段，取段内最近的有效值
+            start = np.flatnonzero(np.r_[True, sorted_code[1:] != sorted_code[:-1]])
+            start_loc = np.repeat(start, np.diff(np.r_[start, len(order)]))
+            valid_loc = np.maximum.accumulate(np.where(np.isnan(sorted_price), -1, np.arange(len(order))))
+            sorted_price = np.where(valid_loc >= start_loc, sorted_price[valid_loc], np.nan)
+        price_arr = np.empty(len(order))
+        price_arr[order] = sorted_price
+        pre_arr = np.full(len(order), np.nan)
+        same_code = sorted_code[periods:] == sorted_code[:len(order) - periods]
+        pre_arr[order[periods:][same_code]] = sorted_price[:len(order) - periods][same_code]
+        return price_arr, pre_arr
+
     # @property
     # # @lru_cache()
     def trade(self):
         """
         :return: 期货中，pandas.Series，index是[日期，股票代码]
         """
-        if 'trade' in self.data.columns:
-            return self.data.trade
+        if self.has_field('trade'):
+            return self.field('trade')
         else:
             return None
 
@@ -296,8 +610,8 @@ class bar_data(object):
         """
         :return: 持仓，pandas.Series，index是[日期，股票代码]
         """
-        if 'position' in self.data.columns:
-            return self.data.position
+        if self.has_field('position'):
+            return self.field('position')
         else:
             return None
 
@@ -310,7 +624,7 @@ class bar_data(object):
         """
         :return: 复权因子，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.adj_factor
+        return self.field('adj_factor')
 
     # 交易日期
 #     # @property
@@ -321,33 +635,39 @@ class bar_data(object):
     # Date = date
     # @property
     # # @lru_cache()
-    def max(self):
+    def max(self, window=None, min_periods=None):
         """
-        :return: 最高均价，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 最高均价，pandas.Series，index是股票代码；window不为None时是滚动最高均价，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: x.max())
+        return self.price_stat('max', window, min_periods)
 
     MAX = max
     Max = max
 
     # @property
     # # @lru_cache()
-    def min(self):
+    def min(self, window=None, min_periods=None):
         """
-        :return: 最低均价，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 最低均价，pandas.Series，index是股票代码；window不为None时是滚动最低均价，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: x.min())
+        return self.price_stat('min', window, min_periods)
 
     MIN = min
     Min = min
 
     # @property
     # # @lru_cache()
-    def mean(self):
+    def mean(self, window=None, min_periods=None):
         """
-        :return: 平均均价，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 平均均价，pandas.Series，index是股票代码；window不为None时是滚动平均均价，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: x.mean())
+        return self.price_stat('mean', window, min_periods)
 
     MEAN = mean
     Mean = mean
@@ -355,32 +675,38 @@ class bar_data(object):
     # 一阶差分序列
     # @property
     # # @lru_cache()
-    def diff(self):
+    def diff(self, periods=1):
         """
+        :param periods: 间隔的记录数量，int，按每只股票自己的查询结果计数
         :return: 均价变化量，pandas.Series，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: x.diff(1))
+        price_arr, pre_arr = self.price_shift(periods)
+        return pd.Series(price_arr - pre_arr, index=self.price().index)
 
     DIFF = diff
 
     # @property
     # # @lru_cache()
-    def pvariance(self):
+    def pvariance(self, window=None, min_periods=None):
         """
-        :return: 均价总体方差，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价总体方差，pandas.Series，index是股票代码；window不为None时是滚动均价总体方差，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: statistics.pvariance(x))
+        return self.price_stat('pvariance', window, min_periods)
 
     PVARIANCE = pvariance
     Pvariance = pvariance
 
     # @property
     # # @lru_cache()
-    def variance(self):
+    def variance(self, window=None, min_periods=None):
         """
-        :return: 均价样本方差，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价样本方差，pandas.Series，index是股票代码；window不为None时是滚动均价样本方差，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: statistics.variance(x))
+        return self.price_stat('variance', window, min_periods)
 
     VARIANCE = variance
     Variance = variance
@@ -409,47 +735,53 @@ class bar_data(object):
 
     # @property
     # # @lru_cache()
-    def stdev(self):
+    def stdev(self, window=None, min_periods=None):
         """
-        :return: 均价的样本标准差，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的样本标准差，pandas.Series，index是股票代码；window不为None时是滚动均价的样本标准差，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: statistics.stdev(x))
+        return self.price_stat('stdev', window, min_periods)
 
     STDEV = stdev
     Stdev = stdev
 
     # @property
     # # @lru_cache()
-    def pstdev(self):
+    def pstdev(self, window=None, min_periods=None):
         """
-        :return: 均价的总体标准差，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的总体标准差，pandas.Series，index是股票代码；window不为None时是滚动均价的总体标准差，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: statistics.pstdev(x))
+        return self.price_stat('pstdev', window, min_periods)
 
     PSTDEV = pstdev
     Pstdev = pstdev
 
     # @property
     # # @lru_cache()
-    def mean_harmonic(self):
+    def mean_harmonic(self, window=None, min_periods=None):
         """
-        :return: 均价的调和平均数，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的调和平均数，pandas.Series，index是股票代码；window不为None时是滚动均价的调和平均数，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: statistics.harmonic_mean(x))
+        return self.price_stat('mean_harmonic', window, min_periods)
 
     MEAN_HARMONIC = mean_harmonic
     Mean_harmonic = mean_harmonic
 
     # @property
     # # @lru_cache()
-    def mode(self):
+    def mode(self, window=None, min_periods=None):
         """
-        :return: 均价的众数，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的众数，pandas.Series，index是股票代码；window不为None时是滚动众数，index是[日期，股票代码]，
+                 滚动众数的计算量与window的平方成正比
         """
-        try:
-            return self.price.groupby(level=1).apply(lambda x: statistics.mode(x))
-        except:
-            return None
+        return self.price_stat('mode', window, min_periods)
 
     MODE = mode
     Mode = mode
@@ -457,11 +789,13 @@ class bar_data(object):
     # 振幅
     # @property
     # # @lru_cache()
-    def amplitude(self):
+    def amplitude(self, window=None, min_periods=None):
         """
-        :return: 均价在时间区间内的振幅，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价在时间区间内的振幅，pandas.Series，index是股票代码；window不为None时是滚动均价在时间区间内的振幅，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: (x.max() - x.min()) / x.min())
+        return self.price_stat('amplitude', window, min_periods)
 
     AMPLITUDE = amplitude
     Amplitude = amplitude
@@ -469,11 +803,13 @@ class bar_data(object):
     # 偏度 Skewness
     # @property
     # # @lru_cache()
-    def skew(self):
+    def skew(self, window=None, min_periods=None):
         """
-        :return: 均价的偏度，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的偏度，pandas.Series，index是股票代码；window不为None时是滚动均价的偏度，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: x.skew())
+        return self.price_stat('skew', window, min_periods)
 
     SKEW = skew
     Skew = skew
@@ -481,12 +817,13 @@ class bar_data(object):
     # 峰度Kurtosis
     # @property
     # # @lru_cache()
-    def kurt(self):
+    def kurt(self, window=None, min_periods=None):
         """
-        :return: 均价的峰度，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的峰度，pandas.Series，index是股票代码；window不为None时是滚动均价的峰度，index是[日期，股票代码]
         """
-        '返回DataStruct.price的峰度'
-        return self.price.groupby(level=1).apply(lambda x: x.kurt())
+        return self.price_stat('kurt', window, min_periods)
 
     Kurt = kurt
     KURT = kurt
@@ -494,11 +831,13 @@ class bar_data(object):
     # 百分数变化
     # @property
     # # @lru_cache()
-    def pct_change(self):
+    def pct_change(self, periods=1):
         """
-        :return: 均价的百分比变化，pandas.Series，index是[日期，股票代码]
+        :param periods: 间隔的记录数量，int，按每只股票自己的查询结果计数
+        :return: 均价的百分比变化，pandas.Series，index是[日期，股票代码]，nan先用同一股票之前的均价填充
         """
-        return self.price.groupby(level=1).apply(lambda x: x.pct_change())
+        price_arr, pre_arr = self.price_shift(periods, pad=True)
+        return pd.Series(price_arr / pre_arr - 1, index=self.price().index)
 
     PCT_CHANGE = pct_change
     Pct_change = pct_change
@@ -506,11 +845,13 @@ class bar_data(object):
     # 平均绝对偏差
     # @property
     # # @lru_cache()
-    def mad(self):
+    def mad(self, window=None, min_periods=None):
         """
-        :return: 均价的平均绝对偏差，pandas.Series，index是股票代码
+        :param window: 滚动窗口长度，int，按查询结果中的日期计数，None表示整个查询区间
+        :param min_periods: 滚动窗口内最少的有效值个数，int，None表示与window相同
+        :return: 均价的平均绝对偏差，pandas.Series，index是股票代码；window不为None时是滚动均价的平均绝对偏差，index是[日期，股票代码]
         """
-        return self.price.groupby(level=1).apply(lambda x: x.mad())
+        return self.price_stat('mad', window, min_periods)
 
     MAD = mad
     Mad = mad
@@ -580,39 +921,52 @@ class bar_data(object):
     LEN = len
     Len = len
 
+    def adjust(self, series, df=None, base=None):
+        """
+        复权价格，在[日期×股票代码]矩阵上按股票代码对齐后一次计算
+        :param series: 价格序列，pandas.Series，index是[日期，股票代码]
+        :param df: 传入含有复权因子数据的序列，pandas.DataFrame，index是[日期，股票代码]，columns是字段名，None表示使用实例的复权因子
+        :param base: 复权基期，str，见price_store_tool.adjust_price_matrix
+        :return: 复权价格，pandas.Series，index与series相同
+        """
+        adj_factor = self.adj_factor() if df is None else df['adj_factor']
+        adj_price_df = adjust_price_matrix(series.unstack(), adj_factor.unstack(), base)
+        return adj_price_df.stack(dropna=False).reindex(series.index).rename(series.name)
+
     def qfq(self, series, df=None):
         """
         定点复权
         :param series: 价格序列，pandas.Series，index是[日期，股票代码]
         :param df: 传入含有复权因子数据的序列，pandas.DataFrame，index是[日期，股票代码]，columns是字段名
-        :return: 以第一个交易日为复权基期计算的定点复权价格，pandas.Series，index是[日期，股票代码]
+        :return: 以第一个交易日为复权基期计算的定点复权价格，pandas.Series，index是[日期，股票代码]，
+                 第一个交易日没有数据的股票以该股票第一个有复权因子的日期为基期
         """
-        if df is None:
-            dd = self.adj_factor * series
-            for date in self.data.index.levels[0]:
-                dd.loc[date, :] = dd.loc[date, :] / self.adj_factor.loc[self.data.index.levels[0][0], :].tolist()
-        else:
-            dd = df.adj_factor * series
-            for date in df.index.levels[0]:
-                dd.loc[date, :] = dd.loc[date, :] / df.adj_factor.loc[df.index.levels[0][0], :].tolist()
-        return dd
+        return self.adjust(series, df, 'first')
 
     def hfq(self, series, df=None):
         """
         前复权
         :param series: 价格序列，pandas.Series，index是[日期，股票代码]
         :param df: 传入含有复权因子数据的序列，pandas.DataFrame，index是[日期，股票代码]，columns是字段名
-        :return: 前复权价格，pandas.Series，index是[日期，股票代码]
+        :return: 前复权价格，pandas.Series，index是[日期，股票代码]，最后一个交易日没有数据的股票以该股票最后一个有复权因子的日期为基期
         """
-        if df is None:
-            dd = self.adj_factor * series
-            for date in self.data.index.levels[0]:
-                dd.loc[date, :] = dd.loc[date, :] / self.adj_factor.loc[self.data.index.levels[0][-1], :].tolist()
-        else:
-            dd = df.adj_factor * series
-            for date in df.index.levels[0]:
-                dd.loc[date, :] = dd.loc[date, :] / df.adj_factor.loc[df.index.levels[0][-1], :].tolist()
-        return dd
+        return self.adjust(series, df, 'last')
+
+    def adjusted_price(self, base=None, field_ls=('open', 'high', 'low', 'close')):
+        """
+        复权后的行情，第一次计算后按base缓存在实例中，之后只补算缓存中没有的字段
+        :param base: 复权基期，str，None表示后复权，first同qfq，last同hfq
+        :param field_ls: 价格字段列表，list
+        :return: 复权价格，pandas.DataFrame，index是[日期，股票代码]，columns是field_ls
+        """
+        adjusted_df = self.adjusted_dt.get(base, pd.DataFrame(index=self.adj_factor().index))
+        adj_factor_df = self.adj_factor().unstack()
+        for field in field_ls:
+            if field not in adjusted_df.columns:
+                adj_price_df = adjust_price_matrix(self.field(field).unstack(), adj_factor_df, base)
+                adjusted_df[field] = adj_price_df.stack(dropna=False).reindex(adjusted_df.index)
+        self.adjusted_dt[base] = adjusted_df
+        return adjusted_df[list(field_ls)]
 
     def get_dict(self, time, code):
         """
@@ -882,8 +1236,9 @@ class bar_data(object):
         return self.bar_pct_change[self.bar_pct_change > pct].sort_index()
 
 
-class financial_data(object):
-    def __init__(self, code=None, date=None, start=None, end=None, stock_list=None, n=None, coll=db.wind_financial_2014):
+class financial_data(lazy_query):
+    def __init__(self, code=None, date=None, start=None, end=None, stock_list=None, n=None, coll=db.wind_financial_2014,
+                 lazy=False):
         """
         基本面数据接口
         :param code: 股票代码，str
@@ -893,7 +1248,9 @@ class financial_data(object):
         :param stock_list: 股票池，list
         :param n: 交易日数量，int，+为向未来增加，-为向过去增加
         :param coll: 数据库变量，被连接的document为wind_financial_2014
+        :param lazy: 是否按字段延迟获取，bool，True时构造实例只记录查询条件，pe_ttm()等字段方法只获取该字段
         """
+        self._data = None
         self.code = code
         self.stock_list = stock_list
         if date is not None:
@@ -912,58 +1269,54 @@ class financial_data(object):
         self.end = end
         self.n = n
         if self.code is not None and self.date is not None and self.n is None:
-            self.coll = self.coll_fin.find({'date': self.date, 'code': self.code})
+            self.query = {'date': self.date, 'code': self.code}
         elif self.code is not None and self.date is not None and self.n is not None:
             if self.n > 0:
                 try:
-                    self.coll = self.coll_fin.find(
-                        {'date': {'$gte': self.date, '$lt': trade_date_sse[trade_date_sse.index(self.date) + self.n]},
-                         'code': self.code})
+                    self.query = {'date': {'$gte': self.date, '$lt': trade_date_sse[trade_date_sse.index(self.date) + self.n]},
+                                  'code': self.code}
                 except Exception:
-                    self.coll = self.coll_fin.find({'date': {'$gte': self.date}, 'code': self.code})
+                    self.query = {'date': {'$gte': self.date}, 'code': self.code}
             else:
                 try:
-                    self.coll = self.coll_fin.find(
-                        {'date': {'$gt': trade_date_sse[trade_date_sse.index(self.date) + self.n], '$lte': self.date},
-                         'code': self.code})
+                    self.query = {'date': {'$gt': trade_date_sse[trade_date_sse.index(self.date) + self.n], '$lte': self.date},
+                                  'code': self.code}
                 except Exception:
-                    self.coll = self.coll_fin.find({'date': {'$lte': self.date}, 'code': self.code})
+                    self.query = {'date': {'$lte': self.date}, 'code': self.code}
         elif self.start is not None and self.code is not None:
             if self.end is None:
-                self.coll = self.coll_fin.find({'code': self.code, 'date': {'$gte': self.start}})
+                self.query = {'code': self.code, 'date': {'$gte': self.start}}
             else:
-                self.coll = self.coll_fin.find({'code': self.code, 'date': {'$gte': self.start, '$lte': self.end}})
+                self.query = {'code': self.code, 'date': {'$gte': self.start, '$lte': self.end}}
         elif self.stock_list is not None and self.date is not None and self.n is None:
-            self.coll = self.coll_fin.find({'code': {'$in': self.stock_list}, 'date': self.date})
+            self.query = {'code': {'$in': self.stock_list}, 'date': self.date}
         elif self.stock_list is not None and self.date is not None and self.n is not None:
             if self.n > 0:
                 try:
-                    self.coll = self.coll_fin.find({'date': {'$gte': self.date, '$lt': trade_date_sse[
-                        trade_date_sse.index(self.date) + self.n]}, 'code': {'$in': self.stock_list}})
+                    self.query = {'date': {'$gte': self.date, '$lt': trade_date_sse[
+                        trade_date_sse.index(self.date) + self.n]}, 'code': {'$in': self.stock_list}}
                 except Exception:
-                    self.coll = self.coll_fin.find({'date': {'$gte': self.date}, 'code': {'$in': self.stock_list}})
+                    self.query = {'date': {'$gte': self.date}, 'code': {'$in': self.stock_list}}
             else:
                 try:
-                    self.coll = self.coll_fin.find({'date': {
+                    self.query = {'date': {
                         '$gt': trade_date_sse[trade_date_sse.index(self.date) + self.n], '$lte': self.date},
-                        'code': {'$in': self.stock_list}})
+                        'code': {'$in': self.stock_list}}
                 except Exception:
-                    self.coll = self.coll_fin.find({'date': {'$lte': self.date}, 'code': {'$in': self.stock_list}})
+                    self.query = {'date': {'$lte': self.date}, 'code': {'$in': self.stock_list}}
         elif self.stock_list is not None and self.start is not None:
             if self.end is None:
-                self.coll = self.coll_fin.find({'code': {'$in': self.stock_list}, 'date': {'$gte': self.start}})
+                self.query = {'code': {'$in': self.stock_list}, 'date': {'$gte': self.start}}
             else:
-                self.coll = self.coll_fin.find(
-                    {'code': {'$in': self.stock_list}, 'date': {'$gte': self.start, '$lte': self.end}})
+                self.query = {'code': {'$in': self.stock_list}, 'date': {'$gte': self.start, '$lte': self.end}}
         elif self.start is None and self.stock_list is None and self.code is None and self.date is not None:
-            self.coll = self.coll_fin.find({'date': self.date})
+            self.query = {'date': self.date}
         elif self.date is None and self.stock_list is None and self.code is None and self.start is not None:
             if self.end is None:
-                self.coll = self.coll_fin.find({'date': {'$gte': self.start}})
+                self.query = {'date': {'$gte': self.start}}
             else:
-                self.coll = self.coll_fin.find({'date': {'$gte': self.start, '$lte': self.end}})
-        self.data = pd.DataFrame(item for item in self.coll).set_index(['date', 'code']).sort_index()
-        self.data.drop(['_id'], axis=1, inplace=True)
+                self.query = {'date': {'$gte': self.start, '$lte': self.end}}
+        self.init_data(coll, lazy)
 
     def __call__(self):
         """
@@ -1071,7 +1424,7 @@ class financial_data(object):
         """
         :return: 市净率倒数，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.bp
+        return self.field('bp')
 
     BP = bp
     Bp = bp
@@ -1082,7 +1435,7 @@ class financial_data(object):
         """
         :return: 扣非净利润TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.deductedprofit_ttm
+        return self.field('deductedprofit_ttm')
 
     DEDUCTEDPROFIT_TTM = deductedprofit_ttm
     Deductedprofit_ttm = deductedprofit_ttm
@@ -1094,7 +1447,7 @@ class financial_data(object):
         """
         :return: 市盈率倒数，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.ep
+        return self.field('ep')
 
     EP = ep
     Ep = ep
@@ -1105,7 +1458,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.epcut
+        return self.field('epcut')
 
     EPcut = epcut
 
@@ -1115,7 +1468,7 @@ class financial_data(object):
         """
         :return: 毛利润TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.grossmargin_ttm
+        return self.field('grossmargin_ttm')
 
     GROSSMARGIN_TTM = grossmargin_ttm
     Grossmargin_ttm = grossmargin_ttm
@@ -1127,7 +1480,7 @@ class financial_data(object):
         """
         :return: 总市值，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.mkt_cap_ard
+        return self.field('mkt_cap_ard')
 
     MKT_CAP_ARD = mkt_cap_ard
     Mkt_cap_ard = mkt_cap_ard
@@ -1138,7 +1491,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.ncfp
+        return self.field('ncfp')
 
     NCFP = ncfp
     Ncfp = ncfp
@@ -1149,7 +1502,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.ocfp
+        return self.field('ocfp')
 
     OCFP = ocfp
     Ocfp = ocfp
@@ -1168,7 +1521,7 @@ class financial_data(object):
         """
         :return: 自由流通股本，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.free_float_shares
+        return self.field('free_float_shares')
 
     FREE_FLOAT_SHARES = free_float_shares
 
@@ -1178,7 +1531,7 @@ class financial_data(object):
         """
         :return: 总股本，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.total_share
+        return self.field('total_share')
 
     TOTAL_SHARE = total_share
 
@@ -1188,7 +1541,7 @@ class financial_data(object):
         """
         :return: 营业收入TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.or_ttm
+        return self.field('or_ttm')
 
     OR_TTM = or_ttm
     Or_ttm = or_ttm
@@ -1200,7 +1553,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.pb_lf
+        return self.field('pb_lf')
 
     PB_LF = pb_lf
     Pb_lf = pb_lf
@@ -1211,7 +1564,7 @@ class financial_data(object):
         """
         :return: 市现率PCF(现金净流量)，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.pcf_ncf_ttm
+        return self.field('pcf_ncf_ttm')
 
     PCF_NCF_TTM = pcf_ncf_ttm
     Pcf_ncf_ttm = pcf_ncf_ttm
@@ -1223,7 +1576,7 @@ class financial_data(object):
         """
         :return: 市现率PCF(经营现金流)，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.pcf_ocf_ttm
+        return self.field('pcf_ocf_ttm')
 
     PCF_OCF_TTM = pcf_ocf_ttm
     Pcf_ocf_ttm = pcf_ocf_ttm
@@ -1235,7 +1588,7 @@ class financial_data(object):
         """
         :return: 市盈率TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.pe_ttm
+        return self.field('pe_ttm')
 
     PE_TTM = pe_ttm
     PE_ttm = pe_ttm
@@ -1247,7 +1600,7 @@ class financial_data(object):
         """
         :return: 净利润TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.profit_ttm
+        return self.field('profit_ttm')
 
     PROFIT_TTM = profit_ttm
     PROFIT_ttm = profit_ttm
@@ -1259,7 +1612,7 @@ class financial_data(object):
         """
         :return: 资产收益率TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.roa_ttm2
+        return self.field('roa_ttm2')
 
     ROA_TTM = roa_ttm2
     ROA_ttm = roa_ttm2
@@ -1271,7 +1624,7 @@ class financial_data(object):
         """
         :return: 净资产收益率TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.roe_ttm2
+        return self.field('roe_ttm2')
 
     ROE_TTM = roe_ttm2
     ROE_ttm = roe_ttm2
@@ -1283,7 +1636,7 @@ class financial_data(object):
         """
         :return: 优先股，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.share_ntrd_prfshare
+        return self.field('share_ntrd_prfshare')
 
     SHARE_NTRD_PRFSHARE = share_ntrd_prfshare
     Share_ntrd_prfshare = share_ntrd_prfshare
@@ -1294,7 +1647,7 @@ class financial_data(object):
         """
         :return: 市销率倒数，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.sp
+        return self.field('sp')
 
     SP = sp
     Sp = sp
@@ -1305,7 +1658,7 @@ class financial_data(object):
         """
         :return: 综合评级（数值），pandas.Series，index是[日期，股票代码]
         """
-        return self.data.wrating_avg_data
+        return self.field('wrating_avg_data')
 
     WRATING_AVG_DATA = wrating_avg_data
     Wrating_avg_data = wrating_avg_data
@@ -1316,7 +1669,7 @@ class financial_data(object):
         """
         :return: 评级低调家数，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.wrating_downgrade
+        return self.field('wrating_downgrade')
 
     WRATING_DOWNGRADE = wrating_downgrade
     Wrating_downgrade = wrating_downgrade
@@ -1327,7 +1680,7 @@ class financial_data(object):
         """
         :return: 一致预测目标价，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.wrating_targetprice
+        return self.field('wrating_targetprice')
 
     WRATING_TARGETPRICE = wrating_targetprice
     Wrating_targetprice = wrating_targetprice
@@ -1338,7 +1691,7 @@ class financial_data(object):
         """
         :return: 评级低调家数，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.wrating_upgrade
+        return self.field('wrating_upgrade')
 
     WRATING_UPGRADE = wrating_upgrade
     Wrating_upgrade = wrating_upgrade
@@ -1349,7 +1702,7 @@ class financial_data(object):
         """
         :return: 过去12个月涨跌幅，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['12m_high/low']
+        return self.field('12m_high/low')
 
     HIGH_TO_LOW_12M = high_to_low_12m
     HIGH_TO_LOW_12m = high_to_low_12m
@@ -1362,7 +1715,7 @@ class financial_data(object):
         """
         :return: 过去1个月涨跌幅，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['1m_high/low']
+        return self.field('1m_high/low')
 
     HIGH_TO_LOW_1M = high_to_low_1m
     HIGH_TO_LOW_1m = high_to_low_1m
@@ -1375,7 +1728,7 @@ class financial_data(object):
         """
         :return: 过去2个月涨跌幅，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['2m_high/low']
+        return self.field('2m_high/low')
 
     HIGH_TO_LOW_2M = high_to_low_2m
     HIGH_TO_LOW_2m = high_to_low_2m
@@ -1388,7 +1741,7 @@ class financial_data(object):
         """
         :return: 过去3个月涨跌幅，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['3m_high/low']
+        return self.field('3m_high/low')
 
     HIGH_TO_LOW_3M = high_to_low_3m
     HIGH_TO_LOW_3m = high_to_low_3m
@@ -1401,7 +1754,7 @@ class financial_data(object):
         """
         :return: 过去6个月涨跌幅，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['6m_high/low']
+        return self.field('6m_high/low')
 
     HIGH_TO_LOW_6M = high_to_low_6m
     HIGH_TO_LOW_6m = high_to_low_6m
@@ -1414,7 +1767,7 @@ class financial_data(object):
         """
         :return: 日动量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.d_return
+        return self.field('d_return')
 
     RETURN_D = return_d
     RETURN_d = return_d
@@ -1427,7 +1780,7 @@ class financial_data(object):
         """
         :return: 年动量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['12m_return']
+        return self.field('12m_return')
 
     RETURN_12M = return_12m
     RETURN_12m = return_12m
@@ -1440,7 +1793,7 @@ class financial_data(object):
         """
         :return: 月动量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['1m_return']
+        return self.field('1m_return')
 
     RETURN_1M = return_1m
     RETURN_1m = return_1m
@@ -1453,7 +1806,7 @@ class financial_data(object):
         """
         :return: 2个月动量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['2m_return']
+        return self.field('2m_return')
 
     RETURN_2M = return_2m
     RETURN_2m = return_2m
@@ -1466,7 +1819,7 @@ class financial_data(object):
         """
         :return: 3个月动量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['3m_return']
+        return self.field('3m_return')
 
     RETURN_3M = return_3m
     RETURN_3m = return_3m
@@ -1479,7 +1832,7 @@ class financial_data(object):
         """
         :return: 6个月动量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['6m_return']
+        return self.field('6m_return')
 
     RETURN_6M = return_6m
     RETURN_6m = return_6m
@@ -1492,7 +1845,7 @@ class financial_data(object):
         """
         :return: 年波动，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['12m_std']
+        return self.field('12m_std')
 
     STD_12M = std_12m
     std_12M = std_12m
@@ -1505,7 +1858,7 @@ class financial_data(object):
         """
         :return: 月波动，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['1m_std']
+        return self.field('1m_std')
 
     STD_1M = std_1m
     std_1M = std_1m
@@ -1518,7 +1871,7 @@ class financial_data(object):
         """
         :return: 2个月波动，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['2m_std']
+        return self.field('2m_std')
 
     STD_2M = std_2m
     std_2M = std_2m
@@ -1531,7 +1884,7 @@ class financial_data(object):
         """
         :return: 3个月波动，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['3m_std']
+        return self.field('3m_std')
 
     STD_3M = std_3m
     std_3M = std_3m
@@ -1544,7 +1897,7 @@ class financial_data(object):
         """
         :return: 6个月波动，pandas.Series，index是[日期，股票代码]
         """
-        return self.data['6m_std']
+        return self.field('6m_std')
 
     STD_6M = std_6m
     std_6M = std_6m
@@ -1557,7 +1910,7 @@ class financial_data(object):
         """
         :return: 总资产周转率，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.assetsturn1
+        return self.field('assetsturn1')
 
     ASSETSTURN1 = assetsturn1
     Assetsturn1 = assetsturn1
@@ -1571,7 +1924,7 @@ class financial_data(object):
         """
         :return: 现金比率，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.cashtocurrentdebt
+        return self.field('cashtocurrentdebt')
 
     CASHTOCURRENTDEBT = cashtocurrentdebt
     Cashtocurrentdebt = cashtocurrentdebt
@@ -1582,7 +1935,7 @@ class financial_data(object):
         """
         :return: 流动比率，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.current
+        return self.field('current')
 
     CURRENT = current
     Current = current
@@ -1593,7 +1946,7 @@ class financial_data(object):
         """
         :return: 负债权益比，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.debtequityratio
+        return self.field('debtequityratio')
 
     DEBTEQUITYRATIO = debtequityratio
     Debtequityratio = debtequityratio
@@ -1604,7 +1957,7 @@ class financial_data(object):
         """
         :return: 负债合计，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.debt_mrq
+        return self.field('debt_mrq')
 
     DEBT_mrq = debt_mrq
     DEBT_MRQ = debt_mrq
@@ -1616,7 +1969,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.deductedprofit_g_yoy
+        return self.field('deductedprofit_g_yoy')
 
     DEDUCTEDPROFIT_G_YOY = deductedprofit_g_yoy
     Deductedprofit_g_yoy = deductedprofit_g_yoy
@@ -1627,7 +1980,7 @@ class financial_data(object):
         """
         :return: 每股股利税前，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.div_cashbeforetax2
+        return self.field('div_cashbeforetax2')
 
     DIV_CASHBEFORETAX2 = div_cashbeforetax2
     Div_cashbeforetax2 = div_cashbeforetax2
@@ -1640,7 +1993,7 @@ class financial_data(object):
         """
         :return: 扣非净利润增长率ttm，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.deductedprofit_ttm_growth
+        return self.field('deductedprofit_ttm_growth')
 
     DEDUCTEDPROFIT_TTM_GROWTH = deductedprofit_ttm_growth
     Deductedprofit_ttm_growth = deductedprofit_ttm_growth
@@ -1651,7 +2004,7 @@ class financial_data(object):
         """
         :return: 企业自由现金流量，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.fcff
+        return self.field('fcff')
 
     FCFF = fcff
     Fcff = fcff
@@ -1662,7 +2015,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.fcfp
+        return self.field('fcfp')
 
     FCFP = fcfp
     Fcfp = fcfp
@@ -1673,7 +2026,7 @@ class financial_data(object):
         """
         :return: 财务杠杆，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.financial_leverage
+        return self.field('financial_leverage')
 
     FINANCIAL_LEVERAGE = financial_leverage
     Financial_leverage = financial_leverage
@@ -1700,7 +2053,7 @@ class financial_data(object):
         """
         :return: 销售利润增长率（单季度），pandas.Series，index是[日期，股票代码]
         """
-        return self.data.gross_profit_rate_qfa
+        return self.field('gross_profit_rate_qfa')
 
     GROSS_RATE_QFA = gross_rate_qfa
     Gross_rate_qfa = gross_rate_qfa
@@ -1711,7 +2064,7 @@ class financial_data(object):
         """
         :return: 销售利润增长率TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.gross_profit_rate_ttm
+        return self.field('gross_profit_rate_ttm')
 
     GROSS_RATE_TTM = gross_rate_ttm
     GROSS_RATE_ttm = gross_rate_ttm
@@ -1722,7 +2075,7 @@ class financial_data(object):
         """
         :return: 营业收入增长率，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.growth_or
+        return self.field('growth_or')
 
     GROWTH_OR = growth_or
     GROWTH_or = growth_or
@@ -1733,7 +2086,7 @@ class financial_data(object):
         """
         :return: 户均持股比例，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.holder_avgpct
+        return self.field('holder_avgpct')
 
     HOLDER_AVGPCT = holder_avgpct
 
@@ -1743,7 +2096,7 @@ class financial_data(object):
         """
         :return: 户均持股比例半年增长率，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.holder_havgpctchange
+        return self.field('holder_havgpctchange')
 
     HOLDER_HAVGPCTCHANGE = holder_havgpctchange
 
@@ -1760,7 +2113,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.kf_pr_rate_qfa
+        return self.field('kf_pr_rate_qfa')
 
     KF_PR_RATE_QFA = kf_pr_rate_qfa
 
@@ -1770,7 +2123,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.kf_pr_rate_ttm
+        return self.field('kf_pr_rate_ttm')
 
     KF_PR_RATE_TTM = kf_pr_rate_ttm
     KF_PR_RATE_ttm = kf_pr_rate_ttm
@@ -1781,7 +2134,7 @@ class financial_data(object):
         """
         :return: 长期负债占比，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.longdebttodebt
+        return self.field('longdebttodebt')
 
     LONGDEBTODEBT = longdebttodebt
 
@@ -1791,7 +2144,7 @@ class financial_data(object):
         """
         :return: 市场杠杆，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.marketvalue_leverage
+        return self.field('marketvalue_leverage')
 
     MARKETVALUE_LEVERAGE = marketvalue_leverage
 
@@ -1801,7 +2154,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.ocftosales
+        return self.field('ocftosales')
 
     OCFTOSALES = ocftosales
 
@@ -1811,7 +2164,7 @@ class financial_data(object):
         """
         :return: 营业收入增长率TTM，pandas.Series，index是[日期，股票代码]
         """
-        return self.data.or_growth_ttm
+        return self.field('or_growth_ttm')
 
     OR_GROWTH_TTM = or_growth_ttm
 
@@ -1821,7 +2174,7 @@ class financial_data(object):
         """
         :return: 扣非净利润（单季度），pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_deductedprofit
+        return self.field('qfa_deductedprofit')
 
     QFA_DEDUCTEDPROFIT = qfa_deductedprofit
 
@@ -1831,7 +2184,7 @@ class financial_data(object):
         """
         :return: 毛利润（单季度），pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_grossmargin
+        return self.field('qfa_grossmargin')
 
     QFA_GROSSMARGIN = qfa_grossmargin
 
@@ -1841,7 +2194,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_net_profit_is
+        return self.field('qfa_net_profit_is')
 
     QFA_NET_PROFIT_IS = qfa_net_profit_is
 
@@ -1851,7 +2204,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_net_profit_is_g
+        return self.field('qfa_net_profit_is_g')
 
     QFA_NET_PROFIT_IS_G = qfa_net_profit_is_g
 
@@ -1861,7 +2214,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_oper_rev
+        return self.field('qfa_oper_rev')
 
     QFA_OPER_REV = qfa_oper_rev
 
@@ -1871,7 +2224,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_roa
+        return self.field('qfa_roa')
 
     QFA_ROA = qfa_roa
 
@@ -1881,7 +2234,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_roe
+        return self.field('qfa_roe')
 
     QFA_ROE = qfa_roe
 
@@ -1891,7 +2244,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_stot_cash_inflows_oper_act
+        return self.field('qfa_stot_cash_inflows_oper_act')
 
     QFA_STOT_CASH_INFLOWS_OPER_ACT = qfa_stot_cash_inflows_oper_act
 
@@ -1901,7 +2254,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_stot_cash_inflows_oper_act_g
+        return self.field('qfa_stot_cash_inflows_oper_act_g')
 
     QFA_STOT_CASH_INFLOWS_OPER_ACT_G = qfa_stot_cash_inflows_oper_act_g
 
@@ -1911,7 +2264,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.qfa_yoysales
+        return self.field('qfa_yoysales')
 
     QFA_YOYSALES = qfa_yoysales
 
@@ -1921,7 +2274,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.stm_issuingdate
+        return self.field('stm_issuingdate')
 
     STM_ISSUINGDATE = stm_issuingdate
 
@@ -1931,7 +2284,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.stot_cash_inflows_oper_act
+        return self.field('stot_cash_inflows_oper_act')
 
     STOT_CASH_INFLOWS_OPER_ACT = stot_cash_inflows_oper_act
 
@@ -1948,7 +2301,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.turnover_ttm
+        return self.field('turnover_ttm')
 
     TURNOVER_TTM = turnover_ttm
 
@@ -2009,7 +2362,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.wgsd_assets
+        return self.field('wgsd_assets')
 
     WGSD_ASSETS = wgsd_assets
 
@@ -2019,7 +2372,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.wgsd_com_eq_paholder
+        return self.field('wgsd_com_eq_paholder')
 
     WGSD_COM_EQ_PAHOLDER = wgsd_com_eq_paholder
 
@@ -2029,7 +2382,7 @@ class financial_data(object):
         """
         :return: pandas.Series，index是[日期，股票代码]
         """
-        return self.data.yoyocf
+        return self.field('yoyocf')
 
     YOYOCF = yoyocf
 
@@ -2289,6 +2642,79 @@ class financial_data(object):
 # DATE = trade[trade['m_last_trade_day'] == 1].index.tolist()
 
 
+@lru_cache(maxsize=None)
+def load_wind_st():
+    """
+    读取wind_ST，只读取一次，所有block_data共用
+    :return: ST记录，pandas.DataFrame，空值为None
+    """
+    df = pd.DataFrame(item for item in db.wind_ST.find({}, {'_id': 0}))
+    return df.where(df.notnull(), None)
+
+
+@lru_cache(maxsize=None)
+def load_delisted_stock():
+    """
+    读取已退市股票，只读取一次，所有block_data共用
+    :return: 已退市股票，pandas.DataFrame，index是股票代码，columns是字段名
+    """
+    df = pd.DataFrame(item for item in db.ts_stock_basic.find({}, {'_id': 0}))
+    return df[df['list_status'] == 'D'].set_index('code')
+
+
+class BlockSnapshot(object):
+    """
+    单个日期的板块数据和指数成分表，成分表是与股票代码数组对齐的bool数组，退市日期也按股票代码对齐成数组，
+    成分股查询只做数组运算；self.data被同一日期的所有block_data共用，不应原地修改
+    :param date: 日期，str，"%Y-%m-%d"，一般为月末交易日
+    :param coll: 数据库变量，被连接的document为wind_block_2014
+    """
+    def __init__(self, date, coll=db.wind_block_2014):
+        self.date = date
+        self.data = pd.DataFrame(item for item in coll.find({'date': date})).set_index(['date', 'code']).sort_index()
+        self.data = self.data[~self.data.index.duplicated()]
+        self.data.drop(['_id'], axis=1, inplace=True)
+        self.codes = self.data.index.get_level_values('code').to_numpy(dtype=object)
+        self.member_dt = {}
+        self.weight_dt = {}
+        for col in self.data.columns:
+            if col.endswith('w') and col[:-1].isdigit():
+                self.weight_dt[col[:-1]] = self.data[col].to_numpy(dtype='float64')
+            elif col.isdigit():
+                self.member_dt[col] = (self.data[col] == 1).to_numpy()
+        delist_date = load_delisted_stock()['delist_date']
+        delist_date = delist_date[delist_date.notna()]
+        self.delist_date = delist_date.reindex(self.codes).fillna('').to_numpy(dtype=str)
+
+    def members(self, index_code, date):
+        """
+        :param index_code: 指数代码，str，如000300
+        :param date: 查询日期，str，"%Y-%m-%d"，在该日期之前（含当日）已退市的股票被剔除
+        :return: 成分股，list，按股票代码排序
+        """
+        delisted = (self.delist_date != '') & (self.delist_date <= date)
+        return self.codes[self.member_dt[index_code] & ~delisted].tolist()
+
+
+@lru_cache(maxsize=64)
+def get_block_snapshot(date):
+    """
+    按日期缓存wind_block_2014的板块数据，最多保留64个日期，最久未使用的日期先被淘汰
+    :param date: 日期，str，"%Y-%m-%d"，一般为月末交易日
+    :return: 板块数据，BlockSnapshot
+    """
+    return BlockSnapshot(date)
+
+
+def clear_block_cache():
+    """
+    清空wind_ST、已退市股票和板块数据的缓存，用于数据库更新之后
+    """
+    load_wind_st.cache_clear()
+    load_delisted_stock.cache_clear()
+    get_block_snapshot.cache_clear()
+
+
 class block_data():
     def __init__(self, code=None, date=None, coll=db.wind_block_2014):
         """
@@ -2296,10 +2722,7 @@ class block_data():
         :param date: 日期，str，"%Y-%m-%d"
         :param coll: 数据库变量，被连接的document为wind_block_2014
         """
-        ref_ST = db.wind_ST.find({}, {'_id': 0})
-        df = pd.DataFrame(item for item in ref_ST)
-        df = df.where(df.notnull(), None)
-        self.st = df
+        self.st = load_wind_st()
         self.DATE = date  # 原始日期
         if date is None:
             self.date = date
@@ -2307,6 +2730,12 @@ class block_data():
             self.date = util_get_closed_month_end(date)  # 上一月最后一个交易日
         self.code = code
         self.coll_block = coll
+        self.snapshot = None
+        if self.code is None and self.date is not None and coll is db.wind_block_2014:
+            # 按日期查询全部股票时使用缓存的板块数据
+            self.snapshot = get_block_snapshot(self.date)
+            self.data = self.snapshot.data
+            return
         if self.code is None and self.date is not None:
             self.coll = self.coll_block.find({'date': self.date})
         elif self.date is None and self.code is not None:
@@ -2409,10 +2838,18 @@ class block_data():
         """
         :return: 已退市股票，pandas.DataFrame，index是股票代码，columns是字段名
         """
-        ref_D = db.ts_stock_basic.find({}, {'_id': 0})
-        df = pd.DataFrame(item for item in ref_D)
-        dfD = df[df['list_status'] == 'D'].set_index('code')
-        return dfD
+        return load_delisted_stock()
+
+    def index_member(self, index_code):
+        """
+        :param index_code: 指数代码，str，如000300
+        :return: 剔除已退市股票后的指数成分股，list
+        """
+        if self.snapshot is not None:
+            return self.snapshot.members(index_code, self.DATE)
+        delist_date = self.D['delist_date']
+        da = self.data[self.data[index_code] == 1].reset_index(level=1).drop_duplicates(subset=['code']).code.to_list()
+        return [code for code in da if code not in delist_date.index or self.DATE < delist_date[code]]
 
     def del_tuishi(self, da):
         """
@@ -2442,16 +2879,7 @@ class block_data():
         """
         :return: 非ST上证50成分股，list
         """
-        d_list = self.D.index.tolist()
-        da = self.data[self.data['000016'] == 1].reset_index(level=1).drop_duplicates(subset=['code']).code.to_list()
-        r_da = []
-        for code in da:
-            if code not in d_list:
-                r_da.append(code)
-            else:
-                if self.DATE < self.D.at[code, 'delist_date']:
-                    r_da.append(code)
-        return r_da
+        return self.index_member('000016')
 
     SZ50 = sz50
 
@@ -2495,16 +2923,7 @@ class block_data():
         """
         :return: 非ST沪深300成分股，list
         """
-        d_list = self.D.index.tolist()
-        da = self.data[self.data['000300'] == 1].reset_index(level=1).drop_duplicates(subset=['code']).code.to_list()
-        r_da = []
-        for code in da:
-            if code not in d_list:
-                r_da.append(code)
-            else:
-                if self.DATE < self.D.at[code, 'delist_date']:
-                    r_da.append(code)
-        return r_da
+        return self.index_member('000300')
 
     hs300 = HS300
 
@@ -2525,16 +2944,7 @@ class block_data():
         """
         :return: 非ST中证500成分股，list
         """
-        d_list = self.D.index.tolist()
-        da = self.data[self.data['000905'] == 1].reset_index(level=1).drop_duplicates(subset=['code']).code.to_list()
-        r_da = []
-        for code in da:
-            if code not in d_list:
-                r_da.append(code)
-            else:
-                if self.DATE < self.D.at[code, 'delist_date']:
-                    r_da.append(code)
-        return r_da
+        return self.index_member('000905')
 
     ZZ500 = zz500
 
@@ -2555,16 +2965,7 @@ class block_data():
         """
         :return: 非ST中证800成分股，list
         """
-        d_list = self.D.index.tolist()
-        da = self.data[self.data['000906'] == 1].reset_index(level=1).drop_duplicates(subset=['code']).code.to_list()
-        r_da = []
-        for code in da:
-            if code not in d_list:
-                r_da.append(code)
-            else:
-                if self.DATE < self.D.at[code, 'delist_date']:
-                    r_da.append(code)
-        return r_da
+        return self.index_member('000906')
 
     ZZ800 = zz800
 
@@ -2574,16 +2975,7 @@ class block_data():
         """
         :return: 非ST中证1000成分股，list
         """
-        d_list = self.D.index.tolist()
-        da = self.data[self.data['000852'] == 1].reset_index(level=1).drop_duplicates(subset=['code']).code.to_list()
-        r_da = []
-        for code in da:
-            if code not in d_list:
-                r_da.append(code)
-            else:
-                if self.DATE < self.D.at[code, 'delist_date']:
-                    r_da.append(code)
-        return r_da
+        return self.index_member('000852')
 
     ZZ1000 = zz1000
 
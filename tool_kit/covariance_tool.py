@@ -0,0 +1,202 @@
+from tool_kit import pd, np
+from tool_kit.ewma_tool import ewma_weight
+
+
+def newey_west(moment_arr, weight_sum_arr, lag=2):
+    """
+    Newey-West调整，用Bartlett权重把各阶滞后的协方差加到当期协方差上
+    :param moment_arr: 各阶滞后的加权交叉矩，numpy.ndarray，shape是(lag+1，因子数，因子数)或(lag+1，股票数)，
+                       第k个元素是Σ w·x(t)·x(t-k)
+    :param weight_sum_arr: 各阶滞后的权重和，numpy.ndarray，shape是(lag+1,)或(lag+1，股票数)
+    :param lag: 滞后阶数，int
+    :return: 调整后的协方差，numpy.ndarray，shape与moment_arr[0]相同，权重和为0的位置为nan
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight_sum_arr = np.where(weight_sum_arr > 0, weight_sum_arr, np.nan)
+        if moment_arr.ndim == 3:
+            cov_arr = moment_arr[0] / weight_sum_arr[0]
+            for k in range(1, lag + 1):
+                if np.isfinite(weight_sum_arr[k]):
+                    lag_cov = moment_arr[k] / weight_sum_arr[k]
+                    cov_arr = cov_arr + (1 - k / (lag + 1)) * (lag_cov + lag_cov.T)
+            return cov_arr
+        var_arr = moment_arr[0] / weight_sum_arr[0]
+        nw_arr = var_arr.copy()
+        for k in range(1, lag + 1):
+            nw_arr = nw_arr + np.nan_to_num(2 * (1 - k / (lag + 1)) * moment_arr[k] / weight_sum_arr[k])
+        # 自相关为负导致调整后方差不为正时，保留调整前的方差
+        return np.where(nw_arr > 0, nw_arr, var_arr)
+
+
+def eigen_adjust(cov_arr, weight_arr, n_sim=100, scale=1.2, seed=0, normal_arr=None):
+    """
+    特征因子调整，按协方差矩阵模拟因子收益率，用模拟样本估计特征因子方差的偏差并放大被低估的特征值
+    :param cov_arr: 因子协方差矩阵，numpy.ndarray，shape是(因子数，因子数)
+    :param weight_arr: 模拟样本估计协方差时使用的时间权重，numpy.ndarray，shape是(模拟期数,)，和为1
+    :param n_sim: 模拟次数，int
+    :param scale: 偏差的放大系数，float
+    :param seed: 随机数种子，int
+    :param normal_arr: 预先生成的标准正态随机数，numpy.ndarray，shape是(模拟次数，模拟期数，因子数)，
+                       None时按n_sim和seed生成；逐日调用时传入同一组随机数可以省去每天的抽样
+    :return: 调整后的因子协方差矩阵，numpy.ndarray，shape与cov_arr相同
+    """
+    eig_value, eig_vector = np.linalg.eigh(cov_arr)
+    eig_value = np.clip(eig_value, 0, None)
+    if normal_arr is None:
+        normal_arr = np.random.default_rng(seed).standard_normal((n_sim, len(weight_arr), len(eig_value)))
+    # 模拟的特征因子收益率乘以时间权重的平方根，协方差即为批量的X'X，再做特征分解
+    sim_arr = normal_arr * np.sqrt(eig_value) * np.sqrt(weight_arr)[:, None]
+    sim_value, sim_vector = np.linalg.eigh(np.swapaxes(sim_arr, 1, 2) @ sim_arr)
+    # 模拟特征因子的真实方差：sim_vector'·D·sim_vector的对角线
+    true_value = (sim_vector ** 2 * eig_value[:, None]).sum(axis=1)
+    # 方差为0的特征因子模拟方差也为0，比值无效，只对有效的模拟次数取平均，全部无效时不调整
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = true_value / sim_value
+    valid = np.isfinite(ratio)
+    n_valid = valid.sum(axis=0)
+    bias = np.sqrt(np.where(valid, ratio, 0.0).sum(axis=0) / np.maximum(n_valid, 1))
+    gamma = np.where(n_valid > 0, scale * (bias - 1) + 1, 1.0)
+    return (eig_vector * (gamma ** 2 * eig_value)) @ eig_vector.T
+
+
+class RiskModel(object):
+    """
+    因子协方差矩阵和特异性方差的逐日增量估计，时间权重来自ewma_tool.ewma_weight，窗口内的加权交叉矩每天由前一天的状态
+    衰减一次、加入当天的收益率、减去移出窗口的收益率得到，不重新计算整个窗口；日频收益率的均值视为0
+    :param factor_half_life: 因子协方差的半衰期，int
+    :param specific_half_life: 特异性方差的半衰期，int
+    :param window: 估计窗口长度，int，交易日数量
+    :param nw_lag: Newey-West调整的滞后阶数，int，0表示不做调整
+    :param adjust_eigen: 是否做特征因子调整，bool
+    :param n_sim: 特征因子调整的模拟次数，int
+    :param eigen_scale: 特征因子调整的偏差放大系数，float
+    :param horizon: 预测期长度，int，协方差和方差乘以horizon
+    :param min_periods: 输出结果需要的最少观测数量，int，特异性方差按股票计数
+    :param seed: 特征因子调整的随机数种子，int
+    """
+    def __init__(self, factor_half_life=90, specific_half_life=90, window=252, nw_lag=2, adjust_eigen=True,
+                 n_sim=100, eigen_scale=1.2, horizon=1, min_periods=20, seed=0):
+        self.window = window
+        self.nw_lag = nw_lag
+        self.adjust_eigen = adjust_eigen
+        self.n_sim = n_sim
+        self.eigen_scale = eigen_scale
+        self.horizon = horizon
+        self.min_periods = min_periods
+        self.seed = seed
+        self.factor_weight_arr = ewma_weight(window, factor_half_life)
+        self.specific_weight_arr = ewma_weight(window, specific_half_life)
+        self.factor_decay = self.factor_weight_arr[0] / self.factor_weight_arr[1] if window > 1 else 1.0
+        self.specific_decay = self.specific_weight_arr[0] / self.specific_weight_arr[1] if window > 1 else 1.0
+        self.factor_ls = []
+        self.factor_buffer = []
+        self.factor_moment = None
+        self.factor_weight_sum = np.zeros(nw_lag + 1)
+        self.code_index = pd.Index([])
+        self.specific_buffer = []
+        self.specific_moment = np.zeros((nw_lag + 1, 0))
+        self.specific_weight_sum = np.zeros((nw_lag + 1, 0))
+        self.specific_count = np.zeros(0)
+        self.normal_arr = None
+        self.date_ls = []
+        self.factor_cov_dt = {}
+        self.specific_var_dt = {}
+
+    def update_moment(self, moment, weight_sum, buffer, decay, product):
+        """
+        窗口内加权交叉矩的一步递推：衰减前一天的状态，加入当天与各阶滞后的乘积，减去移出窗口的观测
+        :param moment: 各阶滞后的加权交叉矩，numpy.ndarray，原地更新
+        :param weight_sum: 各阶滞后的权重和，numpy.ndarray，原地更新
+        :param buffer: 最近window+nw_lag天的观测，list，最后一个元素是当天的观测，元素是(取值，是否有效)
+        :param decay: 每天的衰减系数，float
+        :param product: 两个观测的乘积函数，返回(乘积，权重)
+        """
+        drop_weight = decay ** self.window
+        moment *= decay
+        weight_sum *= decay
+        for k in range(self.nw_lag + 1):
+            if len(buffer) > k:
+                value, weight = product(buffer[-1], buffer[-1 - k])
+                moment[k] += value
+                weight_sum[k] += weight
+            if len(buffer) > self.window + k:
+                value, weight = product(buffer[-1 - self.window], buffer[-1 - self.window - k])
+                moment[k] -= drop_weight * value
+                weight_sum[k] -= drop_weight * weight
+
+    def update(self, date, factor_return_series, specific_return_series=None):
+        """
+        加入一天的因子收益率和特异性收益率，更新状态并计算当天的因子协方差矩阵和特异性方差
+        :param date: 日期，str，"%Y-%m-%d"，需要按时间顺序逐日调用
+        :param factor_return_series: 因子收益率，pandas.Series，index是因子名称，第一次调用时确定因子列表，
+                                     之后新出现的因子被忽略，缺失的因子收益率视为0
+        :param specific_return_series: 特异性收益率，pandas.Series，index是股票代码，None表示只更新因子协方差
+        :return: (因子协方差矩阵，特异性方差)，tuple，pandas.DataFrame，index和columns是因子名称；
+                 pandas.Series，index是当天有特异性收益率的股票代码；观测数量不足min_periods时为nan
+        """
+        if len(self.factor_ls) == 0:
+            self.factor_ls = factor_return_series.index.tolist()
+            self.factor_moment = np.zeros((self.nw_lag + 1, len(self.factor_ls), len(self.factor_ls)))
+        factor_arr = np.nan_to_num(factor_return_series.reindex(self.factor_ls).to_numpy(dtype='float64'))
+        self.factor_buffer = (self.factor_buffer + [factor_arr])[-(self.window + self.nw_lag + 1):]
+        self.update_moment(self.factor_moment, self.factor_weight_sum, self.factor_buffer, self.factor_decay,
+                           lambda x, y: (np.outer(x, y), 1.0))
+        self.date_ls.append(date)
+        factor_cov = newey_west(self.factor_moment, self.factor_weight_sum, self.nw_lag)
+        if len(self.date_ls) < self.min_periods:
+            factor_cov = np.full(factor_cov.shape, np.nan)
+        elif self.adjust_eigen:
+            if self.normal_arr is None:
+                self.normal_arr = np.random.default_rng(self.seed).standard_normal(
+                    (self.n_sim, self.window, len(self.factor_ls)))
+            factor_cov = eigen_adjust(factor_cov, self.factor_weight_arr, scale=self.eigen_scale,
+                                      normal_arr=self.normal_arr)
+        factor_cov_df = pd.DataFrame(factor_cov * self.horizon, index=self.factor_ls, columns=self.factor_ls)
+        self.factor_cov_dt[date] = factor_cov_df
+        if specific_return_series is None:
+            return factor_cov_df, None
+
+        new_code = specific_return_series.index.difference(self.code_index)
+        if len(new_code) != 0:
+            self.code_index = self.code_index.append(new_code)
+            pad = np.zeros((self.nw_lag + 1, len(new_code)))
+            self.specific_moment = np.hstack([self.specific_moment, pad])
+            self.specific_weight_sum = np.hstack([self.specific_weight_sum, pad])
+            self.specific_count = np.concatenate([self.specific_count, np.zeros(len(new_code))])
+        self.specific_buffer = (self.specific_buffer + [specific_return_series])[-(self.window + self.nw_lag + 1):]
+
+        def product(x, y):
+            # 两天的特异性收益率按股票代码对齐后逐股票相乘，只有两天都有收益率的股票计入权重
+            x_arr = x.reindex(self.code_index).to_numpy(dtype='float64')
+            y_arr = y.reindex(self.code_index).to_numpy(dtype='float64')
+            valid = np.isfinite(x_arr) & np.isfinite(y_arr)
+            return np.where(valid, x_arr * y_arr, 0.0), valid.astype('float64')
+
+        self.update_moment(self.specific_moment, self.specific_weight_sum, self.specific_buffer, self.specific_decay,
+                           product)
+        self.specific_count += np.isfinite(specific_return_series.reindex(self.code_index).to_numpy(dtype='float64'))
+        if len(self.specific_buffer) > self.window:
+            self.specific_count -= np.isfinite(
+                self.specific_buffer[-1 - self.window].reindex(self.code_index).to_numpy(dtype='float64'))
+        specific_var = newey_west(self.specific_moment, self.specific_weight_sum, self.nw_lag)
+        specific_var = np.where(self.specific_count >= self.min_periods, specific_var, np.nan)
+        specific_var_series = pd.Series(specific_var * self.horizon, index=self.code_index, name=date).reindex(
+            specific_return_series.index)
+        self.specific_var_dt[date] = specific_var_series
+        return factor_cov_df, specific_var_series
+
+    def run(self, factor_return_df, specific_return_series=None):
+        """
+        按时间顺序逐日更新
+        :param factor_return_df: 因子收益率，pandas.DataFrame，index是日期，columns是因子名称，
+                                 与FactorPanelCal.factor_return_df相同
+        :param specific_return_series: 特异性收益率，pandas.Series，index是[date, code]，
+                                       与FactorPanelCal.specific_return_series相同，None表示只估计因子协方差
+        :return: (因子协方差矩阵，特异性方差)，tuple，dict，key是日期，value同update的返回值
+        """
+        specific_dt = {} if specific_return_series is None else \
+            {date: series.droplevel(0) for date, series in specific_return_series.groupby(level=0)}
+        for date in factor_return_df.index:
+            self.update(date, factor_return_df.loc[date],
+                        None if specific_return_series is None else specific_dt.get(date, pd.Series(dtype='float64')))
+        return self.factor_cov_dt, self.specific_var_dt
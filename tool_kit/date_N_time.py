@@ -1,6 +1,107 @@
-
 import re
-from tool_kit import db_zcs, pd, datetime, timedelta
+from tool_kit import db_zcs, pd, np, datetime, timedelta
+
+
+class TradeCalendar(object):
+    """
+    内存交易日历，首次使用时从wind_trade_day一次性读取全部交易日及d/w/m/q_last_trade_day标记，
+    之后的日期查询全部基于排序后的numpy数组做二分查找和下标偏移，不再访问数据库
+    :param coll: 数据库变量，被连接的document为wind_trade_day
+    """
+    def __init__(self, coll=None):
+        self.coll = coll
+        self.dates = None
+        self.flag_dt = {}
+        self.freq_dates_dt = {}
+
+    def load(self):
+        """
+        读取交易日历
+        self.dates: 全部交易日，numpy.ndarray，升序
+        self.flag_dt: 窗口期结束标记，dict，key是频率，如d/w/m/q，value是与self.dates等长的bool数组
+        """
+        coll = db_zcs.wind_trade_day if self.coll is None else self.coll
+        records = list(coll.find({}, {'_id': 0}))
+        df = pd.DataFrame(records).drop_duplicates(subset=['date']).sort_values('date')
+        self.dates = df['date'].to_numpy(dtype=str)
+        self.flag_dt = {}
+        for col in df.columns:
+            if col.endswith('_last_trade_day'):
+                self.flag_dt[col[:-len('_last_trade_day')]] = (df[col].fillna(0).to_numpy() == 1)
+        self.freq_dates_dt = {}
+        return self
+
+    def reload(self):
+        """
+        重新读取交易日历，用于数据库更新了新的交易日之后
+        """
+        return self.load()
+
+    def get_dates(self, freq='d'):
+        """
+        :param freq: 日期频率，str，'d'是全部交易日，其余如'w'、'm'、'q'是对应窗口期的最后一个交易日
+        :return: 该频率下的交易日，numpy.ndarray，升序
+        """
+        if self.dates is None:
+            self.load()
+        if freq == 'd':
+            return self.dates
+        if freq not in self.freq_dates_dt:
+            flag = self.flag_dt.get(freq)
+            self.freq_dates_dt[freq] = self.dates[flag] if flag is not None else self.dates[:0]
+        return self.freq_dates_dt[freq]
+
+    def is_flagged(self, date, freq):
+        """
+        :param date: 指定日期，str，"%Y-%m-%d"
+        :param freq: 窗口期类型，str，d/w/m/q
+        :return: 该日期的窗口期结束标记，bool；若该日期不是交易日则抛出IndexError
+        """
+        dates = self.get_dates('d')
+        loc = np.searchsorted(dates, date, side='left')
+        if loc == len(dates) or dates[loc] != date:
+            raise IndexError('%s is not a trade date' % date)
+        flag = self.flag_dt.get(freq)
+        if flag is None:
+            raise KeyError('%s_last_trade_day' % freq)
+        return bool(flag[loc])
+
+    def contains(self, date):
+        """
+        :param date: 指定日期，str，"%Y-%m-%d"
+        :return: 是否为交易日，bool
+        """
+        dates = self.get_dates('d')
+        loc = np.searchsorted(dates, date, side='left')
+        return bool(loc < len(dates) and dates[loc] == date)
+
+    def between(self, s_date='', e_date='', freq='d'):
+        """
+        :return: s_date<=date<=e_date的交易日，list
+        """
+        dates = self.get_dates(freq)
+        left = np.searchsorted(dates, s_date, side='left')
+        right = np.searchsorted(dates, e_date, side='right')
+        return dates[left:right].tolist()
+
+    def before(self, date, n, freq='d', inclusive=True):
+        """
+        :return: date之前（inclusive为True时包含date）最近的n个交易日，list，升序
+        """
+        dates = self.get_dates(freq)
+        right = np.searchsorted(dates, date, side='right' if inclusive else 'left')
+        return dates[max(right - n, 0):right].tolist()
+
+    def after(self, date, n, freq='d', inclusive=True):
+        """
+        :return: date之后（inclusive为True时包含date）最近的n个交易日，list，升序
+        """
+        dates = self.get_dates(freq)
+        left = np.searchsorted(dates, date, side='left' if inclusive else 'right')
+        return dates[left:left + n].tolist()
+
+
+trade_calendar = TradeCalendar()
 
 
 def gen_trade_date(s_date='', e_date='', days=0, freq='d'):
@@ -12,30 +113,12 @@ def gen_trade_date(s_date='', e_date='', days=0, freq='d'):
     :param freq: 日期频率，str，'d'是日频，'w'是周频，'m'是月频
     :return: 交易日列表，list
     """
-    database = db_zcs
-
-    if days == 0:#追溯天数为0
-        if freq == 'd':
-            # s_data<=trade_date <=e_date ,只取data这一列。
-            trade_date = database.wind_trade_day.find({'date': {'$gte': s_date, '$lte': e_date}}, {'_id': 0, 'date': 1})
-        else:#s_data<=trade_date <=e_date and 月或周的_last_trade_day ==1
-            trade_date = database.wind_trade_day.find({'date': {'$gte': s_date, '$lte': e_date}, '%s_last_trade_day' % freq: 1},
-                                                      {'_id': 0, 'date': 1})
+    if days == 0:  # 追溯天数为0，s_date<=trade_date<=e_date
+        date_ls = trade_calendar.between(s_date, e_date, freq)
     elif s_date == '':
-        if freq == 'd':
-            trade_date = database.wind_trade_day.find({'date': {'$lte': e_date}}, {'_id': 0, 'date': 1}).sort('date', -1).limit(days)
-        else:
-            trade_date = database.wind_trade_day.find({'date': {'$lte': e_date}, '%s_last_trade_day' % freq: 1},
-                                                      {'_id': 0, 'date': 1}).sort('date', -1).limit(days)
+        date_ls = trade_calendar.before(e_date, days, freq)
     elif e_date == '':
-        if freq == 'd':
-            trade_date = database.wind_trade_day.find({'date': {'$gte': s_date}}, {'_id': 0, 'date': 1}).limit(days)
-        else:
-            trade_date = database.wind_trade_day.find({'date': {'$gte': s_date}, '%s_last_trade_day' % freq: 1},
-                                                      {'_id': 0, 'date': 1}).limit(days)
-    # trade_date形如[{'date':value},{},{}..],故在这里提取value;
-    date_ls = [date['date'] for date in trade_date]
-    date_ls.sort()
+        date_ls = trade_calendar.after(s_date, days, freq)
     return date_ls
 
 
@@ -48,34 +131,24 @@ def shift_date(t_date='', days=None, direction='pre'):
     :param direction: 追溯方向，str，pre是向过去追溯，post是向未来追溯
     :return: 得到的追溯后目标日期，str，%Y-%m-%d"
     """
-    database = db_zcs
     if days == 0:
         target_date = t_date
     elif isinstance(days, int):
-        if direction == 'pre':#sort('date',-1)为降序排序
-            cursor = database.wind_trade_day.find({'date': {'$lte': t_date}}, {'_id': 0, 'date': 1}
-                                                  ).sort('date', -1).limit(days)
+        if direction == 'pre':
+            target_date = trade_calendar.before(t_date, days)[0]
         elif direction == 'post':
-            cursor = database.wind_trade_day.find({'date': {'$gte': t_date}}, {'_id': 0, 'date': 1}).limit(days)
-        target_date = [date['date'] for date in cursor][-1]
+            target_date = trade_calendar.after(t_date, days)[-1]
 
     elif isinstance(days, str):
         n = re.match(r'(\d+)(.*)', days)
-        if n:#匹配成功，表示存在数字+str
-            if direction == 'pre':#group（0）是匹配正则表达式整体结果 group(1)是（\d+）意为一个或多个数字
-                cursor = database.wind_trade_day.find({'date': {'$lt': t_date}, '%s_last_trade_day' % n.group(2): 1},
-                                                      {'_id': 0, 'date': 1}).sort('date', -1).limit(int(n.group(1)))
-            elif direction == 'post':
-                cursor = database.wind_trade_day.find({'date': {'$gt': t_date}, '%s_last_trade_day' % n.group(2): 1},
-                                                      {'_id': 0, 'date': 1}).limit(int(n.group(1)))
-        else:#表示不存在数字，默认为最近一个。
-            if direction == 'pre':
-                cursor = database.wind_trade_day.find({'date': {'$lt': t_date}, '%s_last_trade_day' % days: 1},
-                                                      {'_id': 0, 'date': 1}).sort('date', -1).limit(1)
-            elif direction == 'post':
-                cursor = database.wind_trade_day.find({'date': {'$gt': t_date}, '%s_last_trade_day' % days: 1},
-                                                      {'_id': 0, 'date': 1}).limit(1)
-        target_date = [date['date'] for date in cursor][-1]
+        if n:  # 匹配成功，表示存在数字+str，group(1)是数字，group(2)是频率
+            num, freq = int(n.group(1)), n.group(2)
+        else:  # 表示不存在数字，默认为最近一个。
+            num, freq = 1, days
+        if direction == 'pre':
+            target_date = trade_calendar.before(t_date, num, freq, inclusive=False)[0]
+        elif direction == 'post':
+            target_date = trade_calendar.after(t_date, num, freq, inclusive=False)[-1]
     return target_date
 
 
@@ -86,13 +159,8 @@ def get_next_date(t_date, freq='d'):
     :param freq: 频率，str，'d'是日频，'m'是月频
     :return: 下一期的日期，str，"%Y-%m-%d"
     """
-    database = db_zcs
-    if freq == 'd':
-        cursor = database.wind_trade_day.find({'date': {'$gt': t_date}}, {'_id': 0, 'date': 1}).limit(1)
-        next_date = [it for it in cursor][0]['date']
-    elif freq == 'm':
-        cursor = database.wind_trade_day.find({'date': {'$gt': t_date}, 'm_last_trade_day': 1}, {'_id': 0, 'date': 1}).limit(1)
-        next_date = [it for it in cursor][0]['date']
+    if freq in ['d', 'm']:
+        next_date = trade_calendar.after(t_date, 1, freq, inclusive=False)[0]
     return next_date
 
 
@@ -157,8 +225,7 @@ def gen_last_trade_date():
     :return: 当前时间之前的最近一个交易日，str，'%Y-%m-%d'
     """
     current_date = str(datetime.now().date())
-    cursor = db_zcs.wind_trade_day.find({'date': {'$lte': current_date}}, {'_id': 0, 'date': 1}).sort('date', 1)
-    lte_current_date_ls = [i['date'] for i in cursor]
+    lte_current_date_ls = trade_calendar.before(current_date, 2)
     if current_date in lte_current_date_ls:
         return lte_current_date_ls[-2]
     else:
@@ -173,12 +240,7 @@ def is_window_start(date, window_type='m'):
     :return: 判定结果，bool
     """
     last_date = shift_date(date, 2, 'pre')
-    cursor = db_zcs.wind_trade_day.find({'date': last_date}, {'_id': 0, '%s_last_trade_day' % window_type: 1})
-    data = [it for it in cursor][0]['%s_last_trade_day' % window_type]
-    if data == 1:
-        return True
-    else:
-        return False
+    return trade_calendar.is_flagged(last_date, window_type)
 
 
 def is_window_end(date, window_type='m'):
@@ -188,12 +250,7 @@ def is_window_end(date, window_type='m'):
     :param window_type: 窗口期类型，str，w表示周，m表示月，q表示季度
     :return: 判定结果，bool
     """
-    cursor = db_zcs.wind_trade_day.find({'date': date}, {'_id': 0, '%s_last_trade_day' % window_type: 1})
-    data = [it for it in cursor][0]['%s_last_trade_day' % window_type]
-    if data == 1:
-        return True
-    else:
-        return False
+    return trade_calendar.is_flagged(date, window_type)
 
 
 def is_trade_date(date):
@@ -202,8 +259,4 @@ def is_trade_date(date):
     :param date: 指定日期，str，'%Y-%m-%d'
     :return: 判定结果，bool
     """
-    cursor = db_zcs.wind_trade_day.find({'date': date})
-    if len(list(cursor)) == 0:
-        return False
-    else:
-        return True
\ No newline at end of file
+    return trade_calendar.contains(date)
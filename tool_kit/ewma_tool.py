@@ -0,0 +1,223 @@
+from scipy.signal import lfilter
+from tool_kit import pd, np
+
+
+EWMA_WEIGHT_CACHE = {}
+
+
+def ewma_weight(window, half_life=None, descend=False):
+    """
+    生成并缓存半衰权重向量，同一(window，half_life，descend)只计算一次，返回的数组只读
+    :param window: 窗口长度，int
+    :param half_life: 半衰期长度，int，None表示等权
+    :param descend: 权重衰减方向，bool，True，大->小，False，小->大（按日期升序排列时最新一期权重最大）
+    :return: 和为1的半衰权重向量，numpy.ndarray，shape是(window,)
+    """
+    key = (window, half_life, descend)
+    if key not in EWMA_WEIGHT_CACHE:
+        weight_arr = ewma_decay(half_life) ** np.arange(window, dtype='float64')
+        weight_arr = weight_arr / weight_arr.sum()
+        if not descend:
+            weight_arr = weight_arr[::-1].copy()
+        weight_arr.flags.writeable = False
+        EWMA_WEIGHT_CACHE[key] = weight_arr
+    return EWMA_WEIGHT_CACHE[key]
+
+
+def ewma_decay(half_life=None):
+    """
+    半衰期对应的每期衰减系数
+    :param half_life: 半衰期长度，int，None表示等权，0按1处理（与utility_tool.half_decay_weight一致）
+    :return: 衰减系数，float
+    """
+    if half_life is None:
+        return 1.0
+    return 0.5 ** (1 / (half_life if half_life != 0 else 1))
+
+
+def ewma_sum(value_arr, window, half_life=None):
+    """
+    沿第0维（日期）滚动计算半衰加权和 Σ λ^k·x(t-k)，k<window，最新一期权重为1；
+    每期由前一期的结果衰减一次、加入当期、减去移出窗口的一期得到，用scipy.signal.lfilter一次完成整个矩阵
+    :param value_arr: 取值矩阵，numpy.ndarray，shape是(日期数，...)，不能包含nan
+    :param window: 窗口长度，int
+    :param half_life: 半衰期长度，int，None表示等权
+    :return: 半衰加权和，numpy.ndarray，shape与value_arr相同
+    """
+    decay = ewma_decay(half_life)
+    value_arr = np.asarray(value_arr, dtype='float64')
+    if window < len(value_arr):
+        value_arr = value_arr.copy()
+        value_arr[window:] -= decay ** window * value_arr[:-window]
+    return lfilter([1.0], [1.0, -decay], value_arr, axis=0)
+
+
+def rolling_count(valid_arr, window):
+    """
+    沿第0维滚动计算窗口内的有效观测数量
+    :param valid_arr: 是否有效，numpy.ndarray，bool
+    :param window: 窗口长度，int
+    :return: 有效观测数量，numpy.ndarray，shape与valid_arr相同
+    """
+    count_arr = np.cumsum(valid_arr, axis=0)
+    count_arr[window:] = count_arr[window:] - count_arr[:-window]
+    return count_arr
+
+
+def ewma_mean(value_arr, window, half_life=None, min_periods=1):
+    """
+    滚动半衰加权均值，窗口内的nan不参与计算，权重在有效观测上重新归一化
+    :param value_arr: 取值矩阵，numpy.ndarray，shape是(日期数，...)，如日期×股票代码的收益率矩阵
+    :param window: 窗口长度，int
+    :param half_life: 半衰期长度，int，None表示等权
+    :param min_periods: 需要的最少有效观测数量，int，不足时为nan
+    :return: 半衰加权均值，numpy.ndarray，shape与value_arr相同
+    """
+    value_arr = np.asarray(value_arr, dtype='float64')
+    valid = np.isfinite(value_arr)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_arr = ewma_sum(np.where(valid, value_arr, 0.0), window, half_life) / \
+            ewma_sum(valid, window, half_life)
+    return np.where(rolling_count(valid, window) >= max(min_periods, 1), mean_arr, np.nan)
+
+
+def ewma_cov(x_arr, y_arr=None, window=252, half_life=None, min_periods=1, demean=True):
+    """
+    滚动半衰加权协方差，只使用两个序列都有效的观测，权重在有效观测上重新归一化
+    :param x_arr: 取值矩阵，numpy.ndarray，shape是(日期数，股票数)或(日期数,)
+    :param y_arr: 取值矩阵，numpy.ndarray，shape与x_arr相同或是(日期数,)（如市场收益率，按股票广播），None表示计算x_arr的方差
+    :param window: 窗口长度，int
+    :param half_life: 半衰期长度，int，None表示等权
+    :param min_periods: 需要的最少有效观测数量，int，不足时为nan
+    :param demean: 是否减去加权均值，bool，False时为加权二阶原点矩
+    :return: 半衰加权协方差，numpy.ndarray，shape是x_arr与y_arr广播后的shape；y_arr为None时方差不小于0
+    """
+    x_arr = np.asarray(x_arr, dtype='float64')
+    y_arr = x_arr if y_arr is None else np.asarray(y_arr, dtype='float64')
+    if x_arr.ndim == 2 and y_arr.ndim == 1:
+        y_arr = y_arr[:, None]
+    elif x_arr.ndim == 1 and y_arr.ndim == 2:
+        x_arr = x_arr[:, None]
+    valid = np.isfinite(x_arr) & np.isfinite(y_arr)
+    x_valid = np.where(valid, x_arr, 0.0)
+    y_valid = np.where(valid, y_arr, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight_sum = ewma_sum(valid, window, half_life)
+        cov_arr = ewma_sum(x_valid * y_valid, window, half_life) / weight_sum
+        if demean:
+            cov_arr = cov_arr - ewma_sum(x_valid, window, half_life) * ewma_sum(y_valid, window, half_life) / \
+                weight_sum ** 2
+    if y_arr is x_arr:
+        cov_arr = np.clip(cov_arr, 0, None)
+    return np.where(rolling_count(valid, window) >= max(min_periods, 1), cov_arr, np.nan)
+
+
+def ewma_std(value_arr, window, half_life=None, min_periods=1, demean=True):
+    """
+    滚动半衰加权标准差
+    :param value_arr: 取值矩阵，numpy.ndarray，shape是(日期数，...)
+    :param window: 窗口长度，int
+    :param half_life: 半衰期长度，int，None表示等权
+    :param min_periods: 需要的最少有效观测数量，int，不足时为nan
+    :param demean: 是否减去加权均值，bool
+    :return: 半衰加权标准差，numpy.ndarray，shape与value_arr相同
+    """
+    return np.sqrt(ewma_cov(value_arr, None, window, half_life, min_periods, demean))
+
+
+def ewma_beta(stock_arr, market_arr, window=252, half_life=63, min_periods=1):
+    """
+    滚动半衰加权时间序列回归 r(stock) = α + β·r(market) + e，只使用股票和市场收益率都有效的观测
+    :param stock_arr: 股票收益率矩阵，numpy.ndarray，shape是(日期数，股票数)
+    :param market_arr: 市场收益率，numpy.ndarray，shape是(日期数,)
+    :param window: 窗口长度，int
+    :param half_life: 半衰期长度，int，None表示等权
+    :param min_periods: 需要的最少有效观测数量，int，不足时为nan
+    :return: (β，α，残差标准差)，tuple，numpy.ndarray，shape都是(日期数，股票数)
+    """
+    stock_arr = np.asarray(stock_arr, dtype='float64')
+    market_arr = np.broadcast_to(np.asarray(market_arr, dtype='float64')[:, None], stock_arr.shape)
+    valid = np.isfinite(stock_arr) & np.isfinite(market_arr)
+    y_valid = np.where(valid, stock_arr, 0.0)
+    x_valid = np.where(valid, market_arr, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight_sum = ewma_sum(valid, window, half_life)
+        x_mean = ewma_sum(x_valid, window, half_life) / weight_sum
+        y_mean = ewma_sum(y_valid, window, half_life) / weight_sum
+        x_var = ewma_sum(x_valid * x_valid, window, half_life) / weight_sum - x_mean ** 2
+        y_var = ewma_sum(y_valid * y_valid, window, half_life) / weight_sum - y_mean ** 2
+        xy_cov = ewma_sum(x_valid * y_valid, window, half_life) / weight_sum - x_mean * y_mean
+        beta_arr = xy_cov / x_var
+        alpha_arr = y_mean - beta_arr * x_mean
+        # 加权最小二乘的残差方差等于 Var(y) - β·Cov(x, y)
+        resid_std_arr = np.sqrt(np.clip(y_var - beta_arr * xy_cov, 0, None))
+    enough = rolling_count(valid, window) >= max(min_periods, 1)
+    return tuple(np.where(enough, arr, np.nan) for arr in [beta_arr, alpha_arr, resid_std_arr])
+
+
+def cal_barra_style(return_df, market_return, risk_free=0.0, min_periods=63, beta_window=252, beta_half_life=63,
+                    dastd_window=252, dastd_half_life=42, cmra_months=12, month_days=21, rstr_window=504,
+                    rstr_half_life=126, rstr_lag=21, vol_weight=(0.74, 0.16, 0.10)):
+    """
+    按Barra CNE5的定义用日频收益率矩阵计算beta、波动率和动量类风格因子，全部因子都是整个日期×股票代码矩阵上的滚动运算，
+    输出可以直接用utility_tool.update_from_df写入factor_barra
+    beta：超额收益率对市场超额收益率的半衰加权回归系数
+    hsigma：上述回归的残差标准差
+    dastd：超额收益率的半衰加权标准差
+    cmra：过去cmra_months个月累计对数超额收益率的最大值与最小值之差
+    rstr：滞后rstr_lag天的对数超额收益率的半衰加权均值
+    vol：dastd、cmra、hsigma按vol_weight加权，momentum：rstr；与size、beta的正交化在FactorCal/FactorPanelCal中完成
+    :param return_df: 日频股票收益率矩阵，pandas.DataFrame，index是日期，columns是股票代码，如utility_tool.gen_daily_return_matrix，
+                      需要包含计算窗口所需的历史数据
+    :param market_return: 日频市场收益率，pandas.Series，index是日期，一般为市值加权收益率
+    :param risk_free: 日频无风险收益率，float或pandas.Series（index是日期）
+    :param min_periods: 每个因子需要的最少有效观测数量，int，不足时为nan
+    :param beta_window: beta和hsigma的窗口长度，int
+    :param beta_half_life: beta和hsigma的半衰期，int
+    :param dastd_window: dastd的窗口长度，int
+    :param dastd_half_life: dastd的半衰期，int
+    :param cmra_months: cmra的月数，int
+    :param month_days: 每个月的交易日数量，int
+    :param rstr_window: rstr的窗口长度，int
+    :param rstr_half_life: rstr的半衰期，int
+    :param rstr_lag: rstr的滞后天数，int
+    :param vol_weight: dastd、cmra、hsigma在vol中的权重，tuple
+    :return: 风格因子，pandas.DataFrame，index是[date, code]，columns是[beta, hsigma, dastd, cmra, rstr, vol, momentum]，
+             全部因子都为nan的样本被删除
+    """
+    if isinstance(risk_free, pd.Series):
+        risk_free = risk_free.reindex(return_df.index).to_numpy(dtype='float64')
+    market_arr = market_return.reindex(return_df.index).to_numpy(dtype='float64') - risk_free
+    excess_arr = return_df.to_numpy(dtype='float64') - np.reshape(risk_free, (-1, 1))
+    value_dt = {}
+    value_dt['beta'], _, value_dt['hsigma'] = ewma_beta(excess_arr, market_arr, beta_window, beta_half_life,
+                                                        min_periods)
+    value_dt['dastd'] = ewma_std(excess_arr, dastd_window, dastd_half_life, min_periods)
+
+    # cmra：累计对数收益率矩阵的滞后差分即为过去T个月的累计对数收益率
+    log_arr = np.log1p(excess_arr)
+    valid = np.isfinite(log_arr)
+    cum_arr = np.cumsum(np.where(valid, log_arr, 0.0), axis=0)
+    range_max = np.full(cum_arr.shape, -np.inf)
+    range_min = np.full(cum_arr.shape, np.inf)
+    for month in range(1, cmra_months + 1):
+        lag = month * month_days
+        lag_arr = np.zeros(cum_arr.shape)
+        lag_arr[lag:] = cum_arr[:max(len(cum_arr) - lag, 0)]
+        range_max = np.maximum(range_max, cum_arr - lag_arr)
+        range_min = np.minimum(range_min, cum_arr - lag_arr)
+    cmra_window = cmra_months * month_days
+    value_dt['cmra'] = np.where(rolling_count(valid, cmra_window) >= max(min_periods, 1), range_max - range_min,
+                                np.nan)
+
+    lag_log_arr = np.full(log_arr.shape, np.nan)
+    lag_log_arr[rstr_lag:] = log_arr[:len(log_arr) - rstr_lag]
+    value_dt['rstr'] = ewma_mean(lag_log_arr, rstr_window, rstr_half_life, min_periods)
+
+    value_dt['vol'] = vol_weight[0] * value_dt['dastd'] + vol_weight[1] * value_dt['cmra'] + \
+        vol_weight[2] * value_dt['hsigma']
+    value_dt['momentum'] = value_dt['rstr']
+    factor_ls = ['beta', 'hsigma', 'dastd', 'cmra', 'rstr', 'vol', 'momentum']
+    data_index = pd.MultiIndex.from_product([return_df.index, return_df.columns], names=['date', 'code'])
+    style_df = pd.DataFrame({f: value_dt[f].ravel() for f in factor_ls}, index=data_index)
+    return style_df.dropna(how='all')
@@ -0,0 +1,118 @@
+from tool_kit import pd, np
+from tool_kit.preprocess_tool import stack_by_date
+
+
+COUNTRY_FACTOR = 'country'
+
+
+def constrained_wls_array(x_3d, y_arr, w_arr, c_arr, weight_col=None):
+    """
+    批量带约束加权最小二乘，对每个日期求解 min Σw(y-Xf)² s.t. c·f=0，全部日期的KKT方程组一次求解
+    :param x_3d: 因子暴露，numpy.ndarray，shape是(日期数，股票数，因子数)，补齐和无效样本为0
+    :param y_arr: 收益率，numpy.ndarray，shape是(日期数，股票数)，补齐和无效样本为0
+    :param w_arr: 回归权重，numpy.ndarray，shape是(日期数，股票数)，补齐和无效样本为0
+    :param c_arr: 约束系数，numpy.ndarray，shape是(日期数，因子数)，全为0的日期不加约束
+    :param weight_col: 需要输出纯因子组合权重的因子位置，list，None表示不输出
+    :return: (因子收益率，纯因子组合权重)，tuple，shape分别是(日期数，因子数)和(日期数，len(weight_col)，股票数)，
+             因子收益率等于纯因子组合权重与收益率的乘积；当天没有暴露的因子收益率和组合权重为0，weight_col为None时组合权重为None
+    """
+    n_dates, n_stocks, n_factors = x_3d.shape
+    xw_3d = x_3d * w_arr[..., None]
+    xtx = np.swapaxes(xw_3d, 1, 2) @ x_3d
+    # 当天没有暴露的因子（如当天没有成分股的行业）在正规方程中固定为0，保证方程组非奇异
+    date_loc, factor_loc = np.nonzero(np.einsum('tkk->tk', xtx) == 0)
+    xtx[date_loc, factor_loc, factor_loc] = 1.0
+    c_arr = np.array(c_arr, dtype='float64')
+    c_arr[date_loc, factor_loc] = 0.0
+    kkt = np.zeros((n_dates, n_factors + 1, n_factors + 1))
+    kkt[:, :n_factors, :n_factors] = xtx
+    kkt[:, n_factors, :n_factors] = c_arr
+    kkt[:, :n_factors, n_factors] = c_arr
+    kkt[~(c_arr != 0).any(axis=1), n_factors, n_factors] = 1.0
+    rhs = np.zeros((n_dates, n_factors + 1, 1))
+    rhs[:, :n_factors, 0] = np.einsum('tnk,tn->tk', xw_3d, y_arr)
+    factor_return_arr = np.linalg.solve(kkt, rhs)[:, :n_factors, 0]
+    if weight_col is None:
+        return factor_return_arr, None
+    # 纯因子组合权重是KKT逆矩阵的对应行与X'W的乘积，只对需要的因子计算
+    inv_rows = np.linalg.inv(kkt)[:, weight_col, :n_factors]
+    return factor_return_arr, inv_rows @ np.swapaxes(xw_3d, 1, 2)
+
+
+def cal_factor_return(data_df, style_factor_ls, industry_factor_ls, return_col='return', cap_col='free_mkt',
+                      country=True, weight_factor_ls=None, chunk_size=250, level='date'):
+    """
+    面板数据按日期做横截面带约束加权回归，收益率对[国家因子，行业因子，风格因子]回归，回归权重为流通市值的平方根，
+    行业因子收益率按行业流通市值加权之和为0；按日期补齐成三维数组后批量求解，每次求解chunk_size个日期
+    :param data_df: 因子面板数据，pandas.DataFrame，index是[日期，股票代码]，columns包括风格因子、行业虚拟变量、收益率和流通市值，
+                    与FactorPanelCal.process_data_df相同
+    :param style_factor_ls: 风格因子名称列表，list
+    :param industry_factor_ls: 行业虚拟变量名称列表，list
+    :param return_col: 收益率的列名，str
+    :param cap_col: 流通市值的列名，str
+    :param country: 是否加入国家因子，bool，False时不加国家因子，也不加行业约束
+    :param weight_factor_ls: 需要输出纯因子组合权重的因子名称列表，list，None表示不输出
+    :param chunk_size: 每次求解的日期数量，int
+    :param level: 日期所在的index层级名称，str
+    :return: (因子收益率，特异性收益率，R²，纯因子组合权重)，tuple
+             因子收益率，pandas.DataFrame，index是日期，columns是[country，行业因子，风格因子]
+             特异性收益率，pandas.Series，index与data_df相同，不参与回归的样本为nan
+             R²，pandas.Series，index是日期，加权R²
+             纯因子组合权重，pandas.DataFrame，index与data_df相同，columns是weight_factor_ls，不参与回归的样本为0；
+             weight_factor_ls为None时为None
+    """
+    factor_ls = ([COUNTRY_FACTOR] if country else []) + list(industry_factor_ls) + list(style_factor_ls)
+    n_country = 1 if country else 0
+    x_arr = np.ones((len(data_df), len(factor_ls)))
+    x_arr[:, n_country:] = data_df[list(industry_factor_ls) + list(style_factor_ls)].to_numpy(dtype='float64')
+    y_arr = data_df[return_col].to_numpy(dtype='float64')
+    cap_arr = data_df[cap_col].to_numpy(dtype='float64')
+    w_arr = np.sqrt(cap_arr)
+    valid = np.isfinite(x_arr).all(axis=1) & np.isfinite(y_arr) & np.isfinite(w_arr) & (w_arr > 0)
+    # 不参与回归的样本暴露、收益率和权重都置为0，补齐成三维数组后不影响正规方程
+    x_arr[~valid] = 0.0
+    y_valid = np.where(valid, y_arr, 0.0)
+    w_valid = np.where(valid, w_arr, 0.0)
+    date_codes, date_ls = pd.factorize(data_df.index.get_level_values(level), sort=True)
+    n_dates = len(date_ls)
+    cap_valid = np.where(valid, cap_arr, 0.0)
+
+    factor_return_arr = np.full((n_dates, len(factor_ls)), np.nan)
+    weight_col = [] if weight_factor_ls is None else [factor_ls.index(factor) for factor in weight_factor_ls]
+    pure_weight_arr = np.zeros((len(x_arr), len(weight_col)))
+    for s in range(0, n_dates, chunk_size):
+        rows = np.flatnonzero((date_codes >= s) & (date_codes < s + chunk_size))
+        chunk_codes = date_codes[rows] - s
+        x_3d, date_pos, row_pos = stack_by_date(x_arr[rows], chunk_codes, 0.0)
+        y_2d = np.zeros(x_3d.shape[:2])
+        y_2d[date_pos, row_pos] = y_valid[rows]
+        w_2d = np.zeros(x_3d.shape[:2])
+        w_2d[date_pos, row_pos] = w_valid[rows]
+        # 行业约束系数：当天参与回归的样本中各行业的流通市值之和
+        c_arr = np.zeros((x_3d.shape[0], len(factor_ls)))
+        if country:
+            cap_2d = np.zeros(x_3d.shape[:2])
+            cap_2d[date_pos, row_pos] = cap_valid[rows]
+            industry_loc = slice(n_country, n_country + len(industry_factor_ls))
+            c_arr[:, industry_loc] = (cap_2d[:, None, :] @ x_3d)[:, 0, industry_loc]
+        chunk_return, weight_3d = constrained_wls_array(x_3d, y_2d, w_2d, c_arr,
+                                                        None if len(weight_col) == 0 else weight_col)
+        factor_return_arr[s:s + x_3d.shape[0]] = chunk_return
+        if weight_3d is not None:
+            pure_weight_arr[rows] = np.swapaxes(weight_3d, 1, 2)[date_pos, row_pos]
+
+    resid_arr = np.full(len(y_arr), np.nan)
+    resid_arr[valid] = y_arr[valid] - np.einsum('nk,nk->n', x_arr[valid], factor_return_arr[date_codes[valid]])
+    w_sum = np.bincount(date_codes, weights=w_valid, minlength=n_dates)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y_mean = np.bincount(date_codes, weights=w_valid * y_valid, minlength=n_dates) / w_sum
+        ss_resid = np.bincount(date_codes, weights=w_valid * np.where(valid, resid_arr, 0.0) ** 2, minlength=n_dates)
+        ss_total = np.bincount(date_codes, weights=w_valid * (y_valid - y_mean[date_codes]) ** 2, minlength=n_dates)
+        r2_arr = 1 - ss_resid / ss_total
+    factor_return_df = pd.DataFrame(factor_return_arr, index=pd.Index(date_ls, name=level), columns=factor_ls)
+    factor_return_df[w_sum == 0] = np.nan
+    specific_return_series = pd.Series(resid_arr, index=data_df.index, name='specific_return')
+    r2_series = pd.Series(r2_arr, index=pd.Index(date_ls, name=level), name='r2')
+    pure_weight_df = None if weight_factor_ls is None else \
+        pd.DataFrame(pure_weight_arr, index=data_df.index, columns=list(weight_factor_ls))
+    return factor_return_df, specific_return_series, r2_series, pure_weight_df
@@ -0,0 +1,121 @@
+from scipy import stats
+from tool_kit import pd, np
+
+
+def rank_rows(arr):
+    """
+    逐行计算平均排名，空值保持为空值
+    :param arr: 数据矩阵，numpy.ndarray，shape是(..., 股票数)
+    :return: 排名矩阵，numpy.ndarray，shape与arr相同
+    """
+    shape = arr.shape
+    rank_arr = pd.DataFrame(arr.reshape(-1, shape[-1])).rank(axis=1, method='average').to_numpy()
+    return rank_arr.reshape(shape)
+
+
+def cal_ic_array(factor_arr, return_arr, rank=False, sig_level=None):
+    """
+    横截面IC向量化计算，对所有日期（以及所有因子）同时计算，因子值或收益率为空的股票不参与计算
+    :param factor_arr: 因子值矩阵，numpy.ndarray，shape是(日期数，股票数)或(因子数，日期数，股票数)
+    :param return_arr: 未来收益率矩阵，numpy.ndarray，shape是(日期数，股票数)，与factor_arr按股票和日期对齐
+    :param rank: 是否计算rankIC，bool
+    :param sig_level: 显著性水平，float，p值大于sig_level的IC置为0，None表示不做显著性检验
+    :return: (IC，t值，p值，有效样本数)，tuple，元素都是numpy.ndarray，shape是factor_arr去掉最后一维
+    """
+    factor_arr = np.asarray(factor_arr, dtype='float64')
+    return_arr = np.broadcast_to(np.asarray(return_arr, dtype='float64'), factor_arr.shape)
+    valid = np.isfinite(factor_arr) & np.isfinite(return_arr)
+    x = np.where(valid, factor_arr, np.nan)
+    y = np.where(valid, return_arr, np.nan)
+    if rank:
+        x, y = rank_rows(x), rank_rows(y)
+    n = valid.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_c = np.where(valid, x - np.nansum(x, axis=-1, keepdims=True) / n[..., None], 0.0)
+        y_c = np.where(valid, y - np.nansum(y, axis=-1, keepdims=True) / n[..., None], 0.0)
+        ic = (x_c * y_c).sum(axis=-1) / np.sqrt((x_c ** 2).sum(axis=-1) * (y_c ** 2).sum(axis=-1))
+        ic = np.where(n > 2, np.clip(ic, -1.0, 1.0), np.nan)
+        t_value = ic * np.sqrt((n - 2) / (1 - ic ** 2))
+    p_value = 2 * stats.t.sf(np.abs(t_value), np.maximum(n - 2, 1))
+    p_value = np.where(np.abs(ic) == 1, 0.0, p_value)
+    if sig_level is not None:
+        ic = np.where(p_value > sig_level, 0.0, ic)
+    return ic, t_value, p_value, n
+
+
+def cal_ic(factor_df, return_df, rank=False, sig_level=None):
+    """
+    横截面IC计算，按日期和股票代码对齐后调用cal_ic_array
+    :param factor_df: 因子值矩阵，pandas.DataFrame，index是日期，columns是股票代码
+    :param return_df: 未来收益率矩阵，pandas.DataFrame，index是日期，columns是股票代码，第i行是factor_df第i行对应的未来收益
+    :param rank: 是否计算rankIC，bool
+    :param sig_level: 显著性水平，float，p值大于sig_level的IC置为0，None表示不做显著性检验
+    :return: IC检验结果，pandas.DataFrame，index是日期，columns是[ic, t_value, p_value, n]
+    """
+    codes = factor_df.columns.intersection(return_df.columns)
+    ic, t_value, p_value, n = cal_ic_array(factor_df[codes].to_numpy(dtype='float64'),
+                                           return_df[codes].to_numpy(dtype='float64'), rank, sig_level)
+    return pd.DataFrame({'ic': ic, 't_value': t_value, 'p_value': p_value, 'n': n}, index=factor_df.index)
+
+
+def cal_forward_return(price_df, date_ls, horizon_ls=(1, 5, 20, 'rebalance'), end_date=None):
+    """
+    计算多个持有期的未来收益率
+    :param price_df: 复权价格矩阵，pandas.DataFrame，index是日期（全部交易日），columns是股票代码
+    :param date_ls: 计算未来收益的日期（一般为换仓日），list
+    :param horizon_ls: 持有期，list，int表示持有的交易日数，'rebalance'表示持有至date_ls中的下一个日期
+    :param end_date: 最后一个日期持有至下一换仓日时的结束日期，str，None表示不计算最后一期的'rebalance'收益
+    :return: 未来收益率，dict，key是持有期，value是pandas.DataFrame，index是date_ls，columns是股票代码
+    """
+    price_arr = price_df.to_numpy(dtype='float64')
+    padded_arr = np.vstack([price_arr, np.full((1, price_arr.shape[1]), np.nan)])
+    price_dates = price_df.index
+    start_loc = price_dates.get_indexer(date_ls)
+    forward_return_dt = {}
+    for horizon in horizon_ls:
+        if horizon == 'rebalance':
+            end_ls = list(date_ls[1:]) + [end_date]
+            end_loc = np.array([price_dates.get_loc(date) if date in price_dates else -1 for date in end_ls])
+        else:
+            end_loc = start_loc + int(horizon)
+            end_loc = np.where(end_loc < len(price_dates), end_loc, -1)
+        end_loc = np.where(start_loc == -1, -1, end_loc)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return_arr = padded_arr[end_loc] / padded_arr[start_loc] - 1
+        forward_return_dt[horizon] = pd.DataFrame(return_arr, index=date_ls, columns=price_df.columns)
+    return forward_return_dt
+
+
+def cal_ic_decay(factor_dt, price_df, date_ls=None, horizon_ls=(1, 5, 20, 'rebalance'), end_date=None, rank=False,
+                 sig_level=None, chunk_size=20):
+    """
+    多因子、多持有期IC及IC衰减计算，每个持有期的未来收益率只计算一次，因子按chunk_size分块向量化计算
+    :param factor_dt: 因子值矩阵，dict，key是因子名称，value是pandas.DataFrame，index是股票代码，columns是换仓日
+    :param price_df: 复权价格矩阵，pandas.DataFrame，index是日期（全部交易日），columns是股票代码
+    :param date_ls: 换仓日列表，list，None表示全部因子换仓日的并集
+    :param horizon_ls: 持有期，list，int表示持有的交易日数，'rebalance'表示持有至下一个换仓日
+    :param end_date: 最后一个换仓日持有至下一换仓日时的结束日期，str
+    :param rank: 是否计算rankIC，bool
+    :param sig_level: 显著性水平，float，p值大于sig_level的IC置为0，None表示不做显著性检验
+    :param chunk_size: 每次向量化计算的因子数量，int
+    :return: (ic_dt, decay_df, icir_df)，tuple
+             ic_dt: IC序列，dict，key是持有期，value是pandas.DataFrame，index是换仓日，columns是因子名称
+             decay_df: IC均值衰减，pandas.DataFrame，index是因子名称，columns是持有期
+             icir_df: ICIR，pandas.DataFrame，index是因子名称，columns是持有期
+    """
+    factor_ls = list(factor_dt.keys())
+    if date_ls is None:
+        date_ls = sorted(set(date for factor_df in factor_dt.values() for date in factor_df.columns))
+    codes = price_df.columns
+    forward_return_dt = cal_forward_return(price_df, date_ls, horizon_ls, end_date)
+    ic_dt = {horizon: pd.DataFrame(index=date_ls, columns=factor_ls, dtype='float64') for horizon in horizon_ls}
+    for i in range(0, len(factor_ls), chunk_size):
+        chunk_ls = factor_ls[i:i + chunk_size]
+        factor_arr = np.stack([factor_dt[name].reindex(index=codes, columns=date_ls).T.to_numpy(dtype='float64')
+                               for name in chunk_ls])
+        for horizon in horizon_ls:
+            ic = cal_ic_array(factor_arr, forward_return_dt[horizon].to_numpy(), rank, sig_level)[0]
+            ic_dt[horizon].loc[:, chunk_ls] = ic.T
+    decay_df = pd.DataFrame({horizon: ic_dt[horizon].mean() for horizon in horizon_ls})
+    icir_df = pd.DataFrame({horizon: ic_dt[horizon].mean() / ic_dt[horizon].std() for horizon in horizon_ls})
+    return ic_dt, decay_df, icir_df
@@ -0,0 +1,154 @@
+from tool_kit import pd, np
+from tool_kit.preprocess_tool import stack_by_date
+
+
+# 正交化依赖关系：key是被正交化的因子，value是作为回归解释变量的因子列表，按顺序依次处理
+ORTH_SPEC_DT = {'vol': ['size', 'beta'], 'liq': ['size']}
+
+
+def resolve_orth_spec(spec_dt, factor_ls):
+    """
+    整理正交化依赖关系，只保留被正交化因子和解释变量都在factor_ls中的条目，按依赖顺序分批：
+    解释变量中包含其他被正交化因子的条目排在该因子之后，同一批中解释变量相同的因子合并为一次回归
+    :param spec_dt: 正交化依赖关系，dict，key是被正交化的因子，value是解释变量因子列表，如ORTH_SPEC_DT
+    :param factor_ls: 当前数据中的因子名称列表，list
+    :return: 分批的回归，list，每个元素是一批回归，dict，key是解释变量因子tuple，value是被正交化的因子list
+    """
+    spec_dt = {target: list(x_ls) for target, x_ls in spec_dt.items()
+               if target in factor_ls and all(x in factor_ls for x in x_ls)}
+    stage_ls = []
+    done = set()
+    while len(done) != len(spec_dt):
+        stage = {}
+        for target, x_ls in spec_dt.items():
+            if target not in done and all(x in done or x not in spec_dt for x in x_ls):
+                stage.setdefault(tuple(x_ls), []).append(target)
+        if len(stage) == 0:
+            raise ValueError('正交化依赖关系存在循环：%s' % sorted(set(spec_dt) - done))
+        for target_ls in stage.values():
+            done.update(target_ls)
+        stage_ls.append(stage)
+    return stage_ls
+
+
+def orth_array(y_arr, x_arr, weight_arr, date_codes=None, standardize=True, chunk_size=250):
+    """
+    批量横截面加权回归正交化，回归不含常数项，回归权重为weight_arr的平方，与utility_tool.do_orth的回归相同；
+    全部日期按日期补齐成三维数组，每个(日期，因子)的正规方程一次批量求解，不再逐日期、逐因子回归
+    因子、解释变量或权重有空值的样本不参与回归，残差为空值；解释变量退化时用伪逆得到与最小二乘相同的最小范数解
+    :param y_arr: 被正交化的因子，numpy.ndarray，shape是(样本数，因子数)或(样本数,)
+    :param x_arr: 解释变量，numpy.ndarray，shape是(样本数，解释变量数)或(样本数,)
+    :param weight_arr: 市值权重，numpy.ndarray，shape是(样本数,)
+    :param date_codes: 每个样本的日期编号，numpy.ndarray，0开始的整数，None表示全部样本属于同一日期
+    :param standardize: 是否标准化残差，bool，True时按weight_arr加权均值去均值、除以等权标准差，与utility_tool.do_standardize相同
+    :param chunk_size: 每次求解的日期数量，int
+    :return: 正交化后的因子，numpy.ndarray，shape与y_arr相同
+    """
+    y_arr = np.asarray(y_arr, dtype='float64')
+    is_vector = y_arr.ndim == 1
+    y_arr = y_arr[:, None] if is_vector else y_arr
+    x_arr = np.asarray(x_arr, dtype='float64')
+    x_arr = x_arr[:, None] if x_arr.ndim == 1 else x_arr
+    w_arr = np.asarray(weight_arr, dtype='float64')
+    date_codes = np.zeros(len(y_arr), dtype='int64') if date_codes is None else np.asarray(date_codes)
+    valid = np.isfinite(y_arr) & (np.isfinite(x_arr).all(axis=1) & np.isfinite(w_arr))[:, None]
+    resid_arr = np.full(y_arr.shape, np.nan)
+    n_dates = date_codes.max() + 1 if len(date_codes) != 0 else 0
+    for s in range(0, n_dates, chunk_size):
+        rows = np.flatnonzero((date_codes >= s) & (date_codes < s + chunk_size))
+        chunk_valid = valid[rows]
+        # 解释变量、因子、有效标记和权重拼成一个数组一次补齐
+        n_x, n_y = x_arr.shape[1], y_arr.shape[1]
+        data_3d, date_pos, row_pos = stack_by_date(np.hstack([
+            np.where(chunk_valid.any(axis=1)[:, None], x_arr[rows], 0.0), np.where(chunk_valid, y_arr[rows], 0.0),
+            chunk_valid, np.nan_to_num(w_arr[rows])[:, None]]), date_codes[rows] - s, 0.0)
+        x_3d, y_3d = data_3d[..., :n_x], data_3d[..., n_x:n_x + n_y]
+        v_3d, w_2d = data_3d[..., n_x + n_y:n_x + 2 * n_y], data_3d[..., -1]
+        # 每个因子的有效样本不同，回归权重按因子分开：shape是(日期数，股票数，因子数)
+        ww_3d = v_3d * (w_2d ** 2)[..., None]
+        xtx = np.stack([np.swapaxes(x_3d * ww_3d[..., j:j + 1], 1, 2) @ x_3d for j in range(n_y)], axis=1)
+        xty = np.swapaxes(np.swapaxes(x_3d, 1, 2) @ (ww_3d * y_3d), 1, 2)
+        beta = (np.linalg.pinv(xtx) @ xty[..., None])[..., 0]
+        # 残差在三维数组上计算后取回原始样本，标准化按日期编号计算
+        resid = (y_3d - x_3d @ np.swapaxes(beta, 1, 2))[date_pos, row_pos]
+        resid[~chunk_valid] = 0.0
+        if standardize:
+            n_chunk = len(beta)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                for j in range(resid.shape[1]):
+                    count = np.bincount(date_pos, weights=chunk_valid[:, j], minlength=n_chunk)
+                    mean = np.bincount(date_pos, weights=resid[:, j], minlength=n_chunk) / count
+                    std = np.sqrt(np.bincount(date_pos, weights=np.where(chunk_valid[:, j], resid[:, j] - mean[date_pos],
+                                                                          0.0) ** 2, minlength=n_chunk) / (count - 1))
+                    w_mean = np.bincount(date_pos, weights=resid[:, j] * np.nan_to_num(w_arr[rows]), minlength=n_chunk)
+                    resid[:, j] = (resid[:, j] - w_mean[date_pos]) / std[date_pos]
+        resid_arr[rows] = np.where(chunk_valid, resid, np.nan)
+    return resid_arr[:, 0] if is_vector else resid_arr
+
+
+def apply_orth_spec(factor_df, weight_series, spec_dt=None, level=None, standardize=True, chunk_size=250):
+    """
+    按正交化依赖关系对因子数据做加权回归正交化，解释变量相同的因子、以及全部日期一次批量求解
+    :param factor_df: 因子数据，pandas.DataFrame，index是股票代码（单个日期）或[日期，股票代码]（面板），columns是因子名称
+    :param weight_series: 市值权重，pandas.Series，index与factor_df相同，回归权重为其平方
+    :param spec_dt: 正交化依赖关系，dict，None表示ORTH_SPEC_DT，见resolve_orth_spec
+    :param level: 日期所在的index层级名称，str，None表示factor_df是单个日期的横截面
+    :param standardize: 是否标准化残差，bool，见orth_array
+    :param chunk_size: 每次求解的日期数量，int
+    :return: 正交化后的因子数据，pandas.DataFrame，结构与factor_df相同，未参与正交化的因子不变
+    """
+    stage_ls = resolve_orth_spec(ORTH_SPEC_DT if spec_dt is None else spec_dt, factor_df.columns.tolist())
+    factor_df = factor_df.copy()
+    if len(stage_ls) == 0:
+        return factor_df
+    date_codes = None if level is None else pd.factorize(factor_df.index.get_level_values(level))[0]
+    w_arr = weight_series.reindex(factor_df.index).to_numpy(dtype='float64')
+    for stage in stage_ls:
+        for x_tuple, target_ls in stage.items():
+            factor_df[target_ls] = orth_array(factor_df[target_ls].to_numpy(dtype='float64'),
+                                              factor_df[list(x_tuple)].to_numpy(dtype='float64'), w_arr, date_codes,
+                                              standardize, chunk_size)
+    return factor_df
+
+
+def lowdin_orth(factor_df, weight_series=None, method='symmetric', floor=1e-10, level=None):
+    """
+    Löwdin正交化，对加权重叠矩阵M = F'WF做特征分解（numpy.linalg.eigh，结果为实数且按特征值排序），
+    用floor倍最大特征值作为特征值下限，避免近似共线时放大噪声
+    symmetric：F·M^(-1/2)，小于下限的特征值取下限，正交化后的因子与原因子的距离最小，columns与factor_df相同
+    canonical：F·U·Λ^(-1/2)，只保留大于下限的特征方向，按特征值从大到小排列，columns是['canonical_0', ...]
+    :param factor_df: 因子数据，pandas.DataFrame，index是股票代码（单个日期）或[日期，股票代码]（面板），columns是因子名称
+    :param weight_series: 样本权重，pandas.Series，index与factor_df相同，None表示等权
+    :param method: 正交化方法，str，symmetric或canonical
+    :param floor: 特征值下限，float，相对于最大特征值的比例
+    :param level: 日期所在的index层级名称，str，None表示factor_df是单个日期的横截面；面板数据全部日期的特征分解批量完成
+    :return: 正交化后的因子数据，pandas.DataFrame，index与factor_df相同，特征值都不低于下限时加权后各列两两正交、加权平方和为1，
+             有空值的样本为空值
+    """
+    f_arr = factor_df.to_numpy(dtype='float64')
+    w_arr = np.ones(len(f_arr)) if weight_series is None else \
+        weight_series.reindex(factor_df.index).to_numpy(dtype='float64')
+    valid = np.isfinite(f_arr).all(axis=1) & np.isfinite(w_arr)
+    date_codes = np.zeros(len(f_arr), dtype='int64') if level is None else \
+        pd.factorize(factor_df.index.get_level_values(level))[0]
+    f_3d, date_pos, row_pos = stack_by_date(np.where(valid[:, None], f_arr, 0.0), date_codes, 0.0)
+    w_2d = stack_by_date(np.where(valid, w_arr, 0.0)[:, None], date_codes, 0.0)[0][..., 0]
+    overlap = np.einsum('dsk,ds,dsj->dkj', f_3d, w_2d, f_3d, optimize=True)
+    eig_value, eig_vector = np.linalg.eigh(overlap)
+    eig_value, eig_vector = eig_value[:, ::-1], eig_vector[:, :, ::-1]
+    keep = eig_value > floor * eig_value[:, :1]
+    if method == 'symmetric':
+        columns = factor_df.columns
+        with np.errstate(invalid='ignore', divide='ignore'):
+            inv_sqrt = 1 / np.sqrt(np.maximum(eig_value, floor * eig_value[:, :1]))
+        transition = (eig_vector * inv_sqrt[:, None, :]) @ np.swapaxes(eig_vector, 1, 2)
+    elif method == 'canonical':
+        n_keep = keep.sum(axis=1).min()
+        columns = ['canonical_%d' % i for i in range(n_keep)]
+        inv_sqrt = np.where(keep, 1 / np.sqrt(np.where(keep, eig_value, 1.0)), 0.0)
+        transition = (eig_vector * inv_sqrt[:, None, :])[:, :, :n_keep]
+    else:
+        raise ValueError('method只能是symmetric或canonical')
+    orth_arr = np.full((len(f_arr), transition.shape[2]), np.nan)
+    orth_arr[valid] = (f_3d @ transition)[date_pos, row_pos][valid]
+    return pd.DataFrame(orth_arr, index=factor_df.index, columns=columns)
@@ -0,0 +1,122 @@
+from numpy.lib.stride_tricks import sliding_window_view
+from tool_kit import pd, np
+
+
+PERFORMANCE_COLUMN_LS = ['annualized_returns', 'max_drawdown', 'sharpe', 'drawdown_duration', 'recovery_time',
+                         'calmar', 'sortino', 'turnover_adj_sharpe']
+
+
+def cal_drawdown(net_value_df):
+    """
+    用累计最大值计算回撤，复杂度O(n)
+    :param net_value_df: 净值序列，pandas.DataFrame/pandas.Series，index是日期，columns是策略名称
+    :return: 回撤序列，与net_value_df结构相同，值<=0
+    """
+    return net_value_df / net_value_df.cummax() - 1
+
+
+def drawdown_stats(net_value_arr):
+    """
+    沿最后一维计算最大回撤、最长回撤持续期和最大回撤的修复时间，可用于(策略数，日期数)的净值矩阵，
+    也可用于(窗口数，策略数，窗口长度)的滚动窗口
+    :param net_value_arr: 净值，numpy.ndarray，最后一维是日期
+    :return: (最大回撤，最长回撤持续期，修复时间)，tuple，元素是numpy.ndarray，shape是net_value_arr去掉最后一维；
+             回撤持续期和修复时间的单位是交易日，最大回撤之后没有回到前高的修复时间为nan
+    """
+    running_max = np.fmax.accumulate(net_value_arr, axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        drawdown = net_value_arr / running_max - 1
+    drawdown = np.where(np.isnan(drawdown), 0.0, drawdown)
+    max_drawdown = -drawdown.min(axis=-1)
+
+    # 回撤持续期：距离最近一次创新高的交易日数，取最大值
+    idx = np.arange(net_value_arr.shape[-1])
+    last_peak = np.maximum.accumulate(np.where(drawdown >= 0, idx, 0), axis=-1)
+    duration = (idx - last_peak).max(axis=-1)
+
+    # 修复时间：最大回撤谷底之后第一次回到谷底前高点所需的交易日数
+    trough = drawdown.argmin(axis=-1)
+    peak_value = np.take_along_axis(running_max, trough[..., None], axis=-1)
+    recovered = (idx > trough[..., None]) & (net_value_arr >= peak_value)
+    recovery = (recovered.argmax(axis=-1) - trough).astype('float64')
+    recovery = np.where(recovered.any(axis=-1), recovery, np.nan)
+    recovery = np.where(max_drawdown == 0, 0.0, recovery)
+    return max_drawdown, duration, recovery
+
+
+def cal_performance(net_value_df, turnover_df=None, cost_rate=0.0, period=252):
+    """
+    向量化计算多策略回测指标
+    :param net_value_df: 净值序列，pandas.DataFrame，index是日期，columns是策略名称
+    :param turnover_df: 双边换手率，pandas.DataFrame，index是日期，columns是策略名称，None表示不考虑换手
+    :param cost_rate: 单位换手的交易成本，float，用于计算turnover_adj_sharpe
+    :param period: 年化周期数，int
+    :return: 回测指标，pandas.DataFrame，index是策略名称，columns是PERFORMANCE_COLUMN_LS
+    """
+    if isinstance(net_value_df, pd.Series):
+        net_value_df = net_value_df.to_frame()
+    annual_return = net_value_df.iloc[-1, :] ** (float(period) / len(net_value_df)) - 1
+    max_drawdown, duration, recovery = drawdown_stats(net_value_df.to_numpy(dtype='float64').T)
+    max_drawdown = pd.Series(max_drawdown, index=net_value_df.columns)
+    daily_ret_df = net_value_df.pct_change().fillna(0)
+    sharpe_ratio = daily_ret_df.mean() / daily_ret_df.std() * (period ** 0.5)
+    downside = np.sqrt((daily_ret_df.clip(upper=0) ** 2).mean())
+    sortino_ratio = daily_ret_df.mean() / downside * (period ** 0.5)
+    if turnover_df is None:
+        net_ret_df = daily_ret_df
+    else:
+        net_ret_df = daily_ret_df - turnover_df.reindex_like(daily_ret_df).fillna(0) * cost_rate
+    indicator_df = pd.DataFrame({'annualized_returns': annual_return,
+                                 'max_drawdown': max_drawdown,
+                                 'sharpe': sharpe_ratio,
+                                 'drawdown_duration': duration,
+                                 'recovery_time': recovery,
+                                 'calmar': annual_return / max_drawdown,
+                                 'sortino': sortino_ratio,
+                                 'turnover_adj_sharpe': net_ret_df.mean() / net_ret_df.std() * (period ** 0.5)},
+                                index=net_value_df.columns)
+    return indicator_df[PERFORMANCE_COLUMN_LS]
+
+
+def cal_rolling_performance(net_value_df, window=252, turnover_df=None, cost_rate=0.0, period=252, chunk_size=32):
+    """
+    滚动窗口回测指标，收益类指标用rolling均值和标准差计算，回撤类指标在滑动窗口视图上按策略分块计算
+    :param net_value_df: 净值序列，pandas.DataFrame，index是日期，columns是策略名称
+    :param window: 窗口长度，int，单位为交易日
+    :param turnover_df: 双边换手率，pandas.DataFrame，index是日期，columns是策略名称，None表示不考虑换手
+    :param cost_rate: 单位换手的交易成本，float
+    :param period: 年化周期数，int
+    :param chunk_size: 每次计算回撤类指标的策略数量，int，用于控制滑动窗口的内存占用
+    :return: 滚动回测指标，dict，key是PERFORMANCE_COLUMN_LS中的指标名称，value是pandas.DataFrame，
+             index是日期（窗口结束日期），columns是策略名称，前window-1个日期为nan
+    """
+    if isinstance(net_value_df, pd.Series):
+        net_value_df = net_value_df.to_frame()
+    daily_ret_df = net_value_df.pct_change().fillna(0)
+    annual_return = (net_value_df / net_value_df.shift(window - 1)) ** (float(period) / window) - 1
+    ret_mean = daily_ret_df.rolling(window).mean()
+    downside = np.sqrt((daily_ret_df.clip(upper=0) ** 2).rolling(window).mean())
+    if turnover_df is None:
+        net_ret_df = daily_ret_df
+    else:
+        net_ret_df = daily_ret_df - turnover_df.reindex_like(daily_ret_df).fillna(0) * cost_rate
+
+    n_dates, n_cols = net_value_df.shape
+    result_arr = np.full((3, n_dates, n_cols), np.nan)
+    if n_dates >= window:
+        value_arr = net_value_df.to_numpy(dtype='float64')
+        for i in range(0, n_cols, chunk_size):
+            # window_arr的shape是(窗口数，策略数，窗口长度)，是value_arr上的视图
+            window_arr = sliding_window_view(value_arr[:, i:i + chunk_size], window, axis=0)
+            for j, stat in enumerate(drawdown_stats(window_arr)):
+                result_arr[j, window - 1:, i:i + chunk_size] = stat
+    max_drawdown, duration, recovery = [pd.DataFrame(arr, index=net_value_df.index, columns=net_value_df.columns)
+                                        for arr in result_arr]
+    return {'annualized_returns': annual_return,
+            'max_drawdown': max_drawdown,
+            'sharpe': ret_mean / daily_ret_df.rolling(window).std() * (period ** 0.5),
+            'drawdown_duration': duration,
+            'recovery_time': recovery,
+            'calmar': annual_return / max_drawdown,
+            'sortino': ret_mean / downside * (period ** 0.5),
+            'turnover_adj_sharpe': net_ret_df.rolling(window).mean() / net_ret_df.rolling(window).std() * (period ** 0.5)}
@@ -0,0 +1,116 @@
+from tool_kit import pd, np
+
+
+COST_COLUMN_LS = ['buy', 'sell', 'turnover', 'cost']
+
+
+def cal_turnover_array(weight_arr, return_arr=None):
+    """
+    由相邻两天的持仓权重计算买入和卖出换手，对所有日期（以及所有组合）同时计算
+    :param weight_arr: 持仓权重，numpy.ndarray，shape是(日期数，股票数)或(组合数，日期数，股票数)，
+                       T日的权重是T日持有、承担T日收益的权重，nan视为0，第一天之前视为空仓
+    :param return_arr: 收益率矩阵，numpy.ndarray，shape与weight_arr相同，不为None时调仓前的权重是上一天权重按上一天收益
+                       漂移后的权重（未持仓部分视为现金），None表示调仓前的权重就是上一天的权重
+    :return: (买入换手，卖出换手)，tuple，元素是numpy.ndarray，shape是weight_arr去掉最后一维
+    """
+    weight_arr = np.nan_to_num(np.asarray(weight_arr, dtype='float64'))
+    pre_weight_arr = np.zeros_like(weight_arr)
+    pre_weight_arr[..., 1:, :] = weight_arr[..., :-1, :]
+    if return_arr is not None:
+        pre_return_arr = np.zeros_like(weight_arr)
+        pre_return_arr[..., 1:, :] = np.nan_to_num(np.asarray(return_arr, dtype='float64')[..., :-1, :])
+        grow_arr = pre_weight_arr * (1 + pre_return_arr)
+        pre_weight_arr = grow_arr / (1 + (pre_weight_arr * pre_return_arr).sum(axis=-1, keepdims=True))
+    diff_arr = weight_arr - pre_weight_arr
+    return np.clip(diff_arr, 0, None).sum(axis=-1), np.clip(-diff_arr, 0, None).sum(axis=-1)
+
+
+def cal_trade_cost_array(buy_arr, sell_arr, commission=0.0003, stamp_duty=0.001, slippage=0.0):
+    """
+    :param buy_arr: 买入换手，numpy.ndarray
+    :param sell_arr: 卖出换手，numpy.ndarray，shape与buy_arr相同
+    :param commission: 双边佣金费率，float
+    :param stamp_duty: 印花税税率，float，只对卖出收取
+    :param slippage: 双边滑点，float
+    :return: 交易成本，numpy.ndarray，shape与buy_arr相同，单位与收益率相同
+    """
+    return (buy_arr + sell_arr) * (commission + slippage) + sell_arr * stamp_duty
+
+
+def cal_trade_cost(weight_df, return_df=None, commission=0.0003, stamp_duty=0.001, slippage=0.0):
+    """
+    计算组合每天的换手和交易成本
+    :param weight_df: 持仓权重，pandas.DataFrame，index是日期，columns是股票代码，T日的权重是承担T日收益的权重
+    :param return_df: 收益率矩阵，pandas.DataFrame，None表示不考虑权重漂移，见cal_turnover_array
+    :param commission: 双边佣金费率，float
+    :param stamp_duty: 印花税税率，float，只对卖出收取
+    :param slippage: 双边滑点，float
+    :return: 换手和交易成本，pandas.DataFrame，index是日期，columns是COST_COLUMN_LS，turnover是双边换手
+    """
+    return_arr = None if return_df is None else return_df.reindex_like(weight_df).to_numpy(dtype='float64')
+    buy_arr, sell_arr = cal_turnover_array(weight_df.to_numpy(dtype='float64'), return_arr)
+    cost_arr = cal_trade_cost_array(buy_arr, sell_arr, commission, stamp_duty, slippage)
+    return pd.DataFrame({'buy': buy_arr, 'sell': sell_arr, 'turnover': buy_arr + sell_arr, 'cost': cost_arr},
+                        index=weight_df.index)[COST_COLUMN_LS]
+
+
+def cal_net_value(return_df, cost_df):
+    """
+    扣除交易成本后的净值，T日的收益减去T日调仓的成本
+    :param return_df: 收益率，pandas.DataFrame/pandas.Series，index是日期
+    :param cost_df: 交易成本，结构与return_df相同
+    :return: 扣费净值，结构与return_df相同
+    """
+    return (return_df - cost_df.reindex_like(return_df).fillna(0) + 1).cumprod()
+
+
+def simulate_position(target_arr, return_arr, rebalance_arr, suspended_arr=None, normalize=True):
+    """
+    持仓模拟，调仓日按目标权重调仓，两次调仓之间持仓按每天的收益漂移；调仓日停牌的持仓无法交易，按漂移后的权重保留。
+    只在调仓日之间循环，每段内的漂移用累计收益一次向量化计算
+    :param target_arr: 目标权重，numpy.ndarray，shape是(日期数，股票数)，只使用调仓日的行，nan表示不持有
+    :param return_arr: 收益率矩阵，numpy.ndarray，shape与target_arr相同，T日的收益作用于T-1日收盘后的持仓，
+                       收益为nan的持仓从当天起不再持有
+    :param rebalance_arr: 是否为调仓日，numpy.ndarray，shape是(日期数，)，bool，第一天必须是调仓日
+    :param suspended_arr: 停牌矩阵，numpy.ndarray，shape与target_arr相同，bool，None表示不考虑停牌
+    :param normalize: 是否满仓，bool，True表示权重每天归一化，调仓日停牌持仓之外的仓位按目标权重的比例分配；
+                      False表示目标权重之外的部分为现金，收益为0，调仓日可交易的股票直接调整到目标权重
+    :return: (持仓权重，组合收益，买入换手，卖出换手)，tuple，持仓权重是每天收盘调仓后的权重，shape与target_arr相同，
+             nan表示不持有；组合收益、买入换手和卖出换手的shape是(日期数，)，T日的换手是T日收盘调仓产生的换手，
+             第一天的组合收益为0，买入换手为建仓的仓位
+    """
+    target_arr = np.asarray(target_arr, dtype='float64')
+    return_arr = np.asarray(return_arr, dtype='float64')
+    rebalance_loc = np.flatnonzero(rebalance_arr)
+    if len(rebalance_loc) == 0 or rebalance_loc[0] != 0:
+        raise ValueError('the first date must be a rebalance date')
+
+    def drift(weight, growth):
+        # 按累计收益漂移后的权重，满仓时除以持仓总市值，否则除以包括现金在内的组合总市值
+        value = weight * growth
+        if normalize:
+            return value / np.nansum(value, axis=-1, keepdims=True)
+        return value / (1 + np.nansum(value - weight, axis=-1, keepdims=True))
+
+    n_dates = target_arr.shape[0]
+    weight_arr = np.full(target_arr.shape, np.nan)
+    drift_arr = np.full(target_arr.shape, np.nan)
+    bound_ls = rebalance_loc.tolist() + [n_dates]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for start, end in zip(bound_ls[:-1], bound_ls[1:]):
+            target = target_arr[start]
+            if start > 0:
+                # 调仓日先按当天收益漂移，停牌的持仓保留漂移后的权重，满仓时剩余仓位按目标权重的比例分配
+                drift_arr[start] = drift(weight_arr[start - 1], 1 + return_arr[start])
+                suspended = np.zeros(target.shape, dtype=bool) if suspended_arr is None else suspended_arr[start]
+                carry = np.asarray(suspended, dtype=bool) & ~np.isnan(drift_arr[start])
+                trading_weight = np.nansum(np.where(carry, np.nan, drift_arr[start])) if normalize else 1.0
+                target = np.where(carry, drift_arr[start], target * trading_weight)
+            weight_arr[start] = target / np.nansum(target) if normalize else target
+            if end - start > 1:
+                weight_arr[start + 1:end] = drift(weight_arr[start], np.cumprod(1 + return_arr[start + 1:end], axis=0))
+                drift_arr[start + 1:end] = weight_arr[start + 1:end]
+    portfolio_return_arr = np.zeros(n_dates)
+    portfolio_return_arr[1:] = np.nansum(weight_arr[:-1] * return_arr[1:], axis=1)
+    diff_arr = np.nan_to_num(weight_arr) - np.nan_to_num(drift_arr)
+    return weight_arr, portfolio_return_arr, np.clip(diff_arr, 0, None).sum(axis=1), np.clip(-diff_arr, 0, None).sum(axis=1)
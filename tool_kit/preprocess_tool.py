@@ -0,0 +1,286 @@
+from tool_kit import pd, np
+
+
+def stack_by_date(arr, date_codes, fill_value=np.nan):
+    """
+    把按日期分组的二维数组补齐成(日期数，最大股票数，列数)的三维数组
+    :param arr: 二维数组，numpy.ndarray，shape是(样本数，列数)
+    :param date_codes: 每个样本的日期编号，numpy.ndarray，取值为0到日期数-1
+    :param fill_value: 补齐位置的值，float
+    :return: (三维数组，样本的日期编号，样本在日期内的位置)，tuple，arr[i]对应三维数组[date_pos[i], row_pos[i]]
+    """
+    order = np.argsort(date_codes, kind='stable')
+    counts = np.bincount(date_codes)
+    row_pos = np.empty(len(date_codes), dtype=int)
+    row_pos[order] = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    arr_3d = np.full((len(counts), counts.max() if len(counts) != 0 else 0, arr.shape[1]), fill_value)
+    arr_3d[date_codes, row_pos] = arr
+    return arr_3d, date_codes, row_pos
+
+
+def sorted_quantile(sorted_arr, count, q):
+    """
+    在已排序（空值排在最后）的数组上按线性插值计算分位数，与pandas.quantile的默认方法一致
+    :param sorted_arr: 沿倒数第二维排序后的数组，numpy.ndarray，shape是(..., 股票数，因子数)
+    :param count: 每个横截面的有效样本数，numpy.ndarray，shape是(..., 因子数)
+    :param q: 分位点，float
+    :return: 分位数，numpy.ndarray，shape是(..., 因子数)，没有有效样本的横截面为空值
+    """
+    pos = (count - 1) * q
+    lo = np.clip(np.floor(pos).astype(int), 0, None)
+    hi = np.clip(np.ceil(pos).astype(int), 0, None)
+    lo_value = np.take_along_axis(sorted_arr, lo[..., None, :], axis=-2)[..., 0, :]
+    hi_value = np.take_along_axis(sorted_arr, hi[..., None, :], axis=-2)[..., 0, :]
+    return np.where(count > 0, lo_value + (hi_value - lo_value) * (pos - lo), np.nan)
+
+
+def winsorize_array(arr, method='mad', multi=3.0, quantile=(0.01, 0.99)):
+    """
+    横截面去极值的矩阵计算，沿倒数第二维（股票）计算边界，所有横截面和所有因子一次计算，空值不参与计算且保持为空值
+    :param arr: 因子值数组，numpy.ndarray，shape是(股票数，因子数)或(日期数，股票数，因子数)
+    :param method: 去极值方法，str，mad是中位数±multi倍MAD，sigma是均值±multi倍标准差，percentile是按quantile分位数截断
+    :param multi: 偏离倍数，int/float，method为mad和sigma时使用
+    :param quantile: 上下分位点，tuple，method为percentile时使用
+    :return: (去极值后的数组，下边界截断数量，上边界截断数量)，tuple，截断数量的shape是arr去掉倒数第二维
+    """
+    arr = np.asarray(arr, dtype='float64')
+    count = np.isfinite(arr).sum(axis=-2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'mad':
+            median = sorted_quantile(np.sort(arr, axis=-2), count, 0.5)
+            mad = sorted_quantile(np.sort(np.abs(arr - median[..., None, :]), axis=-2), count, 0.5)
+            lower, upper = median - multi * mad, median + multi * mad
+        elif method == 'sigma':
+            mean = np.nansum(arr, axis=-2) / count
+            std = np.sqrt(np.nansum((arr - mean[..., None, :]) ** 2, axis=-2) / (count - 1))
+            lower, upper = mean - multi * std, mean + multi * std
+        elif method == 'percentile':
+            sorted_arr = np.sort(arr, axis=-2)
+            lower, upper = sorted_quantile(sorted_arr, count, quantile[0]), sorted_quantile(sorted_arr, count, quantile[1])
+        else:
+            raise ValueError('method must be mad, sigma or percentile')
+        lower_hit = arr < lower[..., None, :]
+        upper_hit = arr > upper[..., None, :]
+    result = np.where(lower_hit, lower[..., None, :], np.where(upper_hit, upper[..., None, :], arr))
+    return result, lower_hit.sum(axis=-2), upper_hit.sum(axis=-2)
+
+
+def winsorize(factor_df, method='mad', multi=3.0, quantile=(0.01, 0.99), level=None, chunk_size=100):
+    """
+    去极值，可用于单日横截面，也可用于按日期分组的[日期，股票代码]面板，面板数据补齐成三维数组后每chunk_size个日期一次计算
+    :param factor_df: 因子数据，pandas.DataFrame，index是股票代码或[日期，股票代码]，columns是因子名称
+    :param method: 去极值方法，str，mad/sigma/percentile，含义同winsorize_array
+    :param multi: 偏离倍数，int/float
+    :param quantile: 上下分位点，tuple
+    :param level: 面板数据中日期所在的index层级名称，str，None表示factor_df是单日横截面
+    :param chunk_size: 面板数据每次计算的日期数量，int，用于控制内存占用
+    :return: (去极值后的因子数据，截断数量)，tuple
+             截断数量是pandas.DataFrame，index是因子名称，columns是[lower, upper, total]
+    """
+    value_arr = factor_df.to_numpy(dtype='float64')
+    if level is None:
+        result_arr, lower_count, upper_count = winsorize_array(value_arr, method, multi, quantile)
+    else:
+        date_codes = pd.factorize(factor_df.index.get_level_values(level))[0]
+        result_arr = np.empty(value_arr.shape)
+        lower_count = np.zeros(value_arr.shape[1], dtype=int)
+        upper_count = np.zeros(value_arr.shape[1], dtype=int)
+        for s in range(0, date_codes.max() + 1 if len(date_codes) != 0 else 0, chunk_size):
+            rows = np.flatnonzero((date_codes >= s) & (date_codes < s + chunk_size))
+            arr_3d, date_pos, row_pos = stack_by_date(value_arr[rows], date_codes[rows] - s)
+            clip_3d, lower_3d, upper_3d = winsorize_array(arr_3d, method, multi, quantile)
+            result_arr[rows] = clip_3d[date_pos, row_pos]
+            lower_count += lower_3d.sum(axis=0)
+            upper_count += upper_3d.sum(axis=0)
+    count_df = pd.DataFrame({'lower': lower_count, 'upper': upper_count}, index=factor_df.columns)
+    count_df['total'] = count_df['lower'] + count_df['upper']
+    return pd.DataFrame(result_arr, index=factor_df.index, columns=factor_df.columns), count_df
+
+
+def panel_del_extremum(factor_df, multi=3.0, level='date', method='mad', quantile=(0.01, 0.99)):
+    """
+    面板数据按日期横截面去极值，默认超出[中位数-multi*MAD, 中位数+multi*MAD]的值截断到边界
+    :param factor_df: 因子面板数据，pandas.DataFrame，index是[日期，股票代码]，columns是因子名称
+    :param multi: 偏离倍数，int/float
+    :param level: 日期所在的index层级名称，str
+    :param method: 去极值方法，str，mad/sigma/percentile
+    :param quantile: 上下分位点，tuple，method为percentile时使用
+    :return: (去极值后的因子面板数据，截断数量)，tuple，含义同winsorize
+    """
+    return winsorize(factor_df, method, multi, quantile, level)
+
+
+def group_statistic(factor_df, keys, method='mean', weight_series=None):
+    """
+    全部因子列的分组统计量，一次groupby完成
+    :param factor_df: 因子数据，pandas.DataFrame，columns是因子名称
+    :param keys: 分组键，list，元素是与factor_df等长的数组
+    :param method: 统计方法，str，mean是等权均值，median是中位数，cap_weighted是按weight_series加权的均值
+    :param weight_series: 加权权重（如流通市值），pandas.Series，index与factor_df相同，method为cap_weighted时使用
+    :return: (按原样本对齐的统计量，分组统计量)，tuple，都是pandas.DataFrame，columns是因子名称
+    """
+    if method in ['mean', 'median']:
+        grouped = factor_df.groupby(keys)
+        return grouped.transform(method), grouped.agg(method)
+    elif method == 'cap_weighted':
+        weight_arr = weight_series.reindex(factor_df.index).to_numpy(dtype='float64')[:, None]
+        valid_weight_df = factor_df.notna() * weight_arr
+        weighted_sum = (factor_df * weight_arr).groupby(keys).sum(min_count=1)
+        weight_sum = valid_weight_df.groupby(keys).sum().replace(0, np.nan)
+        agg_df = weighted_sum / weight_sum
+        transform_df = (factor_df * weight_arr).groupby(keys).transform('sum') / \
+            valid_weight_df.groupby(keys).transform('sum').replace(0, np.nan)
+        return transform_df.where(factor_df.groupby(keys).transform('count') > 0), agg_df
+    else:
+        raise ValueError('method must be mean, median or cap_weighted')
+
+
+def fill_nan_by_group(factor_df, group_series, method='mean', weight_series=None, market_fallback=False, level=None):
+    """
+    按分组（如行业）统计量填空值，全部因子列一次groupby-transform完成，可用于单日横截面，也可用于[日期，股票代码]面板
+    :param factor_df: 因子数据，pandas.DataFrame，index是股票代码或[日期，股票代码]，columns是因子名称
+    :param group_series: 分组代码，pandas.Series或list，index与factor_df相同，为list时依次用各级分组填充（如二级行业、一级行业），
+                         分组代码为空值的样本不参与该级填充
+    :param method: 统计方法，str，mean是等权均值，median是中位数，cap_weighted是按weight_series加权的均值
+    :param weight_series: 加权权重（如流通市值），pandas.Series，index与factor_df相同，method为cap_weighted时使用
+    :param market_fallback: 各级分组填充后仍为空值时，是否用全市场（面板数据为当日全市场）统计量填充，bool
+    :param level: 面板数据中日期所在的index层级名称，str，None表示factor_df是单日横截面
+    :return: (填空值后的因子数据，第一级分组统计量)，tuple
+             第一级分组统计量是pandas.DataFrame，index是分组代码（面板数据为[日期，分组代码]），columns是因子名称
+    """
+    if isinstance(group_series, pd.Series):
+        group_series = [group_series]
+    date_key = [] if level is None else [factor_df.index.get_level_values(level)]
+    result_df = factor_df
+    group_stat_df = pd.DataFrame()
+    for i, one_group in enumerate(group_series):
+        keys = date_key + [one_group.reindex(factor_df.index).values]
+        transform_df, agg_df = group_statistic(factor_df, keys, method, weight_series)
+        if i == 0:
+            agg_df.index.set_names(([level] if level is not None else []) + [one_group.name], inplace=True)
+            group_stat_df = agg_df
+        result_df = result_df.fillna(transform_df)
+    if market_fallback:
+        keys = date_key if level is not None else [np.zeros(len(factor_df), dtype=int)]
+        result_df = result_df.fillna(group_statistic(factor_df, keys, method, weight_series)[0])
+    return result_df, group_stat_df
+
+
+def panel_fill_nan(factor_df, group_series, level='date', method='mean', weight_series=None, market_fallback=False):
+    """
+    面板数据按日期和分组（如行业）的横截面统计量填空值，参数含义同fill_nan_by_group
+    :param factor_df: 因子面板数据，pandas.DataFrame，index是[日期，股票代码]，columns是因子名称
+    :param group_series: 分组代码，pandas.Series或list，index与factor_df相同
+    :param level: 日期所在的index层级名称，str
+    :param method: 统计方法，str，mean/median/cap_weighted
+    :param weight_series: 加权权重，pandas.Series，index与factor_df相同
+    :param market_fallback: 分组填充后仍为空值时，是否用当日全市场统计量填充，bool
+    :return: (填空值后的因子面板数据，分组统计量)，tuple
+             分组统计量是pandas.DataFrame，index是[日期，分组代码]，columns是因子名称
+    """
+    return fill_nan_by_group(factor_df, group_series, method, weight_series, market_fallback, level)
+
+
+def panel_standardize(factor_df, level='date'):
+    """
+    面板数据按日期横截面等权标准化
+    :param factor_df: 因子面板数据，pandas.DataFrame，index是[日期，股票代码]，columns是因子名称
+    :param level: 日期所在的index层级名称，str
+    :return: 标准化后的因子面板数据，pandas.DataFrame，结构与factor_df相同
+    """
+    grouped = factor_df.groupby(level=level)
+    return (factor_df - grouped.transform('mean')) / grouped.transform('std')
+
+
+def neutralize_array(y_arr, x_arr, weight_arr=None, ridge=0.0):
+    """
+    横截面回归中性化的矩阵计算，解释变量矩阵只分解一次，全部因子列作为多因变量一次求解，回归不含常数项
+    因变量有空值的列按空值位置分组求解，解释变量或权重有空值的样本不参与回归，残差为空值
+    :param y_arr: 因变量矩阵，numpy.ndarray，shape是(股票数，因子数)
+    :param x_arr: 解释变量矩阵，numpy.ndarray，shape是(股票数，解释变量数)
+    :param weight_arr: 回归权重，numpy.ndarray，shape是(股票数,)，None表示OLS
+    :param ridge: 岭回归惩罚系数，float，0表示不做岭回归
+    :return: (残差矩阵，回归系数矩阵)，tuple，shape分别是(股票数，因子数)和(解释变量数，因子数)
+    """
+    y_arr = np.asarray(y_arr, dtype='float64')
+    x_arr = np.asarray(x_arr, dtype='float64')
+    if y_arr.ndim == 1:
+        y_arr = y_arr[:, None]
+    sqrt_w = np.ones(len(x_arr)) if weight_arr is None else np.sqrt(np.asarray(weight_arr, dtype='float64'))
+    x_valid = np.isfinite(x_arr).all(axis=1) & np.isfinite(sqrt_w)
+    resid_arr = np.full(y_arr.shape, np.nan)
+    beta_arr = np.full((x_arr.shape[1], y_arr.shape[1]), np.nan)
+    y_valid = np.isfinite(y_arr) & x_valid[:, None]
+    # 空值位置相同的因子列共用一次分解
+    pattern_arr, pattern_id = np.unique(y_valid, axis=1, return_inverse=True)
+    for i in range(pattern_arr.shape[1]):
+        rows, cols = pattern_arr[:, i], np.flatnonzero(pattern_id.ravel() == i)
+        if rows.sum() == 0:
+            continue
+        xw = x_arr[rows] * sqrt_w[rows, None]
+        yw = y_arr[np.ix_(rows, cols)] * sqrt_w[rows, None]
+        if ridge > 0:
+            beta = np.linalg.solve(xw.T @ xw + ridge * np.eye(xw.shape[1]), xw.T @ yw)
+        else:
+            beta = np.linalg.lstsq(xw, yw, rcond=None)[0]
+        beta_arr[:, cols] = beta
+        resid_arr[np.ix_(x_valid, cols)] = y_arr[np.ix_(x_valid, cols)] - x_arr[x_valid] @ beta
+    resid_arr[~np.isfinite(y_arr)] = np.nan
+    return resid_arr, beta_arr
+
+
+def neutralize_cross_section(factor_df, exposure_df, weight_series=None, ridge=0.0):
+    """
+    单个日期横截面中性化，全部因子一次求解
+    :param factor_df: 因子数据，pandas.DataFrame，index是股票代码，columns是因子名称
+    :param exposure_df: 中性化的解释变量，pandas.DataFrame，index是股票代码，columns是[对数市值，行业虚拟变量]
+    :param weight_series: 回归权重，pandas.Series，index是股票代码，None表示OLS
+    :param ridge: 岭回归惩罚系数，float，0表示不做岭回归
+    :return: 中性化后的因子数据（回归残差），pandas.DataFrame，结构与factor_df相同
+    """
+    weight_arr = None if weight_series is None else weight_series.reindex(factor_df.index).to_numpy(dtype='float64')
+    resid_arr = neutralize_array(factor_df.to_numpy(dtype='float64'), exposure_df.reindex(factor_df.index).to_numpy(
+        dtype='float64'), weight_arr, ridge)[0]
+    return pd.DataFrame(resid_arr, index=factor_df.index, columns=factor_df.columns)
+
+
+def panel_neutralize(factor_df, exposure_df, weight_series=None, ridge=0.0, stacked=False, chunk_size=250,
+                     level='date'):
+    """
+    面板数据按日期横截面回归中性化
+    :param factor_df: 因子面板数据，pandas.DataFrame，index是[日期，股票代码]，columns是因子名称
+    :param exposure_df: 中性化的解释变量，pandas.DataFrame，index与factor_df相同，columns是[对数市值，行业虚拟变量]
+    :param weight_series: 回归权重，pandas.Series，index与factor_df相同，None表示OLS
+    :param ridge: 岭回归惩罚系数，float，0表示不做岭回归
+    :param stacked: 是否把全部日期堆叠成(日期数，股票数，解释变量数)的数组，用批量正规方程一次求解所有日期，
+                    因子或解释变量有空值的样本不参与回归，适合日期很多、每个日期股票数相近的面板
+    :param chunk_size: 堆叠模式下每次求解的日期数量，int
+    :param level: 日期所在的index层级名称，str
+    :return: 中性化后的因子面板数据（回归残差），pandas.DataFrame，结构与factor_df相同，解释变量有空值的样本为空值
+    """
+    y_arr = factor_df.to_numpy(dtype='float64')
+    x_arr = exposure_df.reindex(factor_df.index).to_numpy(dtype='float64')
+    w_arr = np.ones(len(y_arr)) if weight_series is None else \
+        weight_series.reindex(factor_df.index).to_numpy(dtype='float64')
+    if not stacked:
+        resid_arr = np.full(y_arr.shape, np.nan)
+        for date, loc in factor_df.groupby(level=level).indices.items():
+            resid_arr[loc] = neutralize_array(y_arr[loc], x_arr[loc], w_arr[loc], ridge)[0]
+        return pd.DataFrame(resid_arr, index=factor_df.index, columns=factor_df.columns)
+
+    # 堆叠模式：按日期补齐成三维数组，补齐位置和空值样本的权重为0，每次堆叠chunk_size个日期以控制内存
+    date_codes, date_ls = pd.factorize(factor_df.index.get_level_values(level))
+    valid = np.isfinite(x_arr).all(axis=1) & np.isfinite(y_arr).all(axis=1) & np.isfinite(w_arr)
+    resid_arr = np.full(y_arr.shape, np.nan)
+    for s in range(0, len(date_ls), chunk_size):
+        rows = np.flatnonzero((date_codes >= s) & (date_codes < s + chunk_size))
+        x_3d, date_pos, row_pos = stack_by_date(np.where(valid[rows, None], x_arr[rows], 0.0), date_codes[rows] - s, 0.0)
+        y_3d = stack_by_date(np.where(valid[rows, None], y_arr[rows], 0.0), date_codes[rows] - s, 0.0)[0]
+        w_3d = stack_by_date(np.where(valid[rows], w_arr[rows], 0.0)[:, None], date_codes[rows] - s, 0.0)[0][..., 0]
+        xtw = np.swapaxes(x_3d * w_3d[..., None], 1, 2)
+        xtx = xtw @ x_3d + ridge * np.eye(x_arr.shape[1])
+        # 不做岭回归时，某日缺失的行业虚拟变量使xtx奇异，用伪逆得到与lstsq相同的最小范数解
+        beta_3d = (np.linalg.pinv(xtx) if ridge == 0 else np.linalg.inv(xtx)) @ (xtw @ y_3d)
+        resid_arr[rows] = y_arr[rows] - np.einsum('nk,nkf->nf', x_arr[rows], beta_3d[date_pos])
+    resid_arr[~(np.isfinite(x_arr).all(axis=1)[:, None] & np.isfinite(y_arr))] = np.nan
+    return pd.DataFrame(resid_arr, index=factor_df.index, columns=factor_df.columns)
@@ -0,0 +1,400 @@
+import os
+import json
+from functools import lru_cache
+from tool_kit import db_zcs, pd, np
+from tool_kit.date_N_time import gen_trade_date, gen_last_trade_date
+
+
+PRICE_STORE_PATH = os.environ.get('ZCS_PRICE_STORE', os.path.join(os.path.expanduser('~'), '.zcs_price_store'))
+PRICE_FIELD_DT = {'close': 'float64', 'adj_factor': 'float64', 'volume': 'float64',
+                  'open': 'float32', 'high': 'float32', 'low': 'float32'}
+CODE_CAPACITY_STEP = 512
+ADJUSTED_PRICE_CACHE = {}
+
+
+class PriceStore(object):
+    """
+    ts_daily_adj_factor的本地列式价格库，每个字段存为一个按日期行优先排列的稠密矩阵文件（日期×股票代码），
+    读取时用numpy.memmap做内存映射，按日期区间切片不复制数据
+    目录结构：meta.json记录日期、股票代码、字段类型和列容量，<字段名>.bin是对应字段的原始二进制矩阵
+    :param path: 本地价格库目录，str
+    :param coll: 数据库变量，被连接的document为ts_daily_adj_factor
+    """
+    def __init__(self, path=PRICE_STORE_PATH, coll=None):
+        self.path = path
+        self.coll = db_zcs.ts_daily_adj_factor if coll is None else coll
+        self.dates = np.array([], dtype=str)
+        self.codes = pd.Index([], dtype=object)
+        self.field_dt = {}
+        self.capacity = 0
+        self.matrix_dt = {}
+        self.meta_mtime = None
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.path, 'meta.json')
+
+    def field_path(self, field):
+        return os.path.join(self.path, '%s.bin' % field)
+
+    def exists(self):
+        """
+        :return: 本地价格库是否已经建立，bool
+        """
+        return os.path.exists(self.meta_path)
+
+    def refresh(self):
+        """
+        meta.json有更新时（如其他进程完成了同步）重新读取元数据并重新映射字段文件
+        """
+        if not self.exists():
+            return self
+        mtime = os.path.getmtime(self.meta_path)
+        if mtime != self.meta_mtime:
+            self.load()
+        return self
+
+    def load(self):
+        """
+        读取元数据，并以只读方式内存映射每个字段文件
+        self.dates: 已存储的交易日，numpy.ndarray，升序
+        self.codes: 已存储的股票代码，pandas.Index，顺序即矩阵列顺序
+        self.matrix_dt: 字段矩阵，dict，key是字段名称，value是numpy.memmap，shape是(日期数，列容量)
+        """
+        with open(self.meta_path, 'r') as f:
+            meta = json.load(f)
+        self.meta_mtime = os.path.getmtime(self.meta_path)
+        self.dates = np.array(meta['dates'], dtype=str)
+        self.codes = pd.Index(meta['codes'], dtype=object)
+        self.field_dt = meta['fields']
+        self.capacity = meta['capacity']
+        self.matrix_dt = {}
+        for field, dtype in self.field_dt.items():
+            shape = (len(self.dates), self.capacity)
+            if shape[0] * shape[1] == 0:
+                self.matrix_dt[field] = np.empty(shape, dtype=dtype)
+            else:
+                self.matrix_dt[field] = np.memmap(self.field_path(field), dtype=dtype, mode='r', shape=shape)
+        return self
+
+    def write_meta(self):
+        """
+        原子写入元数据，先写临时文件再替换，字段文件的追加写入总是在元数据更新之前完成
+        """
+        meta = {'dates': self.dates.tolist(), 'codes': self.codes.tolist(), 'fields': self.field_dt,
+                'capacity': self.capacity}
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+        self.meta_mtime = os.path.getmtime(self.meta_path)
+
+    def grow_capacity(self, n_codes):
+        """
+        列容量不足时按CODE_CAPACITY_STEP扩容，重写每个字段文件，新增的列填充nan
+        :param n_codes: 需要容纳的股票数量，int
+        """
+        new_capacity = (n_codes // CODE_CAPACITY_STEP + 1) * CODE_CAPACITY_STEP
+        n_dates = len(self.dates)
+        for field, dtype in self.field_dt.items():
+            new_matrix = np.full((n_dates, new_capacity), np.nan, dtype=dtype)
+            if n_dates * self.capacity > 0:
+                old_matrix = np.memmap(self.field_path(field), dtype=dtype, mode='r', shape=(n_dates, self.capacity))
+                new_matrix[:, :self.capacity] = old_matrix
+                del old_matrix
+            new_matrix.tofile(self.field_path(field) + '.tmp')
+        for field in self.field_dt:
+            os.replace(self.field_path(field) + '.tmp', self.field_path(field))
+        self.capacity = new_capacity
+        self.write_meta()
+
+    def sync(self, s_date='2014-01-01', e_date=None, batch_days=20, field_dt=None):
+        """
+        增量同步，把本地价格库最后一个交易日之后的数据从ts_daily_adj_factor追加到字段文件末尾
+        :param s_date: 本地价格库为空时的建库开始日期，str，"%Y-%m-%d"
+        :param e_date: 同步结束日期，str，"%Y-%m-%d"，None表示同步至gen_last_trade_date
+        :param batch_days: 每次查询的交易日数量，int
+        :param field_dt: 建库字段及存储类型，dict，None表示PRICE_FIELD_DT，只在本地价格库为空时生效
+        :return: 本次追加的交易日数量，int
+        """
+        if self.exists():
+            self.load()
+        else:
+            os.makedirs(self.path, exist_ok=True)
+            self.field_dt = dict(PRICE_FIELD_DT if field_dt is None else field_dt)
+            for field in self.field_dt:
+                open(self.field_path(field), 'wb').close()
+            self.write_meta()
+        if e_date is None:
+            e_date = gen_last_trade_date()
+        if len(self.dates) != 0:
+            s_date = self.dates[-1]
+        new_date_ls = [date for date in gen_trade_date(s_date, e_date) if len(self.dates) == 0 or date > s_date]
+
+        # 丢弃上次同步中断时写入了数据但没有写入元数据的部分
+        for field, dtype in self.field_dt.items():
+            os.truncate(self.field_path(field), len(self.dates) * self.capacity * np.dtype(dtype).itemsize)
+
+        projection = {'_id': 0, 'date': 1, 'code': 1}
+        projection.update({field: 1 for field in self.field_dt})
+        for i in range(0, len(new_date_ls), batch_days):
+            batch_date_ls = new_date_ls[i:i + batch_days]
+            cursor = self.coll.find({'date': {'$gte': batch_date_ls[0], '$lte': batch_date_ls[-1]}}, projection)
+            batch_df = pd.DataFrame(list(cursor))
+            if len(batch_df) != 0:
+                batch_df = batch_df.drop_duplicates(subset=['date', 'code']).set_index(['date', 'code'])
+                new_codes = batch_df.index.get_level_values('code').unique().difference(self.codes)
+                if len(new_codes) != 0:
+                    if len(self.codes) + len(new_codes) > self.capacity:
+                        self.grow_capacity(len(self.codes) + len(new_codes))
+                    self.codes = self.codes.append(pd.Index(sorted(new_codes), dtype=object))
+            for field, dtype in self.field_dt.items():
+                block = np.full((len(batch_date_ls), self.capacity), np.nan, dtype=dtype)
+                if len(batch_df) != 0 and field in batch_df.columns:
+                    field_df = batch_df[field].unstack(level=1).reindex(index=batch_date_ls)
+                    block[:, self.codes.get_indexer(field_df.columns)] = field_df.to_numpy(dtype='float64')
+                with open(self.field_path(field), 'ab') as f:
+                    block.tofile(f)
+            self.dates = np.concatenate([self.dates, np.array(batch_date_ls, dtype=str)])
+            self.write_meta()
+        self.load()
+        return len(new_date_ls)
+
+    def covers(self, s_date, e_date):
+        """
+        :return: 本地价格库是否完整覆盖[s_date, e_date]，bool
+        """
+        self.refresh()
+        return len(self.dates) != 0 and self.dates[0] <= s_date and e_date <= self.dates[-1]
+
+    def get(self, field_ls, s_date='', e_date='', codes=None, date_ls=None):
+        """
+        按日期区间（或日期列表）和股票代码切片
+        :param field_ls: 字段名称列表，list
+        :param s_date: 开始日期，str，"%Y-%m-%d"
+        :param e_date: 结束日期，str，"%Y-%m-%d"
+        :param codes: 股票池，list，None表示全部股票
+        :param date_ls: 日期列表，list，不为None时忽略s_date和e_date
+        :return: 字段矩阵，dict，key是字段名称，value是pandas.DataFrame，index是日期，columns是股票代码；
+                 日期区间切片且codes为None时为内存映射文件上的视图，不复制数据
+        """
+        self.refresh()
+        if date_ls is None:
+            row = slice(np.searchsorted(self.dates, s_date, side='left'),
+                        np.searchsorted(self.dates, e_date, side='right'))
+            index = self.dates[row]
+        else:
+            row = np.searchsorted(self.dates, date_ls, side='left').clip(0, max(len(self.dates) - 1, 0))
+            row = row[self.dates[row] == np.array(date_ls, dtype=str)]
+            index = self.dates[row]
+        if codes is None:
+            col = slice(0, len(self.codes))
+            columns = self.codes
+        else:
+            col = self.codes.get_indexer(codes)
+            col = col[col != -1]
+            columns = self.codes[col]
+        result_dt = {}
+        for field in field_ls:
+            matrix = self.matrix_dt[field][row]
+            matrix = matrix[:, col]
+            result_dt[field] = pd.DataFrame(matrix, index=pd.Index(index, name='date'),
+                                            columns=pd.Index(columns, name='code'), copy=False)
+        return result_dt
+
+
+@lru_cache()
+def get_price_store(path=PRICE_STORE_PATH):
+    """
+    :param path: 本地价格库目录，str
+    :return: 本地价格库实例，PriceStore，目录下没有建库时返回None
+    """
+    store = PriceStore(path)
+    if not store.exists():
+        get_price_store.cache_clear()
+        return None
+    return store.load()
+
+
+def sync_price_store(path=PRICE_STORE_PATH, s_date='2014-01-01', e_date=None, batch_days=20):
+    """
+    增量同步本地价格库，参数同PriceStore.sync
+    :return: 本次追加的交易日数量，int
+    """
+    n_dates = PriceStore(path).sync(s_date=s_date, e_date=e_date, batch_days=batch_days)
+    get_price_store.cache_clear()
+    return n_dates
+
+
+def load_price_matrix(field_ls, s_date='', e_date='', codes=None, date_ls=None):
+    """
+    获取价格矩阵，本地价格库覆盖所需日期时从本地价格库切片，否则从ts_daily_adj_factor查询
+    :param field_ls: 字段名称列表，list
+    :param s_date: 开始日期，str，"%Y-%m-%d"
+    :param e_date: 结束日期，str，"%Y-%m-%d"
+    :param codes: 股票池，list，None表示全部股票
+    :param date_ls: 日期列表，list，不为None时忽略s_date和e_date
+    :return: 字段矩阵，dict，key是字段名称，value是pandas.DataFrame，index是日期，columns是股票代码，
+             只包含有数据的日期和股票
+    """
+    lower, upper = (s_date, e_date) if date_ls is None else (min(date_ls), max(date_ls))
+    store = get_price_store()
+    if store is not None and set(field_ls) <= set(store.field_dt) and store.covers(lower, upper):
+        result_dt = store.get(field_ls, s_date, e_date, codes, date_ls)
+        exist_df = result_dt[field_ls[0]].notna()
+        row, col = exist_df.any(axis=1).to_numpy(), exist_df.any(axis=0).to_numpy()
+        if not (row.all() and col.all()):
+            result_dt = {field: result_dt[field].loc[row, col] for field in field_ls}
+        return result_dt
+
+    query = {'date': {'$gte': s_date, '$lte': e_date}} if date_ls is None else {'date': {'$in': list(date_ls)}}
+    if codes is not None:
+        query['code'] = {'$in': list(codes)}
+    projection = {'_id': 0, 'date': 1, 'code': 1}
+    projection.update({field: 1 for field in field_ls})
+    price_df = pd.DataFrame(list(db_zcs.ts_daily_adj_factor.find(query, projection)), columns=['date', 'code'] + field_ls)
+    price_df = price_df.drop_duplicates(subset=['date', 'code']).set_index(['date', 'code']).sort_index()
+    return {field: price_df[field].unstack(level=1).astype('float64') for field in field_ls}
+
+
+def adjust_price_matrix(price_df, adj_factor_df, base=None):
+    """
+    复权价格矩阵，按日期和股票代码对齐后一次广播计算
+    :param price_df: 价格矩阵，pandas.DataFrame，index是日期，columns是股票代码
+    :param adj_factor_df: 复权因子矩阵，pandas.DataFrame，index是日期，columns是股票代码
+    :param base: 复权基期，str，None表示后复权（价格乘复权因子），first表示以每只股票在adj_factor_df中第一个有复权因子的日期为基期，
+                 last表示以每只股票在adj_factor_df中最后一个有复权因子的日期为基期
+    :return: 复权价格矩阵，pandas.DataFrame，结构与price_df相同
+    """
+    adj_factor_df = adj_factor_df.astype('float64')
+    adj_price_df = price_df * adj_factor_df.reindex_like(price_df)
+    if base is None or len(adj_factor_df) == 0:
+        return adj_price_df
+    adj_arr = adj_factor_df.to_numpy()
+    valid = ~np.isnan(adj_arr)
+    loc = valid.argmax(axis=0) if base == 'first' else len(adj_arr) - 1 - valid[::-1].argmax(axis=0)
+    base_series = pd.Series(np.where(valid.any(axis=0), adj_arr[loc, np.arange(adj_arr.shape[1])], np.nan),
+                            index=adj_factor_df.columns)
+    return adj_price_df / base_series.reindex(price_df.columns).to_numpy()
+
+
+def load_adjusted_price(field_ls=('close',), s_date='', e_date='', codes=None, date_ls=None, cache=False):
+    """
+    获取后复权价格矩阵
+    :param field_ls: 价格字段列表，list，open/high/low/close中的字段
+    :param s_date: 开始日期，str，"%Y-%m-%d"
+    :param e_date: 结束日期，str，"%Y-%m-%d"
+    :param codes: 股票池，list，None表示全部股票
+    :param date_ls: 日期列表，list，不为None时忽略s_date和e_date
+    :param cache: 是否使用进程内缓存，bool，True时从ADJUSTED_PRICE_CACHE中覆盖所需日期的全部股票后复权价格切片，
+                  不能覆盖时按缓存与所需日期的并集重新查询全部股票并替换缓存
+    :return: 后复权价格矩阵，dict，key是字段名称，value是pandas.DataFrame，index是日期，columns是股票代码，
+             只包含有数据的日期和股票
+    """
+    field_ls = list(field_ls)
+    if not cache:
+        price_dt = load_price_matrix(field_ls + ['adj_factor'], s_date, e_date, codes, date_ls)
+        return {field: adjust_price_matrix(price_dt[field], price_dt['adj_factor']) for field in field_ls}
+
+    lower, upper = (s_date, e_date) if date_ls is None else (min(date_ls), max(date_ls))
+    missing_ls = [field for field in field_ls if field not in ADJUSTED_PRICE_CACHE or
+                  not ADJUSTED_PRICE_CACHE[field][0] <= lower <= upper <= ADJUSTED_PRICE_CACHE[field][1]]
+    if len(missing_ls) > 0:
+        cached_ls = [ADJUSTED_PRICE_CACHE[field][:2] for field in missing_ls if field in ADJUSTED_PRICE_CACHE]
+        load_lower = min([lower] + [cached[0] for cached in cached_ls])
+        load_upper = max([upper] + [cached[1] for cached in cached_ls])
+        adjusted_dt = load_adjusted_price(missing_ls, load_lower, load_upper)
+        for field in missing_ls:
+            ADJUSTED_PRICE_CACHE[field] = (load_lower, load_upper, adjusted_dt[field])
+
+    result_dt = {}
+    for field in field_ls:
+        adjusted_df = ADJUSTED_PRICE_CACHE[field][2]
+        if date_ls is None:
+            adjusted_df = adjusted_df.loc[lower:upper]
+        else:
+            adjusted_df = adjusted_df.loc[adjusted_df.index.isin(list(date_ls))]
+        if codes is not None:
+            adjusted_df = adjusted_df.loc[:, adjusted_df.columns.isin(list(codes))]
+        result_dt[field] = adjusted_df
+    exist_df = result_dt[field_ls[0]].notna()
+    row, col = exist_df.any(axis=1).to_numpy(), exist_df.any(axis=0).to_numpy()
+    return {field: result_dt[field].loc[row, col] for field in field_ls}
+
+
+def clear_adjusted_price_cache():
+    """
+    清空进程内的后复权价格缓存
+    """
+    ADJUSTED_PRICE_CACHE.clear()
+
+
+def get_post_close(s_date='', e_date='', codes=None, date_ls=None, cache=False):
+    """
+    获取后复权收盘价矩阵
+    :param cache: 是否使用进程内缓存，bool，见load_adjusted_price
+    :return: 后复权收盘价，pandas.DataFrame，index是日期，columns是股票代码
+    """
+    return load_adjusted_price(['close'], s_date, e_date, codes, date_ls, cache)['close']
+
+
+def cal_return_matrix(price_df):
+    """
+    逐股票计算相对上一个有效价格的收益率，与按股票groupby后pct_change的结果相同
+    :param price_df: 价格矩阵，pandas.DataFrame，index是日期，columns是股票代码
+    :return: 收益率矩阵，pandas.DataFrame，index是日期，columns是股票代码，当天没有价格的位置为nan
+    """
+    return (price_df / price_df.ffill().shift(1) - 1).where(price_df.notna())
+
+
+def read_store_query(query, field_ls=None):
+    """
+    把ts_daily_adj_factor上的date/code查询条件转换为本地价格库切片
+    :param query: 查询条件，dict，date支持等于、$gte、$gt、$lte、$lt，code支持等于、$in
+    :param field_ls: 字段名称列表，list，None表示本地价格库的全部字段
+    :return: 查询结果，pandas.DataFrame，index是[日期，股票代码]，columns是字段名称；本地价格库不存在或不能覆盖时返回None
+    """
+    store = get_price_store()
+    if store is None:
+        return None
+    date_cond = query.get('date')
+    if isinstance(date_cond, str):
+        s_date, e_date = date_cond, date_cond
+    elif isinstance(date_cond, dict) and set(date_cond) <= {'$gte', '$gt', '$lte', '$lt'}:
+        store.refresh()
+        dates = store.dates
+        s_date, e_date = date_cond.get('$gte'), date_cond.get('$lte')
+        if '$gt' in date_cond:
+            loc = np.searchsorted(dates, date_cond['$gt'], side='right')
+            s_date = dates[loc] if loc < len(dates) else None
+        if '$lt' in date_cond:
+            loc = np.searchsorted(dates, date_cond['$lt'], side='left') - 1
+            e_date = dates[loc] if loc >= 0 else None
+    else:
+        return None
+    if s_date is None or e_date is None or not store.covers(s_date, e_date):
+        return None
+    code_cond = query.get('code')
+    if code_cond is None:
+        codes = None
+    elif isinstance(code_cond, str):
+        codes = [code_cond]
+    elif isinstance(code_cond, dict) and set(code_cond) == {'$in'}:
+        codes = list(code_cond['$in'])
+    else:
+        return None
+    field_ls = list(store.field_dt) if field_ls is None else field_ls
+    matrix_dt = store.get(field_ls, s_date, e_date, codes)
+    frame = matrix_dt[field_ls[0]]
+    exist = np.zeros(frame.shape, dtype=bool)
+    for matrix_df in matrix_dt.values():
+        exist |= matrix_df.notna().to_numpy()
+    date_arr = np.repeat(frame.index.to_numpy(), frame.shape[1]).reshape(frame.shape)[exist]
+    code_arr = np.tile(frame.columns.to_numpy(), frame.shape[0]).reshape(frame.shape)[exist]
+    data_df = pd.DataFrame({field: matrix_dt[field].to_numpy()[exist] for field in field_ls},
+                           index=pd.MultiIndex.from_arrays([date_arr, code_arr], names=['date', 'code']))
+    return data_df.sort_index()
+
+
+if __name__ == '__main__':
+    print('synced %s trade dates into %s' % (sync_price_store(), PRICE_STORE_PATH))
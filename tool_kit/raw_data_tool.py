@@ -0,0 +1,245 @@
+from tool_kit import db_zcs, pd, np
+from tool_kit.price_store_tool import CODE_CAPACITY_STEP
+
+
+RAW_COLLECTION_LS = ['ts_daily_adj_factor', 'wind_financial_2014', 'factor_barra']
+DERIVED_FIELD_DT = {'free_mkt': ('close', 'free_float_shares'), 'post_close': ('close', 'adj_factor')}
+
+
+class RawDataLoader(object):
+    """
+    ts_daily_adj_factor、wind_financial_2014、factor_barra的批量读取器：对一组新日期，每个集合只做一次find，
+    游标中的记录按batch_size条一批直接写入预先分配的(日期，股票代码)二维数组，不再为每个集合构造DataFrame后concat；
+    之后任意日期集合的close、free_mkt、未来收益率和风格因子都从数组中按位置取出，请求中未读取过的日期会自动补读
+    多个FactorCal、get_mkt_group、get_cap可以共用同一个读取器，先用load读入全部时间节点（和下一期）即可避免逐日期查询
+    :param style_factor_ls: factor_barra中需要读取的风格因子，list
+    :param price_field_ls: ts_daily_adj_factor中需要读取的字段，list
+    :param financial_field_ls: wind_financial_2014中需要读取的字段，list
+    :param code_ls: 股票池，list，None表示读取全部股票
+    :param batch_size: 每批写入数组的记录数量，int
+    :param db: 数据库变量，None表示db_zcs
+    """
+    def __init__(self, style_factor_ls=None, price_field_ls=('close', 'adj_factor'),
+                 financial_field_ls=('free_float_shares', 'd_return', '1m_return'), code_ls=None, batch_size=100000,
+                 db=None):
+        self.db = db_zcs if db is None else db
+        self.field_dt = {'ts_daily_adj_factor': list(price_field_ls),
+                         'wind_financial_2014': list(financial_field_ls),
+                         'factor_barra': [] if style_factor_ls is None else list(style_factor_ls)}
+        self.code_ls = None if code_ls is None else list(code_ls)
+        self.batch_size = batch_size
+        self.dates = []
+        self.date_pos_dt = {}
+        self.codes = []
+        self.code_pos_dt = {}
+        self.capacity = (0, 0)
+        self.value_dt = {}
+        self.exist_dt = {}
+        self.query_count = 0
+
+    def reserve(self, n_dates, n_codes):
+        """
+        数组容量不足时扩容，日期按需要的数量扩容，股票代码按CODE_CAPACITY_STEP扩容，新增位置的取值为nan、记录标记为False
+        :param n_dates: 需要的日期数量，int
+        :param n_codes: 需要的股票代码数量，int
+        """
+        if n_dates <= self.capacity[0] and n_codes <= self.capacity[1]:
+            return
+        capacity = (max(n_dates, self.capacity[0]),
+                    max(self.capacity[1], (n_codes // CODE_CAPACITY_STEP + 1) * CODE_CAPACITY_STEP))
+        for key_dt, fill_value, dtype in [(self.value_dt, np.nan, 'float64'), (self.exist_dt, False, 'bool')]:
+            for key, arr in key_dt.items():
+                new_arr = np.full(capacity, fill_value, dtype=dtype)
+                new_arr[:arr.shape[0], :arr.shape[1]] = arr
+                key_dt[key] = new_arr
+        self.capacity = capacity
+
+    def add_codes(self, code_ls):
+        """
+        登记新出现的股票代码
+        :param code_ls: 股票代码列表，list
+        """
+        for code in code_ls:
+            if code not in self.code_pos_dt:
+                self.code_pos_dt[code] = len(self.codes)
+                self.codes.append(code)
+
+    def load(self, date_ls):
+        """
+        读取尚未读取过的日期，每个集合一次find，查询条件是{'date': {'$in': 新日期}}，code_ls不为None时加上股票代码条件
+        :param date_ls: 日期列表，list，"%Y-%m-%d"
+        :return: self
+        """
+        new_date_ls = sorted(set(date_ls) - set(self.date_pos_dt))
+        if len(new_date_ls) == 0:
+            return self
+        for date in new_date_ls:
+            self.date_pos_dt[date] = len(self.dates)
+            self.dates.append(date)
+        if self.code_ls is not None:
+            self.add_codes(self.code_ls)
+        if len(self.value_dt) == 0:
+            for collection in RAW_COLLECTION_LS:
+                self.exist_dt[collection] = np.zeros(self.capacity, dtype='bool')
+                for field in self.field_dt[collection]:
+                    self.value_dt[field] = np.full(self.capacity, np.nan)
+        self.reserve(len(self.dates), len(self.codes))
+        for collection in RAW_COLLECTION_LS:
+            if collection == 'factor_barra' and len(self.field_dt[collection]) == 0:
+                continue
+            self.load_collection(collection, new_date_ls)
+        return self
+
+    def load_collection(self, collection, date_ls):
+        """
+        读取一个集合在date_ls上的记录，逐条记录日期位置、股票代码位置和字段取值，每batch_size条写入一次数组
+        :param collection: 集合名称，str
+        :param date_ls: 日期列表，list
+        """
+        field_ls = self.field_dt[collection]
+        query = {'date': {'$in': date_ls}}
+        if self.code_ls is not None:
+            query['code'] = {'$in': self.code_ls}
+        keyword_dt = {'_id': 0, 'code': 1, 'date': 1}
+        for field in field_ls:
+            keyword_dt.update({field: 1})
+        cursor = self.db[collection].find(query, keyword_dt)
+        self.query_count += 1
+        date_pos_ls, code_ls, value_ls = [], [], [[] for _ in field_ls]
+        for doc in cursor:
+            date_pos_ls.append(self.date_pos_dt[doc['date']])
+            code_ls.append(doc['code'])
+            for field, values in zip(field_ls, value_ls):
+                value = doc.get(field)
+                values.append(np.nan if value is None else value)
+            if len(date_pos_ls) >= self.batch_size:
+                self.write_batch(collection, date_pos_ls, code_ls, value_ls)
+                date_pos_ls, code_ls, value_ls = [], [], [[] for _ in field_ls]
+        self.write_batch(collection, date_pos_ls, code_ls, value_ls)
+
+    def write_batch(self, collection, date_pos_ls, code_ls, value_ls):
+        """
+        把一批记录写入数组
+        :param collection: 集合名称，str
+        :param date_pos_ls: 记录的日期位置，list
+        :param code_ls: 记录的股票代码，list
+        :param value_ls: 每个字段的取值，list，与field_dt[collection]对应
+        """
+        if len(date_pos_ls) == 0:
+            return
+        self.add_codes(code_ls)
+        self.reserve(len(self.dates), len(self.codes))
+        date_pos = np.asarray(date_pos_ls)
+        code_pos = np.fromiter((self.code_pos_dt[code] for code in code_ls), dtype='int64', count=len(code_ls))
+        self.exist_dt[collection][date_pos, code_pos] = True
+        for field, values in zip(self.field_dt[collection], value_ls):
+            self.value_dt[field][date_pos, code_pos] = np.asarray(values, dtype='float64')
+
+    def positions(self, date_ls, code_ls=None):
+        """
+        :param date_ls: 日期列表，list，未读取过的日期会先读取
+        :param code_ls: 股票代码列表，list，None表示已读取的全部股票代码
+        :return: (日期位置，股票代码位置，股票代码列表)，tuple，未出现过的股票代码位置为-1
+        """
+        self.load(date_ls)
+        code_ls = list(self.codes) if code_ls is None else list(code_ls)
+        date_pos = np.array([self.date_pos_dt[date] for date in date_ls], dtype='int64')
+        code_pos = np.array([self.code_pos_dt.get(code, -1) for code in code_ls], dtype='int64')
+        return date_pos, code_pos, code_ls
+
+    def take(self, arr, date_pos, code_pos, fill_value):
+        """
+        按位置从数组中取值，位置为-1的股票代码取fill_value
+        :param arr: 取值数组或记录标记数组，numpy.ndarray
+        :param date_pos: 日期位置，numpy.ndarray
+        :param code_pos: 股票代码位置，numpy.ndarray
+        :param fill_value: 未出现过的股票代码的取值
+        :return: 取值矩阵，numpy.ndarray，shape是(日期数，股票代码数)
+        """
+        if arr.shape[1] == 0:
+            return np.full((len(date_pos), len(code_pos)), fill_value, dtype=arr.dtype)
+        value_arr = arr[np.ix_(date_pos, np.where(code_pos >= 0, code_pos, 0))]
+        value_arr[:, code_pos < 0] = fill_value
+        return value_arr
+
+    def field_array(self, field, date_pos, code_pos):
+        """
+        :param field: 字段名称，str，读取的字段或free_mkt（close×free_float_shares）、post_close（close×adj_factor）
+        :param date_pos: 日期位置，numpy.ndarray
+        :param code_pos: 股票代码位置，numpy.ndarray
+        :return: 取值矩阵，numpy.ndarray，shape是(日期数，股票代码数)
+        """
+        if field in self.value_dt:
+            return self.take(self.value_dt[field], date_pos, code_pos, np.nan)
+        if field in DERIVED_FIELD_DT:
+            left, right = DERIVED_FIELD_DT[field]
+            return self.field_array(left, date_pos, code_pos) * self.field_array(right, date_pos, code_pos)
+        raise KeyError('字段%s没有读取，需要在RawDataLoader的字段列表中加入' % field)
+
+    def matrix(self, field, date_ls, code_ls=None):
+        """
+        :param field: 字段名称，str，见field_array
+        :param date_ls: 日期列表，list
+        :param code_ls: 股票代码列表，list，None表示已读取的全部股票代码
+        :return: 取值矩阵，pandas.DataFrame，index是日期，columns是股票代码，没有记录的位置为nan
+        """
+        date_pos, code_pos, code_ls = self.positions(date_ls, code_ls)
+        return pd.DataFrame(self.field_array(field, date_pos, code_pos), index=list(date_ls), columns=code_ls)
+
+    def exist(self, collection, date_ls, code_ls=None):
+        """
+        :param collection: 集合名称，str
+        :param date_ls: 日期列表，list
+        :param code_ls: 股票代码列表，list，None表示已读取的全部股票代码
+        :return: 是否有记录，pandas.DataFrame，index是日期，columns是股票代码，bool
+        """
+        date_pos, code_pos, code_ls = self.positions(date_ls, code_ls)
+        return pd.DataFrame(self.take(self.exist_dt[collection], date_pos, code_pos, False), index=list(date_ls),
+                            columns=code_ls)
+
+    def forward_return(self, date_ls, tom_date_ls, field='d_return', code_ls=None):
+        """
+        下一期的收益率对齐到当期
+        :param date_ls: 当期日期列表，list
+        :param tom_date_ls: 下一期日期列表，list，与date_ls一一对应
+        :param field: 收益率字段，str，d_return、1m_return等wind_financial_2014中读取的字段
+        :param code_ls: 股票代码列表，list，None表示已读取的全部股票代码
+        :return: 下一期收益率，pandas.DataFrame，index是当期日期，columns是股票代码
+        """
+        return_df = self.matrix(field, tom_date_ls, code_ls)
+        return_df.index = list(date_ls)
+        return return_df
+
+    def cross_section(self, date, field_ls, code_ls=None, require_ls=('ts_daily_adj_factor',)):
+        """
+        单个日期的横截面数据
+        :param date: 日期，str
+        :param field_ls: 字段名称列表，list，见field_array
+        :param code_ls: 股票代码列表，list，None表示已读取的全部股票代码
+        :param require_ls: 需要有记录的集合，list，只保留在这些集合中都有当天记录的股票
+        :return: 横截面数据，pandas.DataFrame，index是股票代码，columns是field_ls
+        """
+        date_pos, code_pos, code_ls = self.positions([date], code_ls)
+        keep = np.ones(len(code_ls), dtype='bool')
+        for collection in require_ls:
+            keep &= self.take(self.exist_dt[collection], date_pos, code_pos, False)[0]
+        code_pos = code_pos[keep]
+        data_df = pd.DataFrame({field: self.field_array(field, date_pos, code_pos)[0] for field in field_ls},
+                               index=pd.Index(np.asarray(code_ls, dtype=object)[keep], name='code'), columns=field_ls)
+        return data_df
+
+    def panel(self, field_ls, data_index, level=('date', 'code')):
+        """
+        按[日期，股票代码]取面板数据
+        :param field_ls: 字段名称列表，list，见field_array
+        :param data_index: 面板的index，pandas.MultiIndex
+        :param level: 日期和股票代码所在的index层级名称，tuple
+        :return: 面板数据，pandas.DataFrame，index是data_index，columns是field_ls
+        """
+        date_codes, date_ls = pd.factorize(data_index.get_level_values(level[0]))
+        code_codes, code_ls = pd.factorize(data_index.get_level_values(level[1]))
+        date_pos, code_pos, _ = self.positions(list(date_ls), list(code_ls))
+        value_dt = {}
+        for field in field_ls:
+            value_dt[field] = self.field_array(field, date_pos, code_pos)[date_codes, code_codes]
+        return pd.DataFrame(value_dt, index=data_index, columns=field_ls)
@@ -1,10 +1,13 @@
 import statsmodels.api as sm
 from scipy import stats
 from tool_kit import pd, np, db_zcs
-from tool_kit.date_N_time import shift_date
-from tool_kit.base_datastruct import block_data
-from tool_kit.utility_tool import del_ST, del_suspended, del_newlist, do_orth, do_del_extremum, do_fill_nan, \
-    do_neutralize, do_standardize, half_decay_weight
+from tool_kit.date_N_time import shift_date, gen_trade_date, get_next_date, util_get_closed_month_end
+from tool_kit.base_datastruct import block_data, basic_codes
+from tool_kit.utility_tool import del_ST, del_suspended, del_newlist, do_standardize, half_decay_weight
+from tool_kit.preprocess_tool import panel_del_extremum, panel_fill_nan, panel_neutralize, panel_standardize, \
+    neutralize_cross_section, fill_nan_by_group, winsorize
+from tool_kit.factor_return_tool import cal_factor_return
+from tool_kit.orth_tool import ORTH_SPEC_DT, apply_orth_spec
 
 
 class FactorCal(object):
@@ -24,11 +27,15 @@ class FactorCal(object):
     fill_nan：是否填空值，bool
     neutralize：是否中性化，bool
     standardize：是否标准化，bool
-    orth：是否正交化，bool
+    orth：是否正交化，bool，True按orth_tool.ORTH_SPEC_DT正交化，dict表示自定义的正交化依赖关系，见orth_tool.resolve_orth_spec
+    universe_filter：股票池过滤器，universe_tool.UniverseFilter，不为None时用预先计算的标记矩阵剔除ST、停牌和新股，
+    多个时间节点可共用同一个过滤器
+    raw_data_loader：因子基础数据读取器，raw_data_tool.RawDataLoader，不为None时从读取器中取close、free_float_shares、
+    风格因子和下一期收益率，多个时间节点可共用同一个读取器
     """
     def __init__(self, date, universe, freq='', tom_date='', cal_return='standard', style_factor_ls=None,
                  industry_standard='CS', d_ST=True, d_suspended=True, d_newlist=True, del_extremum=True, fill_nan=True,
-                 neutralize=True, standardize=True, orth=True):
+                 neutralize=True, standardize=True, orth=True, universe_filter=None, raw_data_loader=None):
         self.date = date
         self.universe = universe
         self.freq = freq
@@ -39,19 +46,23 @@ class FactorCal(object):
         self.industry_standard = industry_standard
         self.A_return = 0.0
         self.del_ST, self.del_suspended, self.del_newlist = d_ST, d_suspended, d_newlist
-        self.del_extremum, self.fill_nan, self.neutralize, self.standardize, self.orth = del_extremum, fill_nan, neutralize, standardize, orth
+        self.del_extremum, self.fill_nan, self.neutralize, self.standardize, self.orth = del_extremum, fill_nan, neutralize, standardize, bool(orth)
+        self.orth_spec_dt = orth if isinstance(orth, dict) else ORTH_SPEC_DT
+        self.universe_filter = universe_filter
+        self.raw_data_loader = raw_data_loader
         self.block_data_obj = object
         self.stock_universe = []
         self.raw_data_df = pd.DataFrame()
         self.extremum_multi = None
+        self.clip_count_df = pd.DataFrame()
         self.industry_mean_df = pd.DataFrame()
         self.cap_weight_df = pd.DataFrame()
         self.process_data_df = pd.DataFrame()
         self.industry_factor_ls = []
-        self.wls = object
         self.factor_return_series = pd.Series()
         self.specific_return_series = pd.Series()
         self.ic_series = pd.Series()
+        self.r2 = np.nan
         self.pure_weight_df = pd.DataFrame()
 
     def get_stock_universe(self):
@@ -68,6 +79,10 @@ class FactorCal(object):
         else:
             stock_universe = self.universe.copy()
         self.stock_universe = stock_universe.copy()
+        if self.universe_filter is not None:
+            self.stock_universe = self.universe_filter.filter(self.stock_universe, self.date, self.date, self.del_ST,
+                                                              self.del_suspended, self.del_newlist)
+            return
         if self.del_ST:
             self.stock_universe = del_ST(self.date, self.date, self.stock_universe)
         if self.del_suspended:
@@ -81,7 +96,27 @@ class FactorCal(object):
         self.raw_data_df：因子原始数据DataFrame，pandas.DataFrame，index是股票代码，columns是[因子名称，free_float_shares, close, free_mkt, return, CS]
         """
         self.get_stock_universe()
+        data_df = self.query_raw_data() if self.raw_data_loader is None else self.load_raw_data()
 
+        # 获取行业代码
+        if self.industry_standard is not None:
+            if self.industry_standard == 'CS':
+                industry_series = self.block_data_obj.CS()
+            elif self.industry_standard == 'SW':
+                industry_series = self.block_data_obj.SW()
+            industry_series = industry_series[industry_series.index.isin(self.stock_universe)]
+            industry_df = pd.DataFrame(data=industry_series.dropna(), columns=[self.industry_standard])
+            self.raw_data_df = pd.concat([data_df, industry_df], axis=1, join='inner')
+            self.stock_universe = self.raw_data_df.index.tolist()
+
+        else:
+            self.raw_data_df = data_df
+
+    def query_raw_data(self):
+        """
+        逐个集合查询当天的因子基础数据和下一期的收益率
+        :return: 因子基础数据，pandas.DataFrame，index是股票代码，columns是[因子名称，close, free_float_shares, free_mkt, return]
+        """
         # 获取因子基础数据
         tprice_data = self.db.ts_daily_adj_factor.find({'date': self.date, 'code': {'$in': self.stock_universe}},
                                                        {'_id': 0, 'code': 1, 'close': 1})
@@ -127,28 +162,41 @@ class FactorCal(object):
                 data=price_df['post_close'].groupby(level=0, group_keys=False).apply(lambda x: x.pct_change().tail(1)))
             return_df.rename(columns={'post_close': 'return'}, inplace=True)
             data_df = pd.concat([data_df, return_df], axis=1, join='inner')
+        return data_df
 
-        # 获取行业代码
-        if self.industry_standard is not None:
-            if self.industry_standard == 'CS':
-                industry_series = self.block_data_obj.CS()
-            elif self.industry_standard == 'SW':
-                industry_series = self.block_data_obj.SW()
-            industry_series = industry_series[industry_series.index.isin(self.stock_universe)]
-            industry_df = pd.DataFrame(data=industry_series.dropna(), columns=[self.industry_standard])
-            self.raw_data_df = pd.concat([data_df, industry_df], axis=1, join='inner')
-            self.stock_universe = self.raw_data_df.index.tolist()
-
-        else:
-            self.raw_data_df = data_df
+    def load_raw_data(self):
+        """
+        从raw_data_loader中取当天的因子基础数据和下一期的收益率，结果与query_raw_data相同，读取器已读入的日期不再查询数据库
+        :return: 因子基础数据，pandas.DataFrame，index是股票代码，columns是[因子名称，close, free_float_shares, free_mkt, return]
+        """
+        loader = self.raw_data_loader
+        data_df = loader.cross_section(self.date, self.style_factor_ls + ['close', 'free_float_shares', 'free_mkt'],
+                                       self.stock_universe)
+        if self.cal_return == 'standard' and self.freq in ['d', 'm']:
+            return_field = {'d': 'd_return', 'm': '1m_return'}[self.freq]
+            return_df = loader.cross_section(self.tom_date, [return_field], data_df.index.tolist(),
+                                             require_ls=['wind_financial_2014'])
+            data_df = data_df.reindex(return_df.index)
+            data_df['return'] = return_df[return_field].values
+        elif self.cal_return == 'custom':
+            post_close = loader.matrix('post_close', [self.date, self.tom_date], data_df.index.tolist())
+            data_df['return'] = (post_close.iloc[1] / post_close.iloc[0] - 1).values
+        return data_df
 
-    def process_raw_factor(self, raw_factor_df=None, style_factor_ls=None, extremum_multi=3.0):
+    def process_raw_factor(self, raw_factor_df=None, style_factor_ls=None, extremum_multi=3.0, fill_method='mean',
+                           fill_fallback=False, extremum_method='mad', extremum_quantile=(0.01, 0.99)):
         """
         :param raw_factor_df: 在类外部进行了调整和计算后的原始因子序列，pandas.DataFrame，index是股票代码，columns是[因子名称，free_float_shares, close, free_mkt, return, CS]
         :param style_factor_ls: 风格因子序列，list
         :param extremum_multi: 去极值偏离倍数，int/float
+        :param fill_method: 填空值使用的行业统计量，str，mean是等权均值，median是中位数，cap_weighted是流通市值加权均值
+        :param fill_fallback: 行业统计量填充后仍为空值时，是否用全市场统计量填充，bool
+        :param extremum_method: 去极值方法，str，mad是中位数±extremum_multi倍MAD，sigma是均值±extremum_multi倍标准差，
+                                percentile是按extremum_quantile分位数截断
+        :param extremum_quantile: 去极值的上下分位点，tuple，extremum_method为percentile时使用
         self.raw_data_df：经过外部调整和计算的新的原始因子序列，pandas.DataFrame，index是股票代码，columns是[因子名称，free_float_shares, close, free_mkt, return, CS]
         self.style_factor_ls：新的风格因子名称序列，list
+        self.clip_count_df：去极值截断数量，pandas.DataFrame，index是风格因子名称，columns是[lower, upper, total]
         self.industry_mean_df：风格因子行业均值，pandas.DataFrame，index是行业代码，columns是风格因子名称
         self.cap_weight_df：市值权重，pandas.DataFrame，index是股票代码，columns是[free_mkt, sqrtmkt, weight]
         self.process_data_df：数据预处理后的因子数据，pandas.DataFrame，index是股票代码，columns是[因子名称，行业代码，free_float_shares, close, free_mkt, return, CS]
@@ -185,12 +233,13 @@ class FactorCal(object):
                 data_df.dropna(axis=1, how='all', inplace=True)
             # 去极值
             if self.del_extremum:
-                de_factor = data_df[self.style_factor_ls].apply(lambda x: do_del_extremum(x, multi=self.extremum_multi))
+                de_factor, self.clip_count_df = winsorize(data_df[self.style_factor_ls], extremum_method,
+                                                          self.extremum_multi, extremum_quantile)
                 data_df.update(de_factor)
             # 填空值
             if self.fill_nan:
-                self.industry_mean_df = data_df.reset_index().groupby('CS', as_index=True)[self.style_factor_ls].mean()
-                fn_factor = data_df[self.style_factor_ls].apply(lambda x: do_fill_nan(x, data_df['CS'], self.industry_mean_df))
+                fn_factor, self.industry_mean_df = fill_nan_by_group(data_df[self.style_factor_ls], data_df['CS'],
+                                                                     fill_method, data_df['free_mkt'], fill_fallback)
                 data_df.update(fn_factor)
                 drop_part = len(data_df[data_df.isna().any(axis=1)])/len(data_df)
                 if drop_part < 0.3:  # 如果填空值后仍为空值的样本少于30%，则剔除该部分样本
@@ -203,8 +252,10 @@ class FactorCal(object):
                         self.cap_weight_df['weight'] = self.cap_weight_df['weight']/self.cap_weight_df['weight'].sum()
             # 市值和行业中性化
             if self.neutralize:
-                neu_factor = data_df[self.style_factor_ls].apply(
-                    lambda x: do_neutralize(x, cap_indus_factor=data_df[['free_mkt'] + self.industry_factor_ls]))
+                # 市值和行业暴露矩阵只构造一次，全部风格因子一次回归
+                exposure_df = data_df[['free_mkt'] + self.industry_factor_ls].astype('float64')
+                exposure_df['free_mkt'] = np.log(exposure_df['free_mkt'])
+                neu_factor = neutralize_cross_section(data_df[self.style_factor_ls], exposure_df)
                 data_df.update(neu_factor)
             # 正态化
             # normal_factor = data_df[self.style_factor_ls].apply(lambda x: boxcox_normal(x))
@@ -215,15 +266,301 @@ class FactorCal(object):
                 data_df.update(standard_factor)
             # 正交化
             if self.orth:
-                if 'vol' in self.style_factor_ls and 'size' in self.style_factor_ls and 'beta' in self.style_factor_ls:
-                    data_df['vol'] = do_orth(one_factor=data_df['vol'], independent_factor=data_df[['size', 'beta']],
-                                             weight_factor=self.cap_weight_df['weight'])
-                if 'liq' in self.style_factor_ls and 'size' in self.style_factor_ls:
-                    data_df['liq'] = do_orth(one_factor=data_df['liq'], independent_factor=data_df['size'],
-                                             weight_factor=self.cap_weight_df['weight'])
+                data_df[self.style_factor_ls] = apply_orth_spec(data_df[self.style_factor_ls],
+                                                                self.cap_weight_df['weight'], self.orth_spec_dt)
             self.process_data_df = data_df.copy()
         else:
             # 行业虚拟变量
             industry_dummy_df = pd.get_dummies(data_df['CS'], prefix_sep='')
             self.industry_factor_ls = industry_dummy_df.columns.tolist()
             self.process_data_df = pd.concat([data_df, industry_dummy_df], axis=1, join='inner')
+
+    def cal_factor_return(self, weight_factor_ls=None):
+        """
+        对预处理后的因子数据做带约束的横截面加权回归，需要先调用process_raw_factor，回归方法见factor_return_tool.cal_factor_return
+        :param weight_factor_ls: 需要输出纯因子组合权重的因子名称列表，list，None表示全部因子
+        self.factor_return_series：因子收益率，pandas.Series，index是[country，行业因子，风格因子]
+        self.specific_return_series：特异性收益率，pandas.Series，index是股票代码
+        self.r2：加权R²，float
+        self.pure_weight_df：纯因子组合权重，pandas.DataFrame，index是因子名称，columns是股票代码
+        """
+        data_df = pd.concat({self.date: self.process_data_df}, names=['date', 'code'])
+        industry_factor_ls = [ind for ind in self.industry_factor_ls if ind in data_df.columns]
+        if weight_factor_ls is None:
+            weight_factor_ls = ['country'] + industry_factor_ls + self.style_factor_ls
+        factor_return_df, specific_return_series, r2_series, pure_weight_df = cal_factor_return(
+            data_df, self.style_factor_ls, industry_factor_ls, weight_factor_ls=weight_factor_ls)
+        self.factor_return_series = factor_return_df.iloc[0].rename(None)
+        self.specific_return_series = specific_return_series.xs(self.date, level='date')
+        self.r2 = r2_series.iloc[0]
+        self.pure_weight_df = pure_weight_df.xs(self.date, level='date').T
+
+    def cal_pure_portfolio_weight(self, extra_factor=None, **process_kwargs):
+        """
+        完成数据预处理和带约束的横截面加权回归，结果见cal_factor_return
+        :param extra_factor: 额外加入回归的风格因子原始值，pandas.Series/pandas.DataFrame，index是股票代码，
+                             Series的name或DataFrame的columns是因子名称
+        :param process_kwargs: process_raw_factor的其他参数
+        """
+        if extra_factor is None:
+            self.process_raw_factor(**process_kwargs)
+        else:
+            extra_df = extra_factor.to_frame() if isinstance(extra_factor, pd.Series) else extra_factor
+            style_factor_ls = self.style_factor_ls + [f for f in extra_df.columns if f not in self.style_factor_ls]
+            self.process_raw_factor(raw_factor_df=extra_df, style_factor_ls=style_factor_ls, **process_kwargs)
+        self.cal_factor_return()
+
+
+class FactorPanelCal(object):
+    """
+    面板模式的因子数据获取和预处理，一次完成一段时间内所有时间节点的计算，每个数据库集合只查询一次，
+    预处理在[日期，股票代码]面板上按日期分组向量化计算，每个日期的结果与FactorCal.process_raw_factor相同
+    s_date：开始日期，str
+    e_date：结束日期，str
+    universe：股票池，A、a_share、sz50、hs300、zz500、zz800、zz1000，str，若为list表示指定股票池
+    freq：是计算频率，str，'d'是日频，'m'是月频
+    date_ls：时间节点列表，list，若为None则由s_date、e_date和freq生成
+    其余参数与FactorCal相同
+    """
+    index_code_dt = {'sz50': '000016', 'hs300': '000300', 'HS300': '000300', 'zz500': '000905', 'zz800': '000906',
+                     'zz1000': '000852'}
+
+    def __init__(self, s_date='', e_date='', universe='A', freq='m', date_ls=None, cal_return='standard',
+                 style_factor_ls=None, industry_standard='CS', d_ST=True, d_suspended=True, d_newlist=True,
+                 del_extremum=True, fill_nan=True, neutralize=True, standardize=True, orth=True):
+        self.universe = universe
+        self.freq = freq
+        self.date_ls = gen_trade_date(s_date, e_date, freq=freq) if date_ls is None else list(date_ls)
+        self.tom_date_ls = [get_next_date(date, freq) for date in self.date_ls] if freq in ['d', 'm'] else []
+        self.cal_return = cal_return
+        self.style_factor_ls = [] if style_factor_ls is None else style_factor_ls.copy()
+        self.db = db_zcs
+        self.industry_standard = industry_standard
+        self.del_ST, self.del_suspended, self.del_newlist = d_ST, d_suspended, d_newlist
+        self.del_extremum, self.fill_nan, self.neutralize, self.standardize, self.orth = del_extremum, fill_nan, neutralize, standardize, bool(orth)
+        self.orth_spec_dt = orth if isinstance(orth, dict) else ORTH_SPEC_DT
+        self.month_end_dt = {}
+        self.price_df = pd.DataFrame()
+        self.block_df = pd.DataFrame()
+        self.universe_df = pd.DataFrame()
+        self.raw_data_df = pd.DataFrame()
+        self.extremum_multi = None
+        self.clip_count_df = pd.DataFrame()
+        self.industry_mean_df = pd.DataFrame()
+        self.cap_weight_df = pd.DataFrame()
+        self.drop_part_series = pd.Series()
+        self.process_data_df = pd.DataFrame()
+        self.industry_factor_ls = []
+        self.factor_return_df = pd.DataFrame()
+        self.specific_return_series = pd.Series()
+        self.r2_series = pd.Series()
+        self.pure_weight_df = pd.DataFrame()
+
+    def get_stock_universe(self):
+        """
+        一次查询ts_daily_adj_factor、wind_block_2014、ts_stock_basic，得到所有时间节点的股票池
+        self.price_df：行情数据，pandas.DataFrame，columns是[code, date, close, volume, adj_factor]
+        self.block_df：板块数据，pandas.DataFrame，columns是[code, date, ST, 指数代码, 行业代码]
+        self.month_end_dt：时间节点对应的上一月最后一个交易日，dict，key和value都是日期
+        self.universe_df：股票池，pandas.DataFrame，columns是[date, code]，按date、code排序
+        """
+        self.month_end_dt = {date: util_get_closed_month_end(date) for date in self.date_ls}
+        price_date_ls = self.date_ls + (self.tom_date_ls if self.cal_return == 'custom' else [])
+        price_data = self.db.ts_daily_adj_factor.find({'date': {'$in': sorted(set(price_date_ls))}},
+                                                      {'_id': 0, 'code': 1, 'date': 1, 'close': 1, 'volume': 1,
+                                                       'adj_factor': 1})
+        self.price_df = pd.DataFrame(list(price_data))
+        block_keyword_dt = {'_id': 0, 'code': 1, 'date': 1, 'ST': 1}
+        if self.industry_standard is not None:
+            block_keyword_dt.update({self.industry_standard: 1})
+        if isinstance(self.universe, str) and self.universe in self.index_code_dt:
+            block_keyword_dt.update({self.index_code_dt[self.universe]: 1})
+        block_data_cursor = self.db.wind_block_2014.find(
+            {'date': {'$in': sorted(set(self.date_ls) | set(self.month_end_dt.values()))}}, block_keyword_dt)
+        self.block_df = pd.DataFrame(list(block_data_cursor)).drop_duplicates(subset=['date', 'code'])
+        basic_data = self.db.ts_stock_basic.find({}, {'_id': 0, 'code': 1, 'list_date': 1, 'list_status': 1,
+                                                      'delist_date': 1})
+        basic_df = pd.DataFrame(list(basic_data)).drop_duplicates(subset=['code']).set_index('code')
+
+        date_df = pd.DataFrame({'date': self.date_ls, 'block_date': [self.month_end_dt[date] for date in self.date_ls]})
+        if isinstance(self.universe, str) and self.universe in ['A', 'a_share']:
+            universe_df = self.price_df.loc[self.price_df['date'].isin(self.date_ls) &
+                                            self.price_df['code'].isin(basic_codes), ['date', 'code']]
+        elif isinstance(self.universe, str):
+            index_df = self.block_df.loc[self.block_df[self.index_code_dt[self.universe]] == 1, ['date', 'code']]
+            universe_df = date_df.merge(index_df.rename(columns={'date': 'block_date'}), on='block_date')
+            delist_date = universe_df['code'].map(basic_df.loc[basic_df['list_status'] == 'D', 'delist_date'])
+            universe_df = universe_df.loc[delist_date.isna() | (universe_df['date'] < delist_date), ['date', 'code']]
+        else:
+            universe_df = pd.DataFrame([(date, code) for date in self.date_ls for code in self.universe],
+                                       columns=['date', 'code'])
+        universe_index = pd.MultiIndex.from_frame(universe_df)
+        if self.del_ST:
+            st_df = self.block_df.loc[self.block_df['ST'] == 1, ['date', 'code']]
+            universe_index = universe_index.difference(pd.MultiIndex.from_frame(st_df))
+        if self.del_suspended:
+            sus_df = self.price_df.loc[self.price_df['volume'] == 0, ['date', 'code']]
+            universe_index = universe_index.difference(pd.MultiIndex.from_frame(sus_df))
+        if self.del_newlist:
+            pre_date = universe_index.get_level_values('date').map(
+                {date: shift_date(t_date=date, days=60, direction='pre') for date in self.date_ls})
+            list_date = universe_index.get_level_values('code').map(basic_df['list_date'])
+            is_new = (list_date >= pre_date) & (list_date <= universe_index.get_level_values('date'))
+            universe_index = universe_index[~np.asarray(is_new, dtype=bool)]
+        self.universe_df = universe_index.sort_values().to_frame(index=False)
+
+    def get_raw_factor(self):
+        """
+        一次查询wind_financial_2014、factor_barra，得到所有时间节点的原始因子数据
+        self.raw_data_df：因子原始数据，pandas.DataFrame，index是[date, code]，columns是[因子名称，close，free_float_shares,
+        free_mkt, return, 行业代码]
+        """
+        self.get_stock_universe()
+        universe_index = pd.MultiIndex.from_frame(self.universe_df)
+
+        # 获取因子基础数据
+        price_df = self.price_df.set_index(['date', 'code'])
+        tprice_df = price_df[['close']].reindex(universe_index).dropna(subset=['close'])
+        data_index = tprice_df.index
+        financial_keyword_dt = {'_id': 0, 'code': 1, 'date': 1, 'free_float_shares': 1}
+        return_field = None
+        if self.cal_return == 'standard' and self.freq in ['d', 'm']:
+            return_field = {'d': 'd_return', 'm': '1m_return'}[self.freq]
+            financial_keyword_dt.update({return_field: 1})
+        financial_date_ls = self.date_ls + (self.tom_date_ls if return_field is not None else [])
+        financial_data = self.db.wind_financial_2014.find({'date': {'$in': sorted(set(financial_date_ls))}},
+                                                          financial_keyword_dt)
+        financial_df = pd.DataFrame(list(financial_data)).drop_duplicates(subset=['date', 'code'])
+        financial_df = financial_df.set_index(['date', 'code'])
+        share_df = financial_df[['free_float_shares']].reindex(data_index)
+        if len(self.style_factor_ls) != 0:
+            keyword_dt = {'_id': 0, 'code': 1, 'date': 1}
+            for f in self.style_factor_ls:
+                keyword_dt.update({f: 1})
+            factor_data = self.db.factor_barra.find({'date': {'$in': self.date_ls}}, keyword_dt)
+            factor_df = pd.DataFrame(list(factor_data)).drop_duplicates(subset=['date', 'code'])
+            factor_df = factor_df.set_index(['date', 'code']).reindex(index=data_index, columns=self.style_factor_ls)
+            data_df = pd.concat([factor_df, tprice_df, share_df], axis=1)
+        else:
+            data_df = pd.concat([tprice_df, share_df], axis=1)
+        data_df['free_mkt'] = data_df['free_float_shares'] * data_df['close']
+
+        # 获取下一期的收益率，下一期的数据按照时间节点对齐到当期
+        tom_index = pd.MultiIndex.from_arrays(
+            [data_index.get_level_values('date').map(dict(zip(self.date_ls, self.tom_date_ls))),
+             data_index.get_level_values('code')]) if len(self.tom_date_ls) != 0 else None
+        if return_field is not None:
+            return_series = financial_df[return_field].reindex(tom_index)
+            has_record = tom_index.isin(financial_df.index)
+            data_df['return'] = return_series.values
+            data_df = data_df[has_record]
+        elif self.cal_return == 'custom' and tom_index is not None:
+            post_close = price_df['close'] * price_df['adj_factor']
+            data_df['return'] = post_close.reindex(tom_index).values / post_close.reindex(data_index).values - 1
+
+        # 获取行业代码，行业代码取自上一月最后一个交易日的板块数据
+        if self.industry_standard is not None:
+            block_index = pd.MultiIndex.from_arrays(
+                [data_df.index.get_level_values('date').map(self.month_end_dt),
+                 data_df.index.get_level_values('code')])
+            industry_series = self.block_df.set_index(['date', 'code'])[self.industry_standard].reindex(block_index)
+            data_df[self.industry_standard] = industry_series.values
+            data_df = data_df.dropna(subset=[self.industry_standard])
+        self.raw_data_df = data_df.sort_index()
+
+    def process_raw_factor(self, raw_factor_df=None, style_factor_ls=None, extremum_multi=3.0, fill_method='mean',
+                           fill_fallback=False, extremum_method='mad', extremum_quantile=(0.01, 0.99)):
+        """
+        :param raw_factor_df: 在类外部进行了调整和计算后的原始因子面板数据，pandas.DataFrame，index是[date, code]，columns是因子名称
+        :param style_factor_ls: 风格因子序列，list
+        :param extremum_multi: 去极值偏离倍数，int/float
+        :param fill_method: 填空值使用的行业统计量，str，mean是等权均值，median是中位数，cap_weighted是流通市值加权均值
+        :param fill_fallback: 行业统计量填充后仍为空值时，是否用全市场统计量填充，bool
+        :param extremum_method: 去极值方法，str，mad是中位数±extremum_multi倍MAD，sigma是均值±extremum_multi倍标准差，
+                                percentile是按extremum_quantile分位数截断
+        :param extremum_quantile: 去极值的上下分位点，tuple，extremum_method为percentile时使用
+        self.clip_count_df：去极值截断数量（全部日期合计），pandas.DataFrame，index是风格因子名称，columns是[lower, upper, total]
+        self.industry_mean_df：风格因子行业均值，pandas.DataFrame，index是[date, 行业代码]，columns是风格因子名称
+        self.cap_weight_df：市值权重，pandas.DataFrame，index是[date, code]，columns是[free_mkt, sqrtmkt, weight]
+        self.drop_part_series：填空值后剔除样本的比例，pandas.Series，index是有样本剔除的日期
+        self.process_data_df：数据预处理后的因子数据，pandas.DataFrame，index是[date, code]，columns是[因子名称，close,
+        free_float_shares, free_mkt, return, 行业代码，行业虚拟变量]
+        self.industry_factor_ls：全部日期出现过的行业代码列表，list
+        """
+        self.extremum_multi = extremum_multi
+        self.get_raw_factor()
+        if raw_factor_df is None:
+            data_df = self.raw_data_df.copy()
+        else:
+            data_df = pd.concat([self.raw_data_df, raw_factor_df], axis=1, join='outer').reindex(self.raw_data_df.index)
+            self.style_factor_ls = style_factor_ls
+        industry_dummy_df = pd.get_dummies(data_df[self.industry_standard], prefix_sep='') \
+            if self.industry_standard is not None else pd.DataFrame(index=data_df.index)
+        self.industry_factor_ls = industry_dummy_df.columns.tolist()
+        data_df = pd.concat([data_df, industry_dummy_df], axis=1, join='inner')
+        if len(self.style_factor_ls) == 0:
+            self.process_data_df = data_df
+            return
+        self.cap_weight_df = data_df[['free_mkt']].copy()
+        self.cap_weight_df['sqrtmkt'] = np.sqrt(self.cap_weight_df['free_mkt'])
+        self.cap_weight_df['weight'] = self.cap_weight_df['sqrtmkt'] / \
+            self.cap_weight_df.groupby(level='date')['sqrtmkt'].transform('sum')
+        data_df[self.style_factor_ls] = data_df[self.style_factor_ls].astype('float64')
+        # 去极值
+        if self.del_extremum:
+            data_df[self.style_factor_ls], self.clip_count_df = panel_del_extremum(
+                data_df[self.style_factor_ls], self.extremum_multi, method=extremum_method, quantile=extremum_quantile)
+        # 填空值
+        if self.fill_nan:
+            data_df[self.style_factor_ls], self.industry_mean_df = panel_fill_nan(
+                data_df[self.style_factor_ls], data_df[self.industry_standard], method=fill_method,
+                weight_series=data_df['free_mkt'], market_fallback=fill_fallback)
+            is_nan = data_df.isna().any(axis=1)
+            drop_part = is_nan.groupby(level='date').mean()
+            drop_date = drop_part[(drop_part < 0.3) & (drop_part > 0)]
+            if len(drop_date) != 0:  # 如果填空值后仍为空值的样本少于30%，则剔除该部分样本
+                print('drop data:', drop_date.to_dict())
+                keep = ~(is_nan & data_df.index.get_level_values('date').isin(drop_date.index))
+                data_df = data_df[keep]
+                self.cap_weight_df = self.cap_weight_df[keep]
+                self.cap_weight_df['weight'] = self.cap_weight_df['weight'] / \
+                    self.cap_weight_df.groupby(level='date')['weight'].transform('sum')
+            self.drop_part_series = drop_date
+        # 市值和行业中性化
+        if self.neutralize:
+            exposure_df = pd.concat([np.log(data_df['free_mkt']), data_df[self.industry_factor_ls]], axis=1)
+            data_df[self.style_factor_ls] = panel_neutralize(data_df[self.style_factor_ls], exposure_df)
+        # 标准化
+        if self.standardize:
+            data_df[self.style_factor_ls] = panel_standardize(data_df[self.style_factor_ls])
+        # 正交化
+        if self.orth:
+            data_df[self.style_factor_ls] = apply_orth_spec(data_df[self.style_factor_ls], self.cap_weight_df['weight'],
+                                                            self.orth_spec_dt, level='date')
+        self.process_data_df = data_df
+
+    def get_process_data(self, date):
+        """
+        获取单个时间节点的预处理结果
+        :param date: 时间节点，str
+        :return: 与FactorCal.process_data_df结构相同的数据，pandas.DataFrame，index是股票代码，行业虚拟变量只保留当日出现的行业
+        """
+        data_df = self.process_data_df.xs(date, level='date')
+        absent_ls = [ind for ind in self.industry_factor_ls if not data_df[ind].any()]
+        return data_df.drop(columns=absent_ls)
+
+    def cal_factor_return(self, weight_factor_ls=None, chunk_size=250):
+        """
+        对全部时间节点的预处理结果批量做带约束的横截面加权回归，需要先调用process_raw_factor，
+        每个日期的结果与FactorCal.cal_factor_return相同
+        :param weight_factor_ls: 需要输出纯因子组合权重的因子名称列表，list，None表示不输出
+        :param chunk_size: 每次求解的日期数量，int
+        self.factor_return_df：因子收益率，pandas.DataFrame，index是日期，columns是[country，行业因子，风格因子]
+        self.specific_return_series：特异性收益率，pandas.Series，index是[date, code]
+        self.r2_series：加权R²，pandas.Series，index是日期
+        self.pure_weight_df：纯因子组合权重，pandas.DataFrame，index是[date, code]，columns是weight_factor_ls
+        """
+        self.factor_return_df, self.specific_return_series, self.r2_series, pure_weight_df = cal_factor_return(
+            self.process_data_df, self.style_factor_ls, self.industry_factor_ls, weight_factor_ls=weight_factor_ls,
+            chunk_size=chunk_size)
+        self.pure_weight_df = pd.DataFrame() if pure_weight_df is None else pure_weight_df
@@ -0,0 +1,158 @@
+from tool_kit import db_zcs, pd, np
+from tool_kit.date_N_time import trade_calendar
+
+
+class UniverseFilter(object):
+    """
+    股票池过滤器，一次读取一段时间的ST、停牌和上市日期数据，预先计算[日期×股票代码]的布尔矩阵，
+    之后对任意日期或日期区间的股票池过滤都是数组掩码运算，不再访问数据库
+    :param s_date: 开始日期，str，"%Y-%m-%d"
+    :param e_date: 结束日期，str，"%Y-%m-%d"
+    :param codes: 股票代码范围，list，None表示全部股票；不在范围内的股票视为没有ST和停牌标记
+    :param flag_ls: 需要预先计算的标记，list，ST是wind_block_2014中ST为1，suspended是ts_daily_adj_factor中volume为0，
+                    newlist是上市不足new_days个交易日
+    :param new_days: 新股上市时间，int
+    """
+    def __init__(self, s_date='', e_date='', codes=None, flag_ls=('ST', 'suspended', 'newlist'), new_days=60):
+        self.s_date = s_date
+        self.e_date = e_date
+        self.codes = None if codes is None else pd.Index(sorted(set(codes)))
+        self.flag_ls = list(flag_ls)
+        self.new_days = new_days
+        self.db = db_zcs
+        self.date_index = pd.Index([])
+        self.code_index = pd.Index([])
+        self.list_date_series = pd.Series()
+        self.mask_dt = {}
+        self.load()
+
+    def load(self):
+        """
+        读取数据并计算标记矩阵
+        self.date_index: 标记矩阵的日期，pandas.Index，升序
+        self.code_index: 标记矩阵的股票代码，pandas.Index，升序
+        self.list_date_series: 上市日期，pandas.Series，index是股票代码
+        self.mask_dt: 标记矩阵，dict，key是flag_ls中的标记，value是numpy.ndarray，shape是(日期数，股票数)，True表示需要剔除
+        """
+        date_query = {'$gte': self.s_date, '$lte': self.e_date}
+        code_query = {} if self.codes is None else {'code': {'$in': self.codes.tolist()}}
+        record_dt = {}
+        if 'ST' in self.flag_ls:
+            cursor = self.db.wind_block_2014.find(dict({'date': date_query, 'ST': 1}, **code_query),
+                                                  {'_id': 0, 'code': 1, 'date': 1})
+            record_dt['ST'] = pd.DataFrame(list(cursor), columns=['code', 'date'])
+        if 'suspended' in self.flag_ls:
+            cursor = self.db.ts_daily_adj_factor.find(dict({'date': date_query, 'volume': 0}, **code_query),
+                                                      {'_id': 0, 'code': 1, 'date': 1})
+            record_dt['suspended'] = pd.DataFrame(list(cursor), columns=['code', 'date'])
+        if 'newlist' in self.flag_ls:
+            cursor = self.db.ts_stock_basic.find(code_query, {'_id': 0, 'code': 1, 'list_date': 1})
+            list_date_df = pd.DataFrame(list(cursor), columns=['code', 'list_date']).drop_duplicates(subset=['code'])
+            self.list_date_series = list_date_df.set_index('code')['list_date']
+
+        record_date_set = set(date for record_df in record_dt.values() for date in record_df['date'])
+        self.date_index = pd.Index(sorted(set(trade_calendar.between(self.s_date, self.e_date)) | record_date_set))
+        if self.codes is None:
+            code_set = set(self.list_date_series.index)
+            for record_df in record_dt.values():
+                code_set |= set(record_df['code'])
+            self.code_index = pd.Index(sorted(code_set))
+        else:
+            self.code_index = self.codes
+
+        self.mask_dt = {}
+        for flag, record_df in record_dt.items():
+            mask = np.zeros((len(self.date_index), len(self.code_index)), dtype=bool)
+            date_loc = self.date_index.get_indexer(record_df['date'])
+            code_loc = self.code_index.get_indexer(record_df['code'])
+            valid = (date_loc >= 0) & (code_loc >= 0)
+            mask[date_loc[valid], code_loc[valid]] = True
+            self.mask_dt[flag] = mask
+        if 'newlist' in self.flag_ls:
+            list_date = self.list_date_series.reindex(self.code_index).to_numpy(dtype=object)
+            has_list_date = pd.notna(list_date)
+            list_date = np.where(has_list_date, list_date, '').astype(str)
+            pre_date = self.pre_date(self.date_index.to_numpy(dtype=str))
+            date_arr = self.date_index.to_numpy(dtype=str)
+            self.mask_dt['newlist'] = has_list_date[None, :] & (list_date[None, :] >= pre_date[:, None]) & \
+                (list_date[None, :] <= date_arr[:, None])
+
+    def pre_date(self, date_arr):
+        """
+        向过去追溯new_days个交易日（包含当天）的日期，与shift_date(date, new_days, 'pre')相同
+        :param date_arr: 日期数组，numpy.ndarray，元素是"%Y-%m-%d"
+        :return: 追溯后的日期数组，numpy.ndarray
+        """
+        dates = trade_calendar.get_dates('d')
+        right = np.searchsorted(dates, date_arr, side='right')
+        return dates[np.maximum(right - self.new_days, 0)]
+
+    def flag_matrix(self, s_date, e_date=None, d_ST=True, d_suspended=True, d_newlist=True):
+        """
+        :param s_date: 开始日期，str，"%Y-%m-%d"
+        :param e_date: 结束日期，str，None表示与s_date相同
+        :param d_ST: 是否剔除ST股票，bool
+        :param d_suspended: 是否剔除停牌股票，bool
+        :param d_newlist: 是否剔除新股，bool
+        :return: 区间内的合并标记矩阵，numpy.ndarray，shape是(区间日期数，股票数)，True表示需要剔除
+        """
+        e_date = s_date if e_date is None else e_date
+        if s_date < self.s_date or e_date > self.e_date:
+            raise ValueError('[%s, %s] is out of the loaded range [%s, %s]' % (s_date, e_date, self.s_date, self.e_date))
+        left = self.date_index.searchsorted(s_date, side='left')
+        right = self.date_index.searchsorted(e_date, side='right')
+        flag = np.zeros((right - left, len(self.code_index)), dtype=bool)
+        for name, use in [('ST', d_ST), ('suspended', d_suspended), ('newlist', d_newlist)]:
+            if use:
+                if name not in self.mask_dt:
+                    raise KeyError('%s is not in flag_ls' % name)
+                flag |= self.mask_dt[name][left:right]
+        return flag
+
+    def flag_df(self, s_date, e_date=None, d_ST=True, d_suspended=True, d_newlist=True):
+        """
+        :param s_date: 开始日期，str，"%Y-%m-%d"
+        :param e_date: 结束日期，str，None表示与s_date相同
+        :param d_ST: 是否剔除ST股票，bool
+        :param d_suspended: 是否剔除停牌股票，bool
+        :param d_newlist: 是否剔除新股，bool
+        :return: 区间内的合并标记矩阵，pandas.DataFrame，index是日期，columns是股票代码，True表示需要剔除
+        """
+        flag = self.flag_matrix(s_date, e_date, d_ST, d_suspended, d_newlist)
+        left = self.date_index.searchsorted(s_date, side='left')
+        return pd.DataFrame(flag, index=self.date_index[left:left + len(flag)], columns=self.code_index)
+
+    def filter(self, universe, s_date, e_date=None, d_ST=True, d_suspended=True, d_newlist=True):
+        """
+        过滤股票池，区间内任意一天有标记的股票都被剔除，与del_ST、del_suspended、del_newlist的结果相同，不修改传入的股票池
+        :param universe: 初始股票池列表，list
+        :param s_date: 开始日期，str，"%Y-%m-%d"
+        :param e_date: 结束日期，str，None表示与s_date相同
+        :param d_ST: 是否剔除ST股票，bool
+        :param d_suspended: 是否剔除停牌股票，bool
+        :param d_newlist: 是否剔除新股，bool
+        :return: 过滤后的股票池列表，list，保持原有顺序
+        """
+        e_date = s_date if e_date is None else e_date
+        flagged = self.flag_matrix(s_date, e_date, d_ST, d_suspended, False).any(axis=0)
+        if d_newlist:
+            # 区间内的新股等价于上市日期在[s_date向前追溯new_days个交易日, e_date]内，不受标记矩阵日期范围限制
+            pre_s_date = self.pre_date(np.array([s_date]))[0]
+            list_date = self.list_date_series.reindex(self.code_index)
+            flagged |= ((list_date >= pre_s_date) & (list_date <= e_date)).to_numpy()
+        loc = self.code_index.get_indexer(universe)
+        keep = (loc < 0) | ~flagged[np.maximum(loc, 0)]
+        return [code for code, k in zip(universe, keep) if k]
+
+    def apply_mask(self, member_df, d_ST=True, d_suspended=True, d_newlist=True):
+        """
+        对多个日期的股票池成员矩阵同时过滤，每个日期只剔除当天有标记的股票
+        :param member_df: 股票池成员矩阵，pandas.DataFrame，index是股票代码，columns是日期，值为bool
+        :param d_ST: 是否剔除ST股票，bool
+        :param d_suspended: 是否剔除停牌股票，bool
+        :param d_newlist: 是否剔除新股，bool
+        :return: 过滤后的股票池成员矩阵，pandas.DataFrame，结构与member_df相同
+        """
+        flag_df = self.flag_df(self.s_date, self.e_date, d_ST, d_suspended, d_newlist).T
+        flag_df = flag_df.reindex(index=member_df.index, columns=member_df.columns, fill_value=False)
+        return member_df.astype(bool) & ~flag_df
@@ -1,9 +1,18 @@
 
 import smtplib
-import statsmodels.api as sm
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
 from tool_kit import db_zcs, pd, np, datetime
 from tool_kit.base_datastruct import block_data, basic_codes
 from tool_kit.date_N_time import gen_trade_date, shift_date
+from tool_kit.price_store_tool import load_price_matrix, get_post_close, cal_return_matrix
+from tool_kit.performance_tool import cal_drawdown
+from tool_kit.preprocess_tool import neutralize_cross_section, winsorize
+from tool_kit.universe_tool import UniverseFilter
+from tool_kit.ewma_tool import ewma_weight, ewma_decay
+from tool_kit.orth_tool import orth_array, lowdin_orth
+from tool_kit.raw_data_tool import RawDataLoader
+from tool_kit.position_tool import simulate_position
 from scipy import stats
 from email.mime.text import MIMEText
 from email.header import Header
@@ -16,16 +25,14 @@ def del_ST(s_date, e_date, initial_universe):
     :param s_date: 开始日期，str，"%Y-%m-%d"
     :param e_date: 结束日期，str，"%Y-%m-%d"
     :param initial_universe: 初始股票池列表，list
-    :return: 删除ST股票后的股票池列表，list
+    :return: 删除ST股票后的股票池列表，list，不修改initial_universe
     """
     database = db_zcs
     st_stock = database.wind_block_2014.find(
         {'date': {'$gte': s_date, '$lte': e_date}, 'code': {'$in': initial_universe}, 'ST': 1},
         {'_id': 0, 'code': 1})
-    st_stock_ls = list(set([stock['code'] for stock in st_stock]))
-    for stock in st_stock_ls:
-        initial_universe.remove(stock)
-    return initial_universe
+    st_stock_set = set(stock['code'] for stock in st_stock)
+    return [stock for stock in initial_universe if stock not in st_stock_set]
 
 
 def del_suspended(s_date, e_date, initial_universe):
@@ -34,16 +41,14 @@ def del_suspended(s_date, e_date, initial_universe):
     :param s_date: 开始日期，str，"%Y-%m-%d"
     :param e_date: 结束日期，str，"%Y-%m-%d"
     :param initial_universe: 初始股票池列表，list
-    :return:删除停牌股票后的股票池列表，list
+    :return:删除停牌股票后的股票池列表，list，不修改initial_universe
     """
     database = db_zcs
     sus_stock = database.ts_daily_adj_factor.find(
         {'date': {'$gte': s_date, '$lte': e_date}, 'code': {'$in': initial_universe}, 'volume': 0},
         {'_id': 0, 'code': 1})
-    sus_stock_ls = list(set([stock['code'] for stock in sus_stock]))
-    for stock in sus_stock_ls:
-        initial_universe.remove(stock)
-    return initial_universe
+    sus_stock_set = set(stock['code'] for stock in sus_stock)
+    return [stock for stock in initial_universe if stock not in sus_stock_set]
 
 
 def del_newlist(s_date, e_date, initial_universe, new_days=60):
@@ -53,29 +58,24 @@ def del_newlist(s_date, e_date, initial_universe, new_days=60):
     :param e_date: 结束日期，str，"%Y-%m-%d"
     :param initial_universe: 初始股票池列表，list
     :param new_days: 新股上市时间，int
-    :return: 剔除上市不足new_days日的股票后的股票池列表，list
+    :return: 剔除上市不足new_days日的股票后的股票池列表，list，不修改initial_universe
     """
     database = db_zcs
     cursor = database.ts_stock_basic.find({'code': {'$in': initial_universe}}, {'_id': 0, 'code': 1, 'list_date': 1})
     list_date_df = pd.DataFrame(it for it in cursor).set_index('code')
     pre_s_date = shift_date(t_date=s_date, days=new_days, direction='pre')
-    new_stock_ls = list_date_df[(list_date_df['list_date'] >= pre_s_date) & (list_date_df['list_date'] <= e_date)].index.tolist()
-    for stock in new_stock_ls:
-        initial_universe.remove(stock)
-    return initial_universe
+    new_stock_set = set(list_date_df[(list_date_df['list_date'] >= pre_s_date) & (list_date_df['list_date'] <= e_date)].index)
+    return [stock for stock in initial_universe if stock not in new_stock_set]
 
 
 def do_del_extremum(one_factor, multi=3.0):
     """
-    对一日多股票单因子向量去极值函数
+    对一日多股票单因子向量去极值函数，超出[中位数-multi*MAD, 中位数+multi*MAD]的值截断到边界
     :param one_factor: 一日多股票单因子向量，Series，index是股票代码
     :param multi：偏离倍数，int/float
     :return: 去极值后的一日多股票单因子向量，Series，index是股票代码
     """
-    media = one_factor.median()
-    deviation = abs(one_factor - media)
-    mad = deviation.median()
-    return one_factor
+    return winsorize(one_factor.to_frame(), 'mad', multi)[0].iloc[:, 0]
 
 
 def do_fill_nan(one_factor, ind, ind_mean):
@@ -86,28 +86,20 @@ def do_fill_nan(one_factor, ind, ind_mean):
     :param ind_mean:因子行业均值矩阵，pandas.DataFrame，index是行业代码，columns是因子名称
     :return:填空值后的一日多股票单因子向量，Series，index是股票代码
     """
-    non_series = one_factor[one_factor.isna()]
-    for stock in non_series.index:
-        if ind[stock] is None:  # if isinstance(ind[stock], float) and np.isnan(ind[stock]):
-            continue
-        else:
-            non_series[stock] = ind_mean.at[ind[stock], one_factor.name]
-    one_factor.update(non_series)
-    return one_factor
+    return one_factor.fillna(ind.reindex(one_factor.index).map(ind_mean[one_factor.name]))
 
 
 def do_neutralize(one_factor, cap_indus_factor=None):
     """
     对一日多股票单因子向量进行市值和行业中性化函数
     :param one_factor: 一日多股票单因子向量，pandas.Series，index是股票代码，name是因子名称
-    :param cap_indus_factor: 市值因子和行业因子，pandas.DataFrame，index是股票代码，columns是[free_mkt，行业代码]
+    :param cap_indus_factor: 市值因子和行业因子，pandas.DataFrame，index是股票代码，columns是[free_mkt，行业代码]，不会被修改
     :return: 中性化后的一日多股票单因子向量，pandas.Series，index是股票代码，name是因子名称
     """
-    cap_indus_factor.loc[:, 'free_mkt'] = np.log(cap_indus_factor['free_mkt'])
+    exposure_df = cap_indus_factor.assign(free_mkt=np.log(cap_indus_factor['free_mkt']))
     # 原算法
     # cap_indus_factor.loc[:, 'free_mkt'] = standardize(cap_indus_factor['free_mkt'], None)
-    ols = sm.OLS(endog=one_factor, exog=cap_indus_factor, hasconst=False).fit()
-    result_factor = ols.resid.rename(one_factor.name)
+    result_factor = neutralize_cross_section(one_factor.to_frame(), exposure_df)[one_factor.name]
     return result_factor
 
 
@@ -133,13 +125,10 @@ def do_orth(one_factor, independent_factor, weight_factor):
     :param weight_factor: 市值权重，Series，index是股票代码
     :return: 正交化后的一日多股票单因子向量，Series，index是股票代码
     """
-    y = one_factor.values
-    x = independent_factor.values
-    wls = sm.WLS(y, x, weights=weight_factor**2)
-    reg_result = wls.fit()
-    resid_factor = pd.Series(reg_result.resid, index=one_factor.index)
-    std_resid_factor = do_standardize(resid_factor, weight_factor)
-    return std_resid_factor
+    std_resid_factor = orth_array(one_factor.to_numpy(dtype='float64'),
+                                  independent_factor.reindex(one_factor.index).to_numpy(dtype='float64'),
+                                  weight_factor.reindex(one_factor.index).to_numpy(dtype='float64'))
+    return pd.Series(std_resid_factor, index=one_factor.index)
 
 
 def half_decay_weight(t_start=0, t_end=2, half_period=1, descend=True):
@@ -151,15 +140,11 @@ def half_decay_weight(t_start=0, t_end=2, half_period=1, descend=True):
     :param descend: 权重衰减方向，bool，True，大->小，False，小->大
     :return: 半衰权重序列，list
     """
-    if half_period == 0:
-        half_period = 1
-    weight_vector = []
-    for t in range(t_start, t_end+1):
-        weight_vector.append(0.5 ** (t / half_period))
-    weight_sum = sum(weight_vector)
-    weight_vector = [i/weight_sum for i in weight_vector]
-    weight_vector.sort(reverse=descend)
-    return weight_vector
+    if t_start == 0:
+        return ewma_weight(t_end + 1, half_period, descend).tolist()
+    weight_vector = ewma_decay(half_period) ** np.arange(t_start, t_end + 1, dtype='float64')
+    weight_vector = weight_vector / weight_vector.sum()
+    return (weight_vector if descend else weight_vector[::-1]).tolist()
 
 
 def send_email(sender='xxx', sender_name='', sender_ip='xxx', sender_port=465,
@@ -211,13 +196,31 @@ def gen_universe(s_date, e_date, freq='d', index='A'):
     return stock_universe
 
 
-def get_mkt_group(group_standard=None, stock_universe=None, date='', group_nums=10):
+def gen_universe_mask(date_ls, index='a_share'):
+    """
+    生成指定日期的股票池成员矩阵，每个日期只构造一次block_data
+    :param date_ls: 日期列表，list，元素是"%Y-%m-%d"
+    :param index: 股票池名称，str，a_share/sz50/hs300/zz500/zz800/zz1000
+    :return: 股票池成员矩阵，pandas.DataFrame，index是股票代码，columns是date_ls中的日期，值为bool
+    """
+    if index == 'A':
+        index = 'a_share'
+    member_dt = {date: getattr(block_data(date=date), index)() for date in date_ls}
+    all_codes = pd.Index(sorted(set(code for codes in member_dt.values() for code in codes)))
+    mask = np.zeros((len(all_codes), len(date_ls)), dtype=bool)
+    for j, date in enumerate(date_ls):
+        mask[all_codes.get_indexer(member_dt[date]), j] = True
+    return pd.DataFrame(mask, index=all_codes, columns=date_ls)
+
+
+def get_mkt_group(group_standard=None, stock_universe=None, date='', group_nums=10, raw_data_loader=None):
     """
     生成市值分组序列，若股票池中的股票不在基准股票池中，则用先ffill再bfill的方法填充
     :param group_standard: 分组基准股票池，可选A，hs300，zz500或传入股票池
     :param stock_universe: 目标股票池，list
     :param date: 分组日期，str
     :param group_nums: 分组数量，int
+    :param raw_data_loader: 因子基础数据读取器，raw_data_tool.RawDataLoader，None表示每次调用新建一个只读取close和free_float_shares的读取器
     :return: 市值分组序列，pandas.Series，index是股票代码
     """
     db = db_zcs
@@ -229,14 +232,11 @@ def get_mkt_group(group_standard=None, stock_universe=None, date='', group_nums=
         standard_universe = group_standard
     all_universe = list(set(stock_universe+standard_universe))
     all_universe.sort()
-    price_cursor = db.ts_daily_adj_factor.find({'date': date, 'code': {'$in': all_universe}},
-                                               {'_id': 0, 'code': 1, 'close': 1})
-    tprice_df = pd.DataFrame(it for it in price_cursor).set_index('code')
-    share_cursor = db.wind_financial_2014.find({'date': date, 'code': {'$in': all_universe}},
-                                               {'_id': 0, 'code': 1, 'free_float_shares': 1})
-    share_df = pd.DataFrame(it for it in share_cursor).set_index('code')
-    cap_df = pd.concat([tprice_df, share_df], join='inner', axis=1)
-    cap_df['free_mkt'] = cap_df['close'] * cap_df['free_float_shares']
+    if raw_data_loader is None:
+        raw_data_loader = RawDataLoader(price_field_ls=['close'], financial_field_ls=['free_float_shares'],
+                                        code_ls=all_universe, db=db)
+    cap_df = raw_data_loader.cross_section(date, ['close', 'free_float_shares', 'free_mkt'], all_universe,
+                                           require_ls=['ts_daily_adj_factor', 'wind_financial_2014'])
     group_series = pd.qcut(x=cap_df[cap_df.index.isin(standard_universe)]['free_mkt'], q=group_nums, labels=False
                            ).rename('mkt_group')
     cap_df = pd.concat([cap_df, group_series], join='outer', axis=1, sort=False).sort_values(by='free_mkt')
@@ -274,18 +274,11 @@ def boxcox_normal(onefactor):
 
 def symmetric_orth(fct_df):
     """
-    因子对称正交化函数
+    因子对称正交化函数，计算方法见orth_tool.lowdin_orth
     :param fct_df: 数据预处理后的因子矩阵，pandas.DataFrame，index是股票名称，columns是因子名称
     :return: 对称正交化后的因子矩阵，pandas.DataFrame，index是股票名称，columns是因子名称
     """
-    F = fct_df.values
-    fct_overlap = F.T @ F
-    eigenvalue, eigenvector = np.linalg.eig(fct_overlap)
-    diag_matrix = np.diag(eigenvalue ** (-0.5))
-    transition_matrix = eigenvector @ diag_matrix @ eigenvector.T
-    F_orth = F @ transition_matrix
-    orth_fct_df = pd.DataFrame(F_orth, columns=fct_df.columns, index=fct_df.index)
-    return orth_fct_df
+    return lowdin_orth(fct_df, method='symmetric')
 
 
 # def get_direction(onefactor_ic=None):
@@ -299,18 +292,28 @@ def symmetric_orth(fct_df):
 #         return np.nan
 
 
-def get_cap(universe, s_date, e_date):
+def get_cap(universe, s_date, e_date, raw_data_loader=None):
     """
     获取流通市值
     :param universe: 股票池，list
     :param s_date: 开始日期，str，'%Y-%m-%d'
     :param e_date: 结束日期，str，'%Y-%m-%d'
+    :param raw_data_loader: 因子基础数据读取器，raw_data_tool.RawDataLoader，不为None时close和free_float_shares都从读取器中取，
+                            None表示close从本地价格库或数据库读取、free_float_shares按日期区间查询
     :return: 股票池中的股票在这段时间的流通市值，pandas.DataFrame，index是[股票代码，日期]，columns是[free_mkt]
     """
     db = db_zcs
-    cursor1 = db.ts_daily_adj_factor.find({'code': {'$in': universe}, 'date': {'$gte': s_date, '$lte': e_date}},
-                                          {'_id': 0, 'code': 1, 'date': 1, 'close': 1})
-    price_df = pd.DataFrame(list(cursor1)).set_index(['code', 'date'])
+    if raw_data_loader is not None:
+        date_ls = gen_trade_date(s_date, e_date)
+        exist_df = raw_data_loader.exist('ts_daily_adj_factor', date_ls, universe) & \
+            raw_data_loader.exist('wind_financial_2014', date_ls, universe)
+        keep_df = exist_df & raw_data_loader.matrix('close', date_ls, universe).notna()
+        cap_series = raw_data_loader.matrix('free_mkt', date_ls, universe).T.stack(dropna=False)
+        cap_series = cap_series[keep_df.T.stack(dropna=False).to_numpy()]
+        cap_series.index.names = ['code', 'date']
+        return cap_series.sort_index().rename('free_mkt').to_frame()
+    close_df = load_price_matrix(['close'], s_date, e_date, universe)['close']
+    price_df = close_df.T.stack().rename('close').to_frame()
     cursor2 = db.wind_financial_2014.find({'code': {'$in': universe}, 'date': {'$gte': s_date, '$lte': e_date}},
                                           {'_id': 0, 'code': 1, 'date': 1, 'free_float_shares': 1})
     share_df = pd.DataFrame(list(cursor2)).set_index(['code', 'date'])
@@ -514,88 +517,56 @@ def cal_period_return(s_date='', e_date='', stock_universe=None):
     :param stock_universe: 股票池，list
     :return: 股票池中的股票在s_date和e_date之间
     """
-    db = db_zcs
-    cursor = db.ts_daily_adj_factor.find(
-        {'date': {'$in': [s_date, e_date]}, 'code': {'$in': stock_universe}},
-        {'_id': 0, 'code': 1, 'date': 1, 'close': 1, 'adj_factor': 1})
-    price_df = pd.DataFrame(it for it in cursor).sort_values(['code', 'date']).set_index('code')
-    price_df['post_close'] = price_df['close'] * price_df['adj_factor']
-    return_series = price_df['post_close'].groupby(level=0, group_keys=False).apply(lambda x: x.pct_change().tail(1))
+    post_close_df = get_post_close(codes=stock_universe, date_ls=[s_date, e_date]).reindex([s_date, e_date])
+    return_series = post_close_df.iloc[-1] / post_close_df.iloc[0] - 1
+    return_series = return_series[post_close_df.notna().any(axis=0)]
     return_series.rename('return', inplace=True)
     return return_series
 
 
-def gen_daily_return_matrix(s_date='', e_date='', stock_universe=None):
+def gen_daily_return_matrix(s_date='', e_date='', stock_universe=None, cache=False):
     """
     生成一段时间的日频股票收益率矩阵
     :param s_date: 开始日期，str，"%Y-%m-%d"
     :param e_date: 结束日期，str，"%Y-%m-%d"
     :param stock_universe: 股票池，list
+    :param cache: 是否使用进程内的后复权价格缓存，bool，见price_store_tool.load_adjusted_price
     :return: 日频股票收益率矩阵，index是日期，columns是股票代码
     """
-    db = db_zcs
-    cursor = db.ts_daily_adj_factor.find({'date': {'$gte': s_date, '$lte': e_date}, 'code': {'$in': stock_universe}},
-                                         {'_id': 0, 'code': 1, 'date': 1, 'close': 1, 'adj_factor': 1})
-    price_df = pd.DataFrame(it for it in cursor).set_index(['code', 'date'])
-    price_df['post_close'] = price_df['close'] * price_df['adj_factor']
-    price_df['return'] = price_df['post_close'].groupby(level=0).pct_change()
-    return_df = price_df['return'].unstack(level=0).dropna(axis=0)
+    return_df = cal_return_matrix(get_post_close(s_date, e_date, stock_universe, cache=cache)).dropna(axis=0)
     return return_df
 
 
-def gen_continuous_position(discrete_position_df=None, end_date=''):
+def gen_continuous_position(discrete_position_df=None, end_date='', universe_filter=None):
     """
     生成连续持仓，每个交易日都会对持仓股票的权重进行调整
-    :param discrete_position_df: 非连续持仓数据，pandas.DataFrame，index是股票代码，columns是日期
+    :param discrete_position_df: 非连续持仓数据，pandas.DataFrame，index是股票代码，columns是日期，不会被修改
     :param end_date: 结束持仓日期，str，"%Y-%m-%d"
+    :param universe_filter: 股票池过滤器，universe_tool.UniverseFilter，需包含suspended标记并覆盖持仓区间，
+                            None表示按持仓股票和持仓区间一次性构造
     :return: 连续持仓数据，pandas.DataFrame，index是股票代码，columns是连续持仓日期
     """
-    db = db_zcs
     universe = discrete_position_df.index.tolist()
     date_ls = gen_trade_date(discrete_position_df.columns[0], end_date)
-    cursor = db.ts_daily_adj_factor.find({'date': {'$gte': discrete_position_df.columns[0],
-                                                   '$lte': end_date},
-                                          'code': {'$in': universe}},
-                                         {'_id': 0, 'code': 1, 'date': 1, 'close': 1, 'adj_factor': 1})
-    price_df = pd.DataFrame(list(cursor)).set_index(['code', 'date'])
-    price_df['post_close'] = price_df['close'] * price_df['adj_factor']
-    return_df = price_df['post_close'].unstack(level=1)
+    return_df = get_post_close(discrete_position_df.columns[0], end_date, universe).T
     return_df = return_df.pct_change(axis=1)
+    if universe_filter is None:
+        universe_filter = UniverseFilter(discrete_position_df.columns[0], end_date, universe, flag_ls=['suspended'])
+    suspended_df = universe_filter.flag_df(date_ls[0], date_ls[-1], d_ST=False, d_newlist=False)
+    suspended_df = suspended_df.reindex(index=date_ls, columns=universe, fill_value=False)
+
+    # 调仓日目标权重：未停牌股票的权重归一化，停牌股票保留原始权重
+    rebalance_ls = [date for date in discrete_position_df.columns if date in set(date_ls)]
+    target_df = discrete_position_df[rebalance_ls].T
+    rebalance_suspended_df = suspended_df.loc[rebalance_ls]
+    target_df = target_df.where(rebalance_suspended_df, target_df.div(target_df.mask(rebalance_suspended_df).sum(axis=1),
+                                                                    axis=0))
 
-    for trade_date in discrete_position_df.columns:
-        position_series = discrete_position_df.loc[:, trade_date]
-        position_series = position_series.loc[
-            del_suspended(trade_date, trade_date, discrete_position_df.index.tolist())]
-        position_series = position_series / position_series.sum()
-        discrete_position_df.update(position_series)
-
-    position_ls = [discrete_position_df.iloc[:, 0].dropna()]
-    for date in date_ls[1:]:
-        if date in discrete_position_df.columns.tolist():
-            temp_df1 = pd.concat([position_ls[-1].rename('weight'), return_df.loc[:, date].rename('return')],
-                                 join='inner',
-                                 axis=1)
-            temp_df1['new_weight'] = temp_df1['weight'] * (1 + temp_df1['return'])
-            pre_suspended = list(set(temp_df1.index.tolist()) - set(del_suspended(date, date, temp_df1.index.tolist())))
-            position_series = discrete_position_df.loc[:, date].dropna()
-            valid_weight = temp_df1.loc[del_suspended(date, date, temp_df1.index.tolist()), 'new_weight'].sum()
-            position_series = position_series * valid_weight
-            universe = list(set(position_series.index.tolist() + pre_suspended))
-            universe.sort()
-            position_series = position_series.reindex(index=universe)
-            position_series.loc[pre_suspended] = temp_df1.loc[pre_suspended, 'new_weight'].copy()
-            position_series = position_series/position_series.sum()
-            position_ls.append(position_series)
-        else:
-            position_series = position_ls[-1]
-            temp_df1 = pd.concat([position_series.rename('weight'), return_df.loc[:, date].rename('return')],
-                                 join='inner',
-                                 axis=1)
-            temp_df1['new_weight'] = temp_df1['weight'] * (1 + temp_df1['return'])
-            temp_df1['new_weight'] = temp_df1['new_weight'] / temp_df1['new_weight'].sum()
-            position_ls.append(temp_df1['new_weight'].rename(date))
-    position_df = pd.concat(position_ls, axis=1, join='outer')
-    return position_df
+    weight_arr = simulate_position(target_df.reindex(date_ls).to_numpy(dtype='float64'),
+                                   return_df.reindex(index=universe, columns=date_ls).T.to_numpy(dtype='float64'),
+                                   np.isin(date_ls, rebalance_ls), suspended_df.to_numpy())[0]
+    position_df = pd.DataFrame(weight_arr.T, index=universe, columns=date_ls)
+    return position_df[position_df.notna().any(axis=1)].sort_index()
 
 
 def select_prefix_by_type(ins_type):
@@ -661,21 +632,52 @@ def is_mongo_finished(update_date, part):
         return False
 
 
-def update_from_df(raw_data, table_name=''):
+def update_from_df(raw_data, table_name='', batch_size=1000, ordered=False, n_jobs=1, coll=None):
     """
-    从DataFrame中获取数据更新到database
+    从DataFrame中获取数据批量更新到database，每个(股票代码，日期)对应一个upsert的UpdateOne，按batch_size分批bulk_write
+    ordered为False或n_jobs大于1时更新的执行顺序不确定，raw_data中重复的(股票代码，日期)不再保证以最后一行为准，需要先去重
     :param raw_data: 原始数据，pandas.DataFrame，index是(股票代码，日期)，columns是字段名称
     :param table_name: 数据表名称，str
-    :return: 无返回值，更新至数据库.zcs指定数据表中
-    """
-    data_ls = raw_data.to_dict(orient='records')
+    :param batch_size: 每批写入的文档数量，int
+    :param ordered: 是否按顺序写入，bool，False时数据库不必按顺序执行同一批中的更新，某条更新出错时其余更新照常写入
+    :param n_jobs: 同时写入的批次数量，int，大于1时使用线程池并发写入
+    :param coll: 数据库变量，None表示数据库.zcs中的table_name数据表
+    :return: 写入统计，dict，key是n_docs、n_batches、matched、modified、upserted、seconds、docs_per_second，
+             数据更新至数据库.zcs指定数据表中
+    """
+    start_time = datetime.now()
     length = len(raw_data)
-    for i in range(length):
-        print(i / length)
-        ind = raw_data.index[i]
-        db_zcs[table_name].update_one({'code': [e1 for e1 in ind if '.' in e1][0],
-                                       'date': [e2 for e2 in ind if '-' in e2][0]},
-                                      {'$set': data_ls[i]}, upsert=True)
+    # 股票代码和日期在index中的位置对所有行相同，按第一行确定后整列取出
+    index_df = raw_data.index.to_frame(index=False).astype(str)
+    if length > 0:
+        first_row = index_df.iloc[0].tolist()
+        code_arr = index_df.iloc[:, [i for i, e in enumerate(first_row) if '.' in e][0]].to_numpy()
+        date_arr = index_df.iloc[:, [i for i, e in enumerate(first_row) if '-' in e][0]].to_numpy()
+    coll = db_zcs[table_name] if coll is None else coll
+
+    def write(batch_start):
+        batch_df = raw_data.iloc[batch_start:batch_start + batch_size]
+        request_ls = [UpdateOne({'code': code, 'date': date}, {'$set': doc}, upsert=True)
+                      for code, date, doc in zip(code_arr[batch_start:batch_start + batch_size],
+                                                 date_arr[batch_start:batch_start + batch_size],
+                                                 batch_df.to_dict(orient='records'))]
+        return coll.bulk_write(request_ls, ordered=ordered)
+
+    batch_start_ls = list(range(0, length, batch_size))
+    if n_jobs == 1:
+        result_ls = []
+        for batch_start in batch_start_ls:
+            result_ls.append(write(batch_start))
+            print(min(batch_start + batch_size, length) / length)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            result_ls = list(executor.map(write, batch_start_ls))
+    seconds = (datetime.now() - start_time).total_seconds()
+    return {'n_docs': length, 'n_batches': len(batch_start_ls),
+            'matched': sum(result.matched_count for result in result_ls),
+            'modified': sum(result.modified_count for result in result_ls),
+            'upserted': sum(result.upserted_count for result in result_ls),
+            'seconds': seconds, 'docs_per_second': length / seconds if seconds > 0 else np.nan}
 
 
 def match_code(raw_df, table=''):
@@ -702,8 +704,7 @@ def cal_indicator(net_value_df):
     :return: 回测指标，pandas.DataFrame，index是策略名称，columns是回测指标名称
     """
     annual_return = net_value_df.iloc[-1, :] ** (252.0 / len(net_value_df)) - 1
-    drawdown_df = net_value_df.apply(lambda x: x / net_value_df.loc[:x.name, :].max() - 1, axis=1)
-    max_drawdown = drawdown_df.min() * -1
+    max_drawdown = cal_drawdown(net_value_df).min() * -1
     daily_ret_df = net_value_df.pct_change().fillna(0)
     sharpe_ratio = daily_ret_df.mean() / daily_ret_df.std() * (252 ** 0.5)
     indicator_df = pd.concat([annual_return.rename('annualized_returns'), max_drawdown.rename('max_drawdown'),
@@ -0,0 +1,102 @@
+import time
+from threading import Lock
+from tool_kit import pd, np, datetime
+from tool_kit.utility_tool import update_from_df
+
+
+class MockResult(object):
+    """
+    模拟pymongo的写入结果，只包含update_from_df统计用到的计数
+    """
+    def __init__(self, matched_count, upserted_count):
+        self.matched_count = matched_count
+        self.modified_count = matched_count
+        self.upserted_count = upserted_count
+
+
+class MockCollection(object):
+    """
+    内存中的模拟数据表，按(股票代码，日期)upsert，每次update_one或bulk_write固定等待latency秒模拟一次数据库往返，
+    用于不连接数据库比较update_from_df不同参数的写入速度
+    :param latency: 每次往返的等待时间，float，秒
+    :param per_doc: 每个文档的写入时间，float，秒
+    """
+    def __init__(self, latency=0.0005, per_doc=2e-6):
+        self.latency = latency
+        self.per_doc = per_doc
+        self.store = {}
+        self.n_calls = 0
+        self.lock = Lock()
+
+    def upsert(self, query, update):
+        """
+        :param query: 查询条件，dict，包含code和date
+        :param update: 更新内容，dict，{'$set': 字段值}
+        :return: 是否匹配到已有文档，bool
+        """
+        key = (query['code'], query['date'])
+        with self.lock:
+            matched = key in self.store
+            self.store.setdefault(key, dict(query)).update(update['$set'])
+        return matched
+
+    def update_one(self, query, update, upsert=False):
+        with self.lock:
+            self.n_calls += 1
+        time.sleep(self.latency + self.per_doc)
+        matched = self.upsert(query, update)
+        return MockResult(int(matched), int(not matched))
+
+    def bulk_write(self, request_ls, ordered=True):
+        with self.lock:
+            self.n_calls += 1
+        time.sleep(self.latency + self.per_doc * len(request_ls))
+        matched_ls = [self.upsert(request._filter, request._doc) for request in request_ls]
+        return MockResult(sum(matched_ls), len(matched_ls) - sum(matched_ls))
+
+
+def update_by_row(raw_data, coll):
+    """
+    逐行update_one写入，与批量写入之前的update_from_df相同，作为比较基准
+    :param raw_data: 原始数据，pandas.DataFrame，index是(股票代码，日期)，columns是字段名称
+    :param coll: 数据库变量
+    :return: 写入统计，dict，key是n_docs、seconds、docs_per_second
+    """
+    start_time = datetime.now()
+    data_ls = raw_data.to_dict(orient='records')
+    for i, ind in enumerate(raw_data.index):
+        coll.update_one({'code': [e1 for e1 in ind if '.' in e1][0], 'date': [e2 for e2 in ind if '-' in e2][0]},
+                        {'$set': data_ls[i]}, upsert=True)
+    seconds = (datetime.now() - start_time).total_seconds()
+    return {'n_docs': len(raw_data), 'seconds': seconds, 'docs_per_second': len(raw_data) / seconds}
+
+
+def bench_update_from_df(n_codes=200, n_dates=50, latency=0.0005, param_ls=None):
+    """
+    用模拟数据表比较逐行写入和update_from_df不同参数的写入速度，并检查写入结果相同
+    :param n_codes: 股票数量，int
+    :param n_dates: 日期数量，int
+    :param latency: 每次数据库往返的等待时间，float，秒
+    :param param_ls: update_from_df的参数列表，list，每个元素是dict，None表示默认的几组batch_size、n_jobs
+    :return: 写入统计，pandas.DataFrame，index是写入方式，columns是n_docs、n_calls、seconds、docs_per_second
+    """
+    if param_ls is None:
+        param_ls = [{'batch_size': 1000}, {'batch_size': 1000, 'ordered': True}, {'batch_size': 500, 'n_jobs': 4}]
+    codes = ['%06d.SZ' % i for i in range(n_codes)]
+    dates = pd.bdate_range('2015-01-01', periods=n_dates).strftime('%Y-%m-%d')
+    index = pd.MultiIndex.from_product([codes, dates])
+    raw_data = pd.DataFrame(np.random.RandomState(0).normal(size=(len(index), 3)), index=index, columns=['a', 'b', 'c'])
+    base_coll = MockCollection(latency)
+    stat_dt = {'update_one': dict(update_by_row(raw_data, base_coll), n_calls=base_coll.n_calls)}
+    for param in param_ls:
+        coll = MockCollection(latency)
+        stat = update_from_df(raw_data, coll=coll, **param)
+        if coll.store != base_coll.store:
+            raise ValueError('写入结果与逐行写入不同：%s' % param)
+        stat_dt[', '.join('%s=%s' % item for item in param.items())] = dict(stat, n_calls=coll.n_calls)
+    stat_df = pd.DataFrame(stat_dt).T[['n_docs', 'n_calls', 'seconds', 'docs_per_second']]
+    return stat_df.astype({'n_docs': int, 'n_calls': int})
+
+
+if __name__ == '__main__':
+    print(bench_update_from_df())